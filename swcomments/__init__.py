@@ -1,8 +1,11 @@
-from swcomments import models, forms, views, signals
+from swcomments import models, forms, views, signals, counters, cache, ratings, search, instrumentation
+from swcomments.registry import registry
 
 def bind_form_to_model(form_class, model_class):
   form_class.MODEL_CLASS = model_class
   model_class.FORM_CLASS = form_class
+  registry.register(model_class)
+  instrumentation.instrument_model(model_class)
 
 def __bind_forms_to_models():
   # Bind each model to a form and vice-versa
@@ -15,6 +18,7 @@ def __bind_forms_to_models():
     ('RatingComment', 'RatingCommentForm'),
     ('StackedComment', 'StackedCommentForm'),
     ('StackedRatingComment', 'StackedRatingCommentForm'),
+    ('ThreadedComment', 'ThreadedCommentForm'),
   ]
 
   for m,f in pairs:
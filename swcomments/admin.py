@@ -1,24 +1,132 @@
+import re
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models.query import QuerySet
+
 from swcomments import models
 
-class CommentAdmin(admin.ModelAdmin):
+# Up to this many rows, changelists show exact counts; above, an estimate (or this many + 1)
+ADMIN_EXACT_COUNT_LIMIT = getattr(settings, 'SWCOMMENTS_ADMIN_EXACT_COUNT_LIMIT', 10000)
+
+def estimate_count(qs):
+  """Return the planner's estimate of the number of rows of 'qs' (None if not available:
+  only PostgreSQL and MySQL have one)"""
+  connection = connections[qs.db]
+  if connection.vendor not in ('postgresql', 'mysql'):
+    return None
+  sql, params = qs.order_by().query.get_compiler(using=qs.db).as_sql()
+  cursor = connection.cursor()
+  cursor.execute("EXPLAIN " + sql, params)
+  if connection.vendor == 'postgresql':
+    found = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+    return found and int(found.group(1)) or None
+  # MySQL: one row per table, with the number of rows it expects to read from it
+  column = [ d[0].lower() for d in cursor.description ].index('rows')
+  estimate = None
+  for row in cursor.fetchall():
+    if row[column] is not None:
+      estimate = (estimate or 1) * int(row[column])
+  return estimate
+
+def estimated_count(qs):
+  """Count the rows of 'qs' up to ADMIN_EXACT_COUNT_LIMIT (LIMIT subquery); past that, return
+  the database's estimate if it has one, or ADMIN_EXACT_COUNT_LIMIT + 1 (never a full COUNT)"""
+  qs = qs.order_by()
+  # Django counts sliced querysets with a full COUNT (and clamps the result): count the ids of
+  # a LIMIT subquery instead
+  sql, params = qs.values('pk')[:ADMIN_EXACT_COUNT_LIMIT + 1].query.get_compiler(using=qs.db).as_sql()
+  cursor = connections[qs.db].cursor()
+  cursor.execute("SELECT COUNT(*) FROM (%s) limited" % (sql,), params)
+  count = cursor.fetchone()[0]
+  if count > ADMIN_EXACT_COUNT_LIMIT:
+    count = max(estimate_count(qs) or 0, count)
+  return count
+
+class EstimatedCountPaginator(Paginator):
+  """Paginator that counts with estimated_count()"""
+  def _get_count(self):
+    if self._count is None:
+      self._count = estimated_count(self.object_list)
+    return self._count
+  count = property(_get_count)
+
+class EstimatedCountQuerySet(QuerySet):
+  """QuerySet whose count() is estimated_count()"""
+  def count(self):
+    return estimated_count(self)
+
+class EstimatedCountChangeList(ChangeList):
+  """ChangeList whose unfiltered total ("N total") is counted like its pages, with
+  estimated_count()"""
+  def get_results(self, request):
+    root_query_set = self.root_query_set
+    self.root_query_set = root_query_set._clone(klass=EstimatedCountQuerySet)
+    try:
+      super(EstimatedCountChangeList, self).get_results(request)
+    finally:
+      self.root_query_set = root_query_set
+
+class BaseCommentAdmin(admin.ModelAdmin):
+  """
+  Admin for comment models: comments of all sites, related columns fetched with the comments
+  (select_related), estimated counts on large tables, filters on indexed columns and bulk
+  moderation actions (set-based, see BaseComment.bulk_update_status).
+  """
   list_display = [ "id", "status", "submit_date", "title", "user", "content_type" ]
+  list_filter = [ "status", "site", "content_type" ]
+  list_select_related = True
+  related_fields = [ "user", "site", "content_type" ]
+  paginator = EstimatedCountPaginator
+  actions = [ 'mark_deleted', 'mark_active' ]
+
+  def queryset(self, request):
+    qs = self.model._base_manager.select_related(*self.related_fields)
+    ordering = self.get_ordering(request)
+    if ordering:
+      qs = qs.order_by(*ordering)
+    return qs
 
-class QACommentAdmin(admin.ModelAdmin):
+  def get_changelist(self, request, **kwargs):
+    return EstimatedCountChangeList
+
+  def mark_deleted(self, request, queryset):
+    n = self.model.bulk_update_status(queryset, self.model.STATUS_DELETED)
+    self.message_user(request, "%d comment(s) marked as deleted." % (n,))
+  mark_deleted.short_description = "Mark selected comments as deleted"
+
+  def mark_active(self, request, queryset):
+    n = self.model.bulk_update_status(queryset, self.model.STATUS_ACTIVE)
+    self.message_user(request, "%d comment(s) restored." % (n,))
+  mark_active.short_description = "Restore selected comments"
+
+class CommentAdmin(BaseCommentAdmin):
+  pass
+
+class QACommentAdmin(BaseCommentAdmin):
   list_display = [ "id", "status", "submit_date", "title", "user", "content_type", "comment_type", "question" ]
+  list_filter = BaseCommentAdmin.list_filter + [ "comment_type" ]
+  related_fields = BaseCommentAdmin.related_fields + [ "question" ]
 
-class RatingCommentAdmin(admin.ModelAdmin):
-  list_display = [ "id", "status", "submit_date", "title", "user", "content_type" ]
+class RatingCommentAdmin(BaseCommentAdmin):
+  pass
 
-class StackedCommentAdmin(admin.ModelAdmin):
-  list_display = [ "id", "status", "submit_date", "title", "user", "content_type" ]
+class StackedCommentAdmin(BaseCommentAdmin):
+  related_fields = BaseCommentAdmin.related_fields + [ "stack" ]
 
-class StackedRatingCommentAdmin(admin.ModelAdmin):
-  list_display = [ "id", "status", "submit_date", "title", "user", "content_type" ]
+class StackedRatingCommentAdmin(BaseCommentAdmin):
+  related_fields = BaseCommentAdmin.related_fields + [ "stack" ]
+
+class ThreadedCommentAdmin(BaseCommentAdmin):
+  list_display = [ "id", "status", "submit_date", "title", "user", "content_type", "parent", "depth" ]
+  related_fields = BaseCommentAdmin.related_fields + [ "parent" ]
 
 admin.site.register(models.Comment, CommentAdmin)
 admin.site.register(models.QAComment, QACommentAdmin)
 admin.site.register(models.StackedComment, StackedCommentAdmin)
+admin.site.register(models.ThreadedComment, ThreadedCommentAdmin)
 if hasattr(models, 'RatingComment'): admin.site.register(models.RatingComment, RatingCommentAdmin)
 if hasattr(models, 'RatingComment'): admin.site.register(models.StackedRatingComment, StackedRatingCommentAdmin)
-
@@ -0,0 +1,192 @@
+"""
+Rating analytics over many objects.
+
+Ratings (score, object and date of rating comments) are read with values_list() in id-ordered
+chunks, never as model instances, then grouped per content object or per time period (day,
+week, month).  Each group gets count, mean, standard deviation, min, max, percentiles and a
+histogram of RATING_BUCKETS buckets over 0-RATING_RANGE.
+
+Statistics are computed with NumPy (bincount/lexsort over whole columns) when it is
+installed and settings.SWCOMMENTS_ANALYTICS_NUMPY is not False; otherwise a pure-Python
+implementation gives the same results.  See the swcomments_rating_stats management command.
+"""
+
+import datetime
+import math
+
+from django.conf import settings
+
+from swcomments import models, ratings
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+CHUNK_SIZE = getattr(settings, 'SWCOMMENTS_ANALYTICS_CHUNK_SIZE', 10000)
+PERCENTILES = (25, 50, 75)
+PERIODS = ('day', 'week', 'month')
+
+def numpy_enabled():
+  """Returns True if statistics are computed with NumPy"""
+  return numpy is not None and getattr(settings, 'SWCOMMENTS_ANALYTICS_NUMPY', True)
+
+def iter_chunks(qs, columns, chunk_size=None):
+  """Yield lists of ('id',) + columns tuples of queryset 'qs', walking it by id in chunks"""
+  chunk_size = chunk_size or CHUNK_SIZE
+  last_id = 0
+  while True:
+    rows = list(qs.filter(id__gt=last_id).order_by('id').values_list('id', *columns)[:chunk_size])
+    if not rows:
+      break
+    yield rows
+    last_id = rows[-1][0]
+
+def day_ordinal(d):
+  """Return the date ordinal (day) of datetime 'd', in local time"""
+  if d.tzinfo is not None:
+    from django.utils import timezone
+    d = timezone.localtime(d)
+  return d.toordinal()
+
+def load_ratings(model_class, qs=None, chunk_size=None):
+  """
+  Return (object keys, scores, day ordinals) columns for the ratings of queryset 'qs' (default:
+  the ratings that count for 'model_class', see swcomments.ratings).  Object keys are
+  "content_type_id:object_pk" strings.  Columns are NumPy arrays if numpy_enabled(), lists
+  otherwise.
+  """
+  if qs is None:
+    qs = ratings.rating_scores(model_class)
+  keys, scores, days = [], [], []
+  for rows in iter_chunks(qs, ('content_type', 'object_pk', 'score', 'submit_date'), chunk_size):
+    keys.extend([ u'%s:%s' % (r[1], r[2]) for r in rows ])
+    scores.extend([ r[3] for r in rows ])
+    days.extend([ day_ordinal(r[4]) for r in rows ])
+  if numpy_enabled():
+    return numpy.array(keys, dtype=unicode), numpy.array(scores, dtype=numpy.int64), numpy.array(days, dtype=numpy.int64)
+  return keys, scores, days
+
+# Periods: each day ordinal is mapped to an integer key, then keys are labelled
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def period_keys(days, period):
+  """Return the period key of each day ordinal of 'days' (vectorized if it is an array)"""
+  if period not in PERIODS:
+    raise ValueError("Unknown period: %s (must be one of %s)" % (period, ", ".join(PERIODS)))
+  if period == 'day':
+    return days
+  if period == 'week':
+    # Ordinal 1 (0001-01-01) is a Monday: key is the ordinal of the week's Monday
+    return days - (days - 1) % 7 if numpy_enabled() else [ d - (d - 1) % 7 for d in days ]
+  if numpy_enabled():
+    months = (days - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]').astype(numpy.int64)
+    return months + 1970 * 12
+  months = []
+  for d in days:
+    d = datetime.date.fromordinal(d)
+    months.append(d.year * 12 + d.month - 1)
+  return months
+
+def period_label(key, period):
+  if period == 'month':
+    year, month = divmod(int(key), 12)
+    return '%04d-%02d' % (year, month + 1)
+  return datetime.date.fromordinal(int(key)).isoformat()
+
+# Grouped statistics
+
+def _stats_numpy(keys, scores, percentiles):
+  labels, groups = numpy.unique(keys, return_inverse=True)
+  n = len(labels)
+  scores = scores.astype(numpy.float64)
+  counts = numpy.bincount(groups, minlength=n)
+  sums = numpy.bincount(groups, weights=scores, minlength=n)
+  squares = numpy.bincount(groups, weights=scores * scores, minlength=n)
+  means = sums / counts
+  stddevs = numpy.sqrt(numpy.maximum(squares / counts - means * means, 0))
+
+  # Scores sorted within each group: min, max and percentiles are positions in each group
+  ordered = scores[numpy.lexsort((scores, groups))]
+  starts = numpy.concatenate(([ 0 ], numpy.cumsum(counts)[:-1]))
+  stats = dict(count=counts, mean=means, stddev=stddevs, min=ordered[starts], max=ordered[starts + counts - 1])
+  for p in percentiles:
+    pos = starts + (counts - 1) * (p / 100.0)
+    low = numpy.floor(pos).astype(numpy.int64)
+    high = numpy.ceil(pos).astype(numpy.int64)
+    stats['p%s' % (p,)] = ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+  buckets = scores.astype(numpy.int64) * models.RATING_BUCKETS // (models.RATING_RANGE + 1)
+  histograms = numpy.bincount(groups * models.RATING_BUCKETS + buckets, minlength=n * models.RATING_BUCKETS)
+  histograms = histograms.reshape(n, models.RATING_BUCKETS)
+
+  results = []
+  for i, label in enumerate(labels):
+    d = dict([ (k, float(v[i])) for k, v in stats.items() ])
+    d['count'] = int(counts[i])
+    d['histogram'] = [ int(h) for h in histograms[i] ]
+    results.append((label.item() if hasattr(label, 'item') else label, d))
+  return results
+
+def _percentile(ordered, p):
+  # Linear interpolation between closest ranks (same as the NumPy version)
+  pos = (len(ordered) - 1) * (p / 100.0)
+  low, high = int(math.floor(pos)), int(math.ceil(pos))
+  return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+def _stats_python(keys, scores, percentiles):
+  by_key = {}
+  for k, s in zip(keys, scores):
+    by_key.setdefault(k, []).append(s)
+  results = []
+  for label in sorted(by_key.keys()):
+    ordered = sorted([ float(s) for s in by_key[label] ])
+    count = len(ordered)
+    mean = sum(ordered) / count
+    d = dict(
+      count=count,
+      mean=mean,
+      stddev=math.sqrt(max(sum([ s * s for s in ordered ]) / count - mean * mean, 0)),
+      min=ordered[0],
+      max=ordered[-1],
+    )
+    for p in percentiles:
+      d['p%s' % (p,)] = _percentile(ordered, p)
+    h = [ 0 ] * models.RATING_BUCKETS
+    for s in ordered:
+      h[models.rating_bucket(int(s))] += 1
+    d['histogram'] = h
+    results.append((label, d))
+  return results
+
+def grouped_stats(keys, scores, percentiles=PERCENTILES):
+  """Return a list of (key, stats) for each distinct key of 'keys' (sorted), where stats is a
+  dict of count, mean, stddev, min, max, pNN (for each of 'percentiles') and histogram"""
+  if not len(keys):
+    return []
+  if numpy_enabled():
+    return _stats_numpy(numpy.asarray(keys), numpy.asarray(scores), percentiles)
+  return _stats_python(keys, scores, percentiles)
+
+def stats_by_object(model_class, qs=None, percentiles=PERCENTILES, chunk_size=None):
+  """Return the rating statistics of each object rated with 'model_class' comments: a list of
+  dicts with content_type (id) and object_pk, plus the stats of grouped_stats()"""
+  keys, scores, days = load_ratings(model_class, qs, chunk_size)
+  results = []
+  for key, d in grouped_stats(keys, scores, percentiles):
+    ct_id, object_pk = key.split(":", 1)
+    d.update(content_type=int(ct_id), object_pk=object_pk)
+    results.append(d)
+  return results
+
+def stats_by_period(model_class, period='day', qs=None, percentiles=PERCENTILES, chunk_size=None):
+  """Return the rating statistics of 'model_class' comments per 'period' (day, week or month,
+  by submit_date): a list of dicts with period (start date, or YYYY-MM for months), plus the
+  stats of grouped_stats()"""
+  keys, scores, days = load_ratings(model_class, qs, chunk_size)
+  results = []
+  for key, d in grouped_stats(period_keys(days, period), scores, percentiles):
+    d.update(period=period_label(key, period))
+    results.append(d)
+  return results
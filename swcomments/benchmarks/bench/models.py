@@ -0,0 +1,8 @@
+from django.db import models
+
+class Article(models.Model):
+  """The objects comments are posted on"""
+  title = models.CharField(max_length=255)
+
+  def __unicode__(self):
+    return self.title
@@ -0,0 +1,156 @@
+"""
+What the benchmarks measure.
+
+get_cases() returns the list of Case for a dataset: for each comment model, post_comment
+(valid and invalid posts, with and without lean errors), model inserts, do_thread, do_count and each template tag, on the
+hottest object ("hot"), a median one ("cold") or the first page of objects ("page").
+measure() runs a case and returns its timings and query counts.
+"""
+
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, reset_queries
+from django.template import Template, Context
+from django.test.client import RequestFactory
+from django.utils import simplejson
+
+from swcomments import models, views, ratings, search
+from swcomments.management import comment_models
+
+PAGE_SIZE = 20
+SEARCH_QUERY = "lorem ipsum"
+
+class Case(object):
+  def __init__(self, name, model, target, fn, post=False):
+    self.name = name
+    self.model = model
+    self.target = target
+    self.fn = fn
+    self.post = post
+
+  @property
+  def key(self):
+    return "%s %s %s" % (self.name, self.model, self.target)
+
+def summary(values):
+  """Return min, median, mean, p95 and max of 'values'"""
+  values = sorted(values)
+  n = len(values)
+  return dict(
+    min = values[0],
+    median = values[n // 2],
+    mean = sum(values) / float(n),
+    p95 = values[min(int(n * 0.95), n - 1)],
+    max = values[-1],
+  )
+
+def measure(case, iterations, warmup=1):
+  """Run 'case' 'warmup' times, then 'iterations' times measuring wall time, number of queries
+  and their total time (times in milliseconds)"""
+  for i in range(warmup):
+    case.fn()
+  times, counts, query_times = [], [], []
+  for i in range(iterations):
+    reset_queries()
+    start = time.time()
+    case.fn()
+    times.append((time.time() - start) * 1000)
+    counts.append(len(connection.queries))
+    query_times.append(sum([ float(q['time']) for q in connection.queries ]) * 1000)
+  return dict(
+    iterations = iterations,
+    time_ms = summary(times),
+    queries = summary(counts),
+    query_time_ms = summary(query_times),
+  )
+
+def extra_fields(model):
+  """Model-specific fields of a new (top-level) comment"""
+  d = {}
+  if issubclass(model, models.BaseQAComment):
+    d['comment_type'] = model.COMMENTTYPE_QUESTION
+  if ratings.is_rating_model(model):
+    d['score'] = models.RATING_RANGE // 2
+  return d
+
+def tag_case(name, model, target, source, o):
+  t = Template("{% load swctags %}" + source)
+  def fn():
+    t.render(Context({ 'o': o, 'q': SEARCH_QUERY }))
+  return Case(name, str(model._meta), target, fn)
+
+def post_data(model, o, valid=True, extra=None):
+  """POST data of the form of 'model' for object 'o' (plus 'extra' fields)"""
+  FormClass = model.get_form_class()
+  form = FormClass(o, template_name='form.html')
+  data = dict([ (name, form.initial.get(name, field.initial)) for name, field in form.fields.items() ])
+  data = dict([ (k, v) for k, v in data.items() if v is not None ])
+  data.update(extra_fields(model))
+  data.update(title="Benchmark", name="Bench", email="bench@example.com")
+  if valid:
+    data['comment'] = "A benchmark comment"
+  data.update(extra or {})
+  return data
+
+def post_case(name, model, target, o, user, valid, extra=None):
+  factory = RequestFactory()
+  def fn():
+    request = factory.post('/comments/post-comment/', post_data(model, o, valid, extra))
+    request.user = user
+    rc = simplejson.loads(views.post_comment(request).content)['rc']
+    if rc != (valid and 'success' or 'failure'):
+      raise AssertionError("post_comment returned rc=%s" % (rc,))
+  return Case(name, str(model._meta), target, fn, post=True)
+
+def get_cases(dataset, model_classes=None):
+  """Return the list of Case for 'dataset' (for all comment models, or 'model_classes')"""
+  hot = dataset.objects[0]
+  cold = dataset.objects[len(dataset.objects) // 2]
+  page = dataset.objects[:PAGE_SIZE]
+  user = dataset.users[0]
+  ct = ContentType.objects.get_for_model(hot)
+  cases = []
+  for model in model_classes or comment_models():
+    label = str(model._meta)
+
+    cases.append(post_case('post_comment', model, 'hot', hot, user, True))
+    cases.append(post_case('post_comment_invalid', model, 'hot', hot, user, False))
+    cases.append(post_case('post_comment_invalid_lean', model, 'hot', hot, user, False, { 'errors_only': '1' }))
+    cases.append(post_case('post_comment_bad_hash_lean', model, 'hot', hot, user, False, { 'errors_only': '1', 'security_hash': '0' * 40 }))
+
+    def insert(model=model):
+      model(user=user, content_object=hot, comment="A benchmark comment", **extra_fields(model)).save()
+    cases.append(Case('insert', label, 'hot', insert))
+
+    for target, o in (('hot', hot), ('cold', cold)):
+      def do_thread(model=model, o=o):
+        list(model.do_thread(model.objects.filter(models.object_filter(o.pk), content_type=ct)))
+      def do_count(model=model, o=o):
+        model.do_count(model.objects.filter(models.object_filter(o.pk), content_type=ct)).count()
+      cases.append(Case('do_thread', label, target, do_thread))
+      cases.append(Case('do_count', label, target, do_count))
+
+      cases.append(tag_case('swcomments_get_list', model, target,
+        "{% swcomments_get_list for o of " + label + " as l limit 20 %}{% for c in l %}{{ c.id }}{% endfor %}", o))
+      cases.append(tag_case('swcomments_get_count', model, target,
+        "{% swcomments_get_count for o of " + label + " as n %}{{ n }}", o))
+      cases.append(tag_case('swcomments_render_form', model, target,
+        "{% swcomments_render_form for o of " + label + " %}", o))
+      if ratings.is_rating_model(model):
+        cases.append(tag_case('swcomments_get_rating', model, target,
+          "{% swcomments_get_rating for o of " + label + " as r %}{{ r.average }}", o))
+
+    cases.append(tag_case('swcomments_get_counts', model, 'page',
+      "{% swcomments_get_counts for o of " + label + " as d %}{% for k, v in d.items %}{{ v }}{% endfor %}", page))
+    cases.append(tag_case('swcomments_get_lists', model, 'page',
+      "{% swcomments_get_lists for o of " + label + " as d %}{% for k, l in d.items %}{% for c in l %}{{ c.id }}{% endfor %}{% endfor %}", page))
+    cases.append(tag_case('swcomments_render_forms', model, 'page',
+      "{% swcomments_render_forms for o of " + label + " %}", page))
+    if ratings.is_rating_model(model):
+      cases.append(tag_case('swcomments_get_ratings', model, 'page',
+        "{% swcomments_get_ratings for o of " + label + " as d %}{% for k, r in d.items %}{{ r.average }}{% endfor %}", page))
+    if search.search_enabled():
+      cases.append(tag_case('swcomments_search', model, 'page',
+        "{% swcomments_search query q of " + label + " as r %}{% for c in r %}{{ c.id }}{% endfor %}", None))
+  return cases
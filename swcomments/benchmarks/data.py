@@ -0,0 +1,135 @@
+"""
+Synthetic datasets for the benchmarks.
+
+generate() creates 'objects' articles, 'users' users and, for each comment model, 'comments'
+comments spread over the last 'days' days.  Objects and users are picked with a Zipf-like
+distribution (weight 1 / rank ** skew): objects[0] is the hottest object, the last ones
+get few or no comments.  Comments are inserted in bulk (like swcomments_import) with their
+derived data computed in Python (question, thread paths) or by the rebuild commands (stacks,
+answer counts, rating aggregates, counters, search index).
+"""
+
+import bisect
+import datetime
+import random
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+
+from swcomments import models, ratings
+from swcomments.management import comment_models
+from swcomments.management.commands.swcomments_import import bulk_create, reset_sequences, rebuild_derived
+
+from bench.models import Article
+
+BATCH_SIZE = 500
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt "
+         "ut labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation").split()
+
+class Picker(object):
+  """Pick items of a list with a Zipf-like distribution (first items are the most likely)"""
+  def __init__(self, items, skew, rng):
+    self.items = items
+    self.rng = rng
+    total = 0.0
+    self.cumulative = []
+    for rank in range(len(items)):
+      total += 1.0 / (rank + 1) ** skew
+      self.cumulative.append(total)
+
+  def pick(self):
+    return self.items[bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+def text(rng, n):
+  return " ".join([ rng.choice(WORDS) for i in range(n) ])
+
+class Dataset(object):
+  """What generate() created: objects (hottest first), users and comment counts per model"""
+  def __init__(self, objects, users, counts, params):
+    self.objects = objects
+    self.users = users
+    self.counts = counts
+    self.params = params
+
+  def as_dict(self):
+    d = dict(self.params)
+    d['comments_by_model'] = dict([ (str(m._meta), n) for m, n in self.counts.items() ])
+    return d
+
+def comment_fields(model, rng, c, previous):
+  """Set the model-specific fields of comment 'c', given the earlier comments of its object
+  ('previous', a list of comments of the same model)"""
+  if issubclass(model, models.BaseAnonComment):
+    c.user_name = "User %s" % (c.user_id,)
+    c.user_email = "user%s@example.com" % (c.user_id,)
+  if issubclass(model, models.BaseQAComment):
+    questions = [ p for p in previous if p.comment_type == model.COMMENTTYPE_QUESTION ]
+    if questions and rng.random() < 0.7:
+      c.comment_type = model.COMMENTTYPE_ANSWER
+      c.question_id = rng.choice(questions).id
+    else:
+      c.comment_type = model.COMMENTTYPE_QUESTION
+  if issubclass(model, models.BaseThreadedComment):
+    parents = [ p for p in previous if p.depth < models.THREAD_MAX_DEPTH ]
+    parent = parents and rng.random() < 0.6 and rng.choice(parents) or None
+    c.parent_id = parent and parent.id or None
+    c.depth = parent and parent.depth + 1 or 0
+    c.path = (parent and parent.path or '') + models.path_step(c.id)
+  if ratings.is_rating_model(model):
+    c.score = rng.randint(0, models.RATING_RANGE)
+
+def generate(objects=100, comments=1000, users=50, skew=1.0, days=90, seed=1, model_classes=None, verbosity=1):
+  """Create a dataset (see module docstring) and return it as a Dataset"""
+  rng = random.Random(seed)
+  params = dict(objects=objects, comments=comments, users=users, skew=skew, days=days, seed=seed)
+  model_classes = model_classes or comment_models()
+
+  User.objects.bulk_create([ User(username='bench%d' % (i,)) for i in range(users) ])
+  Article.objects.bulk_create([ Article(title=text(rng, 4)) for i in range(objects) ])
+  user_list = list(User.objects.order_by('id'))
+  object_list = list(Article.objects.order_by('id'))
+  site = Site.objects.get_current()
+  ct = ContentType.objects.get_for_model(Article)
+
+  object_picker = Picker(object_list, skew, rng)
+  user_picker = Picker(user_list, skew, rng)
+  now = datetime.datetime.now().replace(microsecond=0)
+  start = now - datetime.timedelta(days=days)
+  step = datetime.timedelta(days=days) / max(comments, 1)
+
+  counts = {}
+  for model in model_classes:
+    next_id = (model._base_manager.order_by('-id').values_list('id', flat=True)[:1] or [ 0 ])[0] + 1
+    by_object = {}
+    batch = []
+    for i in range(comments):
+      o = object_picker.pick()
+      c = model(
+        id = next_id + i,
+        status = rng.random() < 0.05 and model.STATUS_DELETED or model.STATUS_ACTIVE,
+        user_id = user_picker.pick().id,
+        submit_date = start + step * i,
+        title = text(rng, 3),
+        comment = text(rng, rng.randint(5, 60)),
+        site_id = site.id,
+        content_type_id = ct.id,
+        object_pk = unicode(o.pk),
+        object_id = o.pk,
+      )
+      previous = by_object.setdefault(o.pk, [])
+      comment_fields(model, rng, c, previous)
+      previous.append(c)
+      batch.append(c)
+      if len(batch) >= BATCH_SIZE:
+        bulk_create(model, batch)
+        batch = []
+    if batch:
+      bulk_create(model, batch)
+    counts[model] = comments
+    if verbosity >= 1:
+      print "%s: %d comment(s) created" % (model._meta, comments)
+
+  reset_sequences(model_classes)
+  rebuild_derived(model_classes, verbosity=max(verbosity - 1, 0))
+  return Dataset(object_list, user_list, counts, params)
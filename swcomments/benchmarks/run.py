@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+swcomments benchmarks.
+
+  python swcomments/benchmarks/run.py [options]
+
+Creates a synthetic dataset (see data.py) in a SQLite database (in memory, or a new file with
+--database), runs the benchmark cases (see cases.py) and prints, for each case, its median
+and 95th percentile times and its number of queries.  --output writes the results as JSON;
+--compare reads results written by an earlier run (eg. of another version) and shows the
+change of each case.  Settings (counters, cache, search...) are in settings.py next to this
+file.
+"""
+
+import datetime
+import os
+import platform
+import sys
+from optparse import OptionParser, make_option
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+OPTIONS = (
+  make_option('--objects', type='int', default=100, help='Number of objects comments are posted on (default 100).'),
+  make_option('--comments', type='int', default=1000, help='Number of comments per comment model (default 1000).'),
+  make_option('--users', type='int', default=50, help='Number of users (default 50).'),
+  make_option('--skew', type='float', default=1.0,
+              help='Skew of comments toward hot objects and active users (Zipf exponent, 0 for uniform, default 1).'),
+  make_option('--days', type='int', default=90, help='Comments are spread over this many days (default 90).'),
+  make_option('--seed', type='int', default=1, help='Random seed of the dataset (default 1).'),
+  make_option('--iterations', type='int', default=20, help='Number of measured runs per case (default 20).'),
+  make_option('--post-iterations', type='int', dest='post_iterations', default=5,
+              help='Number of measured runs of post_comment cases (default 5).'),
+  make_option('--model', action='append', dest='models', default=[],
+              help='Only benchmark this comment model ("app_label.model"); can be repeated.'),
+  make_option('--case', action='append', dest='cases', default=[],
+              help='Only run cases whose name contains this string; can be repeated.'),
+  make_option('--database', help='SQLite database file to create (default: in memory).'),
+  make_option('--label', default='', help='Label stored with the results (eg. a version).'),
+  make_option('--output', help='Write the results as JSON to this file ("-" for stdout).'),
+  make_option('--compare', help='Compare with the JSON results of an earlier run.'),
+)
+
+def setup(database=None):
+  """Configure Django with the benchmark settings and create the tables"""
+  if database:
+    if os.path.exists(database):
+      raise SystemExit("%s already exists: the benchmarks need a new database" % (database,))
+    os.environ['SWCOMMENTS_BENCH_DATABASE'] = os.path.abspath(database)
+  sys.path[:0] = [ DIR, os.path.dirname(os.path.dirname(DIR)) ]
+  os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+  from django.core.management import call_command
+  call_command('syncdb', interactive=False, verbosity=0)
+
+def format_row(name, model, target, time, queries, change=''):
+  return "%-28s %-32s %-5s %22s %9s %s" % (name, model, target, time, queries, change)
+
+def compare(result, previous):
+  """Return the change of 'result' relative to 'previous' (median time, queries)"""
+  if previous is None or 'error' in previous:
+    return ''
+  if 'error' in result:
+    return 'was %.2fms' % (previous['time_ms']['median'],)
+  old, new = previous['time_ms']['median'], result['time_ms']['median']
+  change = old and '%+.0f%%' % ((new - old) * 100 / old,) or ''
+  queries = result['queries']['median'] - previous['queries']['median']
+  if queries:
+    change += ' %+d queries' % (queries,)
+  return change
+
+def main(argv=None):
+  parser = OptionParser(usage='%prog [options]', option_list=OPTIONS, description=__doc__.strip().split("\n\n")[0])
+  options, args = parser.parse_args(argv)
+  setup(options.database)
+
+  import django
+  from django.conf import settings
+  from django.db import connection
+  from django.db.models import get_model
+  from django.utils import simplejson
+  from swcomments import counters, cache, search
+  import cases, data
+
+  model_classes = None
+  if options.models:
+    model_classes = [ get_model(*label.lower().split(".", 1)) for label in options.models ]
+    if None in model_classes:
+      parser.error("Unknown comment model in %s" % (", ".join(options.models),))
+
+  previous = {}
+  if options.compare:
+    for r in simplejson.load(open(options.compare))['results']:
+      previous["%s %s %s" % (r['name'], r['model'], r['target'])] = r
+
+  dataset = data.generate(options.objects, options.comments, options.users, options.skew, options.days,
+                          options.seed, model_classes, verbosity=0)
+  out = options.output == '-' and sys.stderr or sys.stdout
+  out.write(format_row('case', 'model', 'on', 'median/p95 (ms)', 'queries', options.compare and 'change' or '') + "\n")
+  results = []
+  for case in cases.get_cases(dataset, model_classes):
+    if options.cases and not [ s for s in options.cases if s in case.name ]:
+      continue
+    result = dict(name=case.name, model=case.model, target=case.target)
+    try:
+      result.update(cases.measure(case, case.post and options.post_iterations or options.iterations))
+    except Exception, e:
+      result['error'] = "%s: %s" % (e.__class__.__name__, e)
+    results.append(result)
+    if 'error' in result:
+      time, queries = 'error', ''
+    else:
+      time = '%.2f/%.2f' % (result['time_ms']['median'], result['time_ms']['p95'])
+      queries = '%d' % (result['queries']['median'],)
+    out.write(format_row(case.name, case.model, case.target, time, queries, compare(result, previous.get(case.key))) + "\n")
+    if 'error' in result:
+      out.write("  %s\n" % (result['error'],))
+
+  if options.output:
+    doc = dict(
+      label = options.label,
+      date = datetime.datetime.now().isoformat(),
+      python = platform.python_version(),
+      django = django.get_version(),
+      database = dict(vendor=connection.vendor, name=settings.DATABASES['default']['NAME']),
+      settings = dict(counters=counters.counters_enabled(), cache=cache.cache_enabled(), search=search.search_enabled()),
+      dataset = dataset.as_dict(),
+      results = results,
+    )
+    f = options.output == '-' and sys.stdout or open(options.output, 'w')
+    simplejson.dump(doc, f, indent=2, sort_keys=True)
+    f.write("\n")
+    if f is not sys.stdout:
+      f.close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,52 @@
+# Settings of the swcomments benchmark project (see run.py).  swcomments.models imports the
+# project settings as the 'settings' module, so this directory must be first on sys.path.
+
+import os
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+# DEBUG makes Django record every query (count and time), the form template cache is forced
+# on below so that it doesn't change what is measured
+DEBUG = True
+TEMPLATE_DEBUG = False
+SECRET_KEY = 'swcomments-benchmarks'
+SITE_ID = 1
+TIME_ZONE = 'UTC'
+USE_TZ = False
+
+# In-memory database unless run.py was given a file (--database)
+DATABASES = {
+  'default': {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.environ.get('SWCOMMENTS_BENCH_DATABASE') or ':memory:',
+  }
+}
+
+INSTALLED_APPS = [
+  'django.contrib.contenttypes',
+  'django.contrib.auth',
+  'django.contrib.sites',
+  'swcomments',
+  'bench',
+]
+try:
+  import djangoratings
+  INSTALLED_APPS.insert(3, 'djangoratings')
+except ImportError:
+  pass
+
+ROOT_URLCONF = 'urls'
+TEMPLATE_DIRS = [ os.path.join(DIR, 'templates') ]
+TEMPLATE_CONTEXT_PROCESSORS = [
+  'django.contrib.auth.context_processors.auth',
+  'django.core.context_processors.request',
+]
+
+CACHES = {
+  'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+  }
+}
+
+SWCOMMENTS_COMMENTABLE_MODELS = [ 'bench.article' ]
+SWCOMMENTS_TEMPLATE_CACHE = True
@@ -0,0 +1,123 @@
+"""
+Versioned cache for comment lists and counts.
+
+When settings.SWCOMMENTS_CACHE is True, the swcomments_get_list, swcomments_get_lists and
+swcomments_get_count tags cache their results (in the cache named by
+settings.SWCOMMENTS_CACHE_ALIAS, default 'default').  Each (comment model, site, content type,
+object_pk) has a version number in the cache that is part of the result keys; it is bumped
+whenever a comment for that object is saved (comment_changed signal, which includes status
+changes), deleted or changed in bulk (comments_bulk_changed), so stale results are simply never read again.
+
+Only one process computes a missing result at a time (single-flight): the others wait for
+it to show up in the cache for up to LOCK_TIMEOUT seconds before computing it themselves.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import signals as dbsignals
+from django.utils.hashcompat import md5_constructor
+
+from swcomments import models, signals
+
+TIMEOUT = getattr(settings, 'SWCOMMENTS_CACHE_TIMEOUT', 5*60)
+VERSION_TIMEOUT = 30*24*60*60
+LOCK_TIMEOUT = 5
+LOCK_WAIT = .05
+
+def cache_enabled():
+  """Returns True if comment lists/counts should be cached"""
+  return getattr(settings, 'SWCOMMENTS_CACHE', False)
+
+def get_comment_cache():
+  return get_cache(getattr(settings, 'SWCOMMENTS_CACHE_ALIAS', 'default'))
+
+def new_version():
+  # Versions start at the current time (ms) so that a version key that was evicted from the
+  # cache never comes back with a number that was already used
+  return int(time.time() * 1000)
+
+def version_key(model_class, site_id, content_type_id, object_pk):
+  """Return the cache key holding the version of the comments of one object (on one site)"""
+  return 'swcomments:v:%s:%s:%s:%s' % (model_class.get_nonproxy_model()._meta, site_id, content_type_id, object_pk)
+
+def get_versions(model_class, content_type_id, object_pks):
+  """Return the list of versions for the comments of 'model_class' (on the current site) for
+  each object of object_pks"""
+  c = get_comment_cache()
+  keys = [ version_key(model_class, settings.SITE_ID, content_type_id, pk) for pk in object_pks ]
+  versions = c.get_many(keys)
+  for k in keys:
+    if k not in versions:
+      v = new_version()
+      if not c.add(k, v, VERSION_TIMEOUT):
+        v = c.get(k, v)
+      versions[k] = v
+  return [ versions[k] for k in keys ]
+
+def bump_version(comment):
+  """Invalidate all cached lists/counts for the object 'comment' is attached to"""
+  c = get_comment_cache()
+  key = version_key(type(comment), comment.site_id, comment.content_type_id, comment.object_pk)
+  try:
+    c.incr(key)
+  except ValueError:
+    c.set(key, new_version(), VERSION_TIMEOUT)
+
+def result_key(model_class, content_type_id, object_pks, parts):
+  """Return the cache key for a result of 'model_class' comments (on the current site) for
+  objects 'object_pks'.  'parts' is a tuple of anything else the result depends on (filter,
+  order, etc.)."""
+  object_pks = [ unicode(pk) for pk in object_pks ]
+  versions = get_versions(model_class, content_type_id, object_pks)
+  data = repr((str(model_class._meta), settings.SITE_ID, content_type_id, object_pks, versions, parts))
+  return 'swcomments:r:%s' % (md5_constructor(data).hexdigest(),)
+
+def get_or_compute(key, compute):
+  """Return the cached value for 'key'; if missing, compute() it (once across processes) and
+  cache it."""
+  c = get_comment_cache()
+  found = c.get(key)
+  if found is not None:
+    return found[0]
+
+  lock = key + ':lock'
+  if c.add(lock, 1, LOCK_TIMEOUT):
+    try:
+      value = compute()
+      c.set(key, (value,), TIMEOUT)
+    finally:
+      c.delete(lock)
+    return value
+
+  # Someone else is computing it, wait for it
+  waited = 0
+  while waited < LOCK_TIMEOUT:
+    time.sleep(LOCK_WAIT)
+    waited += LOCK_WAIT
+    found = c.get(key)
+    if found is not None:
+      return found[0]
+  return compute()
+
+def cached(model_class, content_type_id, object_pks, parts, compute):
+  """Return compute() through the cache (see result_key() for the arguments)"""
+  return get_or_compute(result_key(model_class, content_type_id, object_pks, parts), compute)
+
+def _comment_changed(sender, comment, **kwargs):
+  if cache_enabled():
+    bump_version(comment)
+
+def _comment_deleted(sender, instance, **kwargs):
+  if cache_enabled() and isinstance(instance, models.BaseComment):
+    bump_version(instance)
+
+def _comments_bulk_changed(sender, objects, **kwargs):
+  if cache_enabled():
+    for site_id, ct_id, object_pk in objects:
+      bump_version(sender(site_id=site_id, content_type_id=ct_id, object_pk=object_pk))
+
+signals.comment_changed.connect(_comment_changed)
+signals.comments_bulk_changed.connect(_comments_bulk_changed)
+dbsignals.post_delete.connect(_comment_deleted)
@@ -0,0 +1,212 @@
+"""
+Denormalized comment counters.
+
+When settings.SWCOMMENTS_USE_COUNTERS is True, swcomments_get_count reads the number of
+comments from the CommentCount table instead of running a COUNT query.  Counter rows are
+created the first time they are read.  When a comment is saved (including status changes) or
+deleted, the counters of its object are adjusted in the same transaction by the change it
+made: only the comments of its count_scope() are counted, before and after, and the
+difference is added to the counter rows (count = count + delta).  Comments changed in bulk
+are recounted, and the swcomments_rebuild_counts management command reconciles the table
+with the comment tables.
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
+from django.db.models import F, signals as dbsignals
+from django.db.models.query import QuerySet
+
+from swcomments import models, signals
+
+def counters_enabled():
+  """Returns True if swcomments_get_count should read from the counter table"""
+  return getattr(settings, 'SWCOMMENTS_USE_COUNTERS', False)
+
+def model_label(model_class):
+  """Returns the 'app_label.model' label used to identify comment models in counter rows"""
+  return str(model_class._meta)
+
+def filter_key(model_class, filter):
+  """Returns the filter name stored in counter rows ('' when the default manager is used)"""
+  if filter and filter != 'objects' and hasattr(model_class, filter):
+    return filter
+  return ''
+
+def count_comments(model_class, content_type, object_pk, filter=None, scope=None):
+  """Count comments for one object, exactly like swcomments_get_count does without counters
+  (only those selected by Q object 'scope', if given)"""
+  filter = filter_key(model_class, filter)
+  qs = filter and getattr(model_class, filter) or model_class.objects
+  qs = qs.filter(models.object_filter(object_pk), content_type=content_type)
+  if scope is not None:
+    qs = qs.filter(scope)
+  return model_class.do_count(qs).count()
+
+def _create_counter(model_class, content_type, object_pk, filter):
+  # Count and store; if another process beat us to it, use its row
+  count = count_comments(model_class, content_type, object_pk, filter)
+  sid = transaction.savepoint()
+  try:
+    models.CommentCount.objects.create(comment_model=model_label(model_class), site_id=settings.SITE_ID,
+                                       content_type=content_type, object_pk=object_pk,
+                                       filter=filter, count=count)
+    transaction.savepoint_commit(sid)
+  except IntegrityError:
+    transaction.savepoint_rollback(sid)
+  return count
+
+def get_counts(model_class, objects, filter=None):
+  """
+  Return a dict of object -> number of comments of type 'model_class' for a
+  queryset/list/tuple of objects, reading from the counter table.  Missing counters are
+  computed and stored.
+  """
+  o_list = list(objects)
+  if not o_list:
+    return {}
+
+  ct = ContentType.objects.get_for_model(o_list[0])
+  pks = set([ unicode(o.pk) for o in o_list ])
+  filter = filter_key(model_class, filter)
+
+  rows = models.CommentCount.objects  \
+      .filter(comment_model=model_label(model_class), site=settings.SITE_ID, content_type=ct,
+              object_pk__in=pks, filter=filter)  \
+      .values_list('object_pk', 'count')
+  counts = dict(rows)
+
+  for pk in pks:
+    if pk not in counts:
+      counts[pk] = _create_counter(model_class, ct, pk, filter)
+  return dict([ (o, counts[unicode(o.pk)]) for o in o_list ])
+
+def get_count(model_class, o_expr, filter=None):
+  """
+  Return the number of comments of type 'model_class' for an object (instance) or a
+  queryset/list/tuple of objects, reading from the counter table.
+  """
+  if isinstance(o_expr, (QuerySet, tuple, list)):
+    o_list = list(o_expr)
+  else:
+    o_list = [ o_expr ]
+  return sum(get_counts(model_class, set(o_list), filter).values())
+
+def counter_rows(comment):
+  """Return the counter rows that depend on 'comment' (ie. same object and same non-proxy
+  comment model), as a list of (row, comment model) tuples"""
+  if comment.site_id != settings.SITE_ID:
+    # Comment managers only see the current site; let swcomments_rebuild_counts handle it
+    return []
+  base = comment.get_nonproxy_model()
+  rows = models.CommentCount.objects.filter(site=settings.SITE_ID, content_type=comment.content_type_id,
+                                            object_pk=unicode(comment.object_pk))
+  result = []
+  for row in rows:
+    m = row.get_comment_model()
+    if m is None or not issubclass(m, models.BaseComment) or m.get_nonproxy_model() is not base:
+      continue
+    result.append((row, m))
+  return result
+
+def refresh_counts(comment):
+  """
+  Recount every counter row that depends on 'comment'.  Counting is done per object, which
+  keeps do_count semantics (stacked comments, unanswered questions...) intact.
+  """
+  for row, m in counter_rows(comment):
+    count = count_comments(m, row.content_type_id, row.object_pk, row.filter)
+    if count != row.count:
+      models.CommentCount.objects.filter(pk=row.pk).update(count=count)
+
+def count_before(comment):
+  """
+  Remember, on 'comment', how many comments of its count scope each of its counter rows
+  counts (called right before the comment is written; see apply_counts).
+  """
+  scope = comment.count_scope()
+  comment._counts_before = (scope, [ (row, m, count_comments(m, row.content_type_id, row.object_pk, row.filter, scope))
+                                     for row, m in counter_rows(comment) ])
+
+def apply_counts(comment):
+  """
+  Add to the counter rows of 'comment' the difference between what its count scope counts
+  now and what it counted before the change (see count_before; the scope now includes an
+  inserted comment).  The rows are updated with count = count + delta, so that concurrent
+  changes are all counted.
+  """
+  before = getattr(comment, '_counts_before', None)
+  if before is None:
+    refresh_counts(comment)
+    return
+  del comment._counts_before
+  scope, rows = before
+  scope = scope | comment.count_scope()
+  for row, m, count in rows:
+    delta = count_comments(m, row.content_type_id, row.object_pk, row.filter, scope) - count
+    if delta:
+      models.CommentCount.objects.filter(pk=row.pk).update(count=F('count') + delta)
+
+def rebuild_counts(model_class=None):
+  """
+  Reconcile the counter table with the comment tables: all existing counters (for
+  'model_class' only, if given) are recounted.  Returns the number of rows changed.
+  """
+  changed = 0
+  rows = models.CommentCount.objects.filter(site=settings.SITE_ID)
+  if model_class is not None:
+    rows = rows.filter(comment_model=model_label(model_class))
+  for row in rows.iterator():
+    m = row.get_comment_model()
+    if m is None:
+      row.delete()
+      changed += 1
+      continue
+    count = count_comments(m, row.content_type_id, row.object_pk, row.filter)
+    if count != row.count:
+      models.CommentCount.objects.filter(pk=row.pk).update(count=count)
+      changed += 1
+  return changed
+
+def create_counts(model_class):
+  """
+  Create the default counter of 'model_class' for every object that has comments and no
+  counter yet.  Returns the number of rows created.
+  """
+  created = 0
+  existing = set(models.CommentCount.objects  \
+      .filter(comment_model=model_label(model_class), site=settings.SITE_ID, filter='')  \
+      .values_list('content_type', 'object_pk'))
+  keys = model_class.objects.values_list('content_type', 'object_pk').order_by().distinct()
+  for ct_id, pk in keys.iterator():
+    if (ct_id, pk) not in existing:
+      _create_counter(model_class, ContentType.objects.get_for_id(ct_id), pk, '')
+      created += 1
+  return created
+
+def _comment_pre_save(sender, instance, **kwargs):
+  if counters_enabled() and isinstance(instance, models.BaseComment):
+    count_before(instance)
+
+def _comment_changed(sender, comment, **kwargs):
+  if counters_enabled():
+    apply_counts(comment)
+
+def _comment_pre_delete(sender, instance, **kwargs):
+  if counters_enabled() and isinstance(instance, models.BaseComment):
+    count_before(instance)
+
+def _comment_deleted(sender, instance, **kwargs):
+  if counters_enabled() and isinstance(instance, models.BaseComment):
+    apply_counts(instance)
+
+def _comments_bulk_changed(sender, objects, **kwargs):
+  if counters_enabled():
+    for site_id, ct_id, object_pk in objects:
+      refresh_counts(sender(site_id=site_id, content_type_id=ct_id, object_pk=object_pk))
+
+dbsignals.pre_save.connect(_comment_pre_save)
+signals.comment_changed.connect(_comment_changed)
+signals.comments_bulk_changed.connect(_comments_bulk_changed)
+dbsignals.pre_delete.connect(_comment_pre_delete)
+dbsignals.post_delete.connect(_comment_deleted)
@@ -1,3 +1,4 @@
+import binascii
 import time
 
 from django.conf import settings
@@ -7,10 +8,15 @@ from django.contrib.contenttypes.models import ContentType
 from django.core import exceptions
 
 from swcomments import models
+from swcomments.registry import registry
 
 COMMENT_MAX_LENGTH = 5000
 COMMENT_TIMEOUT = 3*60*60
 
+# If True, forms are rendered without timestamp/security_hash (so that pages can be cached);
+# they must be fetched from the swcomments_security_data view before posting
+DEFER_SECURITY_DATA = getattr(settings, 'SWCOMMENTS_DEFER_SECURITY_DATA', False)
+
 join_strs = "".join
 
 class BaseCommentForm(forms.Form):
@@ -32,13 +38,17 @@ class BaseCommentForm(forms.Form):
   comment = forms.CharField(help_text='Comment (up to %d characters)' % (COMMENT_MAX_LENGTH,), 
                             widget=forms.Textarea, max_length=COMMENT_MAX_LENGTH)
 
-  def __init__(self, target_object, data=None, initial=None, template_name=None):
+  def __init__(self, target_object, data=None, initial=None, template_name=None, security_data=None, defer_security=None):
     self.target_object = target_object
     if initial is None:
       initial = {}
-    initial.update(self.generate_security_data())
+    if security_data is None:
+      if defer_security is None:
+        defer_security = DEFER_SECURITY_DATA
+      security_data = defer_security and self.generate_static_security_data() or self.generate_security_data()
+    initial.update(security_data)
     self.template_name = template_name
-    if self.template_name: initial['tn'] = self.encode_template_name()
+    if self.template_name and 'tn' not in initial: initial['tn'] = self.encode_template_name()
     super(BaseCommentForm, self).__init__(data=data, initial=initial)
 
   @classmethod
@@ -50,12 +60,19 @@ class BaseCommentForm(forms.Form):
 
   def encode_template_name(self):
     # Encodes self.template_name
-    data = join_strs((self.template_name or '',  settings.SECRET_KEY))
-    return ("%s,%s" % (self.template_name, sha_constructor(data).hexdigest())).encode('base64')
+    return self.encode_template_name_for(self.template_name)
+
+  @classmethod
+  def encode_template_name_for(cls, template_name):
+    data = join_strs((template_name or '',  settings.SECRET_KEY))
+    return ("%s,%s" % (template_name, sha_constructor(data).hexdigest())).encode('base64')
 
   @classmethod
   def decode_template_name(cls, tn):
-    name,hash = tn.decode('base64').split(",")
+    try:
+      name,hash = tn.decode('base64').split(",")
+    except (ValueError, binascii.Error):
+      return None
     data = join_strs((name,  settings.SECRET_KEY))
     if hash == sha_constructor(data).hexdigest():
       return name
@@ -63,24 +80,50 @@ class BaseCommentForm(forms.Form):
 
   def clean_security_hash(self):
     """Check the security hash."""
-    security_hash_dict = {
-      'comment_model' : self.data.get("comment_model", ""),
-      'content_type' : self.data.get("content_type", ""),
-      'object_pk' : self.data.get("object_pk", ""),
-      'timestamp' : self.data.get("timestamp", ""),
-    }
-    expected_hash = self.generate_security_hash(**security_hash_dict)
     actual_hash = self.cleaned_data["security_hash"]
-    if expected_hash != actual_hash:
-      raise forms.ValidationError("Security hash check failed.")
+    self.check_security_hash(self.data, actual_hash)
     return actual_hash
 
   def clean_timestamp(self):
     """Make sure the timestamp isn't too far (> X hours) in the past."""
     ts = self.cleaned_data["timestamp"]
+    self.check_timestamp(ts)
+    return ts
+
+  @classmethod
+  def check_security_hash(cls, data, actual_hash):
+    """Raise ValidationError if 'actual_hash' is not the security hash of (raw) form 'data'"""
+    expected_hash = cls.generate_security_hash(
+      data.get("comment_model", ""),
+      data.get("content_type", ""),
+      data.get("object_pk", ""),
+      data.get("timestamp", ""),
+    )
+    if expected_hash != actual_hash:
+      raise forms.ValidationError("Security hash check failed.")
+
+  @classmethod
+  def check_timestamp(cls, ts):
     if time.time() - ts > COMMENT_TIMEOUT:
       raise forms.ValidationError("Comment timeout - please reload page and try again")
-    return ts
+
+  @classmethod
+  def security_errors(cls, data):
+    """
+    Check the timestamp and security hash of (raw) form 'data' without building the form (no
+    target object needed), the same way the form does.  Returns a dict of field name -> list of
+    error messages (empty if both are valid).
+    """
+    errors = {}
+    try:
+      cls.check_timestamp(cls.base_fields['timestamp'].clean(data.get('timestamp')))
+    except forms.ValidationError, e:
+      errors['timestamp'] = e.messages
+    try:
+      cls.check_security_hash(data, cls.base_fields['security_hash'].clean(data.get('security_hash')))
+    except forms.ValidationError, e:
+      errors['security_hash'] = e.messages
+    return errors
 
   '''
   def additional_security_data(self, initial=False):
@@ -93,39 +136,56 @@ class BaseCommentForm(forms.Form):
 
   def generate_security_data(self):
     """Generate a dict of security data for "initial" data."""
-    timestamp = int(time.time())
-    security_dict =   {
-      'comment_model'  : str(self.get_model_class()._meta),
-      'content_type'  : str(self.target_object._meta),
-      'object_pk'     : str(self.target_object._get_pk_val()),
-      'timestamp'     : str(timestamp),
-      'security_hash' : self.initial_security_hash(timestamp),
+    return self.make_security_data(str(self.get_model_class()._meta), str(self.target_object._meta),
+                                   str(self.target_object._get_pk_val()), int(time.time()))
+
+  def generate_static_security_data(self):
+    """Generate the part of the security data that doesn't change with time (for cacheable forms,
+    timestamp and security_hash are left empty)."""
+    return self.make_static_security_data(str(self.get_model_class()._meta), str(self.target_object._meta),
+                                          str(self.target_object._get_pk_val()))
+
+  @classmethod
+  def make_static_security_data(cls, comment_model, content_type, object_pk):
+    return {
+      'comment_model'  : comment_model,
+      'content_type'  : content_type,
+      'object_pk'     : object_pk,
+      'timestamp'     : '',
+      'security_hash' : '',
+    }
+
+  @classmethod
+  def make_security_data(cls, comment_model, content_type, object_pk, timestamp):
+    """Generate the dict of security data from already stringified values (lets callers
+    rendering many forms compute the model/object parts once, see swcomments_render_forms)."""
+    timestamp = str(timestamp)
+    return {
+      'comment_model'  : comment_model,
+      'content_type'  : content_type,
+      'object_pk'     : object_pk,
+      'timestamp'     : timestamp,
+      'security_hash' : cls.generate_security_hash(comment_model, content_type, object_pk, timestamp),
     }
-    return security_dict
 
   def initial_security_hash(self, timestamp):
     """
     Generate the initial security hash from self.content_object
     and a (unix) timestamp.
     """
+    return self.make_security_data(str(self.get_model_class()._meta), str(self.target_object._meta),
+                                   str(self.target_object._get_pk_val()), timestamp)['security_hash']
 
-    initial_security_dict = {
-      'comment_model'  : str(self.get_model_class()._meta),
-      'content_type' : str(self.target_object._meta),
-      'object_pk' : str(self.target_object._get_pk_val()),
-      'timestamp' : str(timestamp),
-    }
-    #initial_security_dict.update(self.additional_security_data(initial=True))
-    return self.generate_security_hash(**initial_security_dict)
-
-  def generate_security_hash(self, comment_model, content_type, object_pk, timestamp):
+  @classmethod
+  def generate_security_hash(cls, comment_model, content_type, object_pk, timestamp):
     """Generate a (SHA1) security hash from the provided info."""
     info = (content_type, object_pk, timestamp, settings.SECRET_KEY)
     return sha_constructor("".join(info)).hexdigest()
 
   def clean_content_type(self):
     ct = self.cleaned_data['content_type']
-    #raise exceptions.SuspiciousOperation("Field 'content_type' is unknown")
+    if registry.get_content_type(ct) is None:
+      raise forms.ValidationError("Comments are not allowed on this object")
     return ct
 
   def get_model_data(self):
@@ -134,7 +194,7 @@ class BaseCommentForm(forms.Form):
     Subclasses can override this method and add to the dictionary."""
     # Leaving status, site, user, submit_date out as they're not necessary...
     return dict(
-      content_type = ContentType.objects.get_by_natural_key(*self.cleaned_data['content_type'].split(".", 1)),
+      content_type = registry.get_content_type(self.cleaned_data['content_type']),
       object_pk = self.cleaned_data['object_pk'],
       comment = self.cleaned_data['comment'],
     )
@@ -152,9 +212,9 @@ class AnonCommentForm(BaseCommentForm):
   def get_model_data(self):
     data = super(AnonCommentForm, self).get_model_data()
     data.update(dict(
-      name = self.cleaned_data['name'],
-      email = self.cleaned_data['email'],
-      url = self.cleaned_data['url'],
+      user_name = self.cleaned_data['name'],
+      user_email = self.cleaned_data['email'],
+      user_url = self.cleaned_data['url'],
     ))
     return data
 
@@ -210,6 +270,41 @@ class BaseStackedCommentForm(forms.Form):
 class StackedCommentForm(BaseStackedCommentForm, BaseCommentForm):
   """StackedComment Form"""
 
+class BaseThreadedCommentForm(forms.Form):
+  """Base for a ThreadedComment form (contains a 'parent_id' hidden field)"""
+
+  parent_id = forms.IntegerField(widget=forms.HiddenInput, required=False)
+
+  def __init__(self, *args, **kwargs):
+    if 'parent' in kwargs:
+      if 'initial' not in kwargs or kwargs['initial'] is None:
+        kwargs['initial'] = {}
+      kwargs['initial']['parent_id'] = kwargs['parent'].id
+      del kwargs['parent']
+    super(BaseThreadedCommentForm, self).__init__(*args, **kwargs)
+
+  def clean_parent_id(self):
+    """Make sure we reply to an active comment of the same object"""
+    parent_id = self.cleaned_data['parent_id']
+    if parent_id:
+      exists = self.get_model_class().active  \
+          .filter(models.object_filter(self.target_object._get_pk_val()),
+                  pk=parent_id, content_type=ContentType.objects.get_for_model(self.target_object))  \
+          .exists()
+      if not exists:
+        raise forms.ValidationError("The comment you are replying to does not exist")
+    return parent_id
+
+  def get_model_data(self):
+    data = super(BaseThreadedCommentForm, self).get_model_data()
+    data.update(dict(
+      parent_id = self.cleaned_data['parent_id'],
+    ))
+    return data
+
+class ThreadedCommentForm(BaseThreadedCommentForm, BaseCommentForm):
+  """ThreadedComment Form"""
+
 class BaseRatingCommentForm(forms.Form):
   """Base for a RatingComment form (contains a 'score' hidden field')"""
 
@@ -0,0 +1,342 @@
+"""
+Instrumentation of template tags and filters, comment model hooks and views.
+
+When settings.SWCOMMENTS_INSTRUMENTATION is True, every call to:
+
+- the render() of the swcomments template tag nodes (kind 'tag'),
+- the swcomments_thread and swcomments_stack_tops template filters (kind 'filter'),
+- the do_thread()/do_count() hooks of the comment models (kind 'hook'),
+- the post_comment view (kind 'view')
+
+is measured: wall time, number and total time of the SQL queries it ran (on all databases)
+and number of rows it materialized (model instances created).  Measurements are inclusive: a
+tag that calls do_count() counts the queries of both.  When do_thread() returns an iterator
+(eg. given a queryset), its consumption is added to the hook's measurement, reported once the
+iterator is exhausted (an iterator that is not exhausted is not reported).  When it is given
+a list (as by the swcomments_thread filter), the list was fetched before the call: its query
+is counted by the caller (the filter).  do_count() only builds a queryset: its query is
+counted by the caller (tag, filter or view).
+
+Each measurement (a Call) is handed to the sinks of settings.SWCOMMENTS_INSTRUMENTATION_SINKS
+(default ['log']):
+
+- 'log': logged to the 'swcomments.instrumentation' logger (INFO)
+- 'signal': sent as signals.call_measured (sender: the comment model, if known)
+- 'memory': aggregated in memory per tag/filter/hook/view and comment model, see get_stats()
+- the dotted path of any callable, called with the Call
+
+The setting is read once at startup: when it is off, nothing is wrapped and instrumentation
+costs nothing.  Queries are recorded with Django's debug cursor (milliseconds) while a call
+is measured, then forgotten (unless settings.DEBUG).
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import signals as dbsignals
+from django.utils.importlib import import_module
+
+from swcomments import signals
+
+ENABLED = getattr(settings, 'SWCOMMENTS_INSTRUMENTATION', False)
+SINKS = getattr(settings, 'SWCOMMENTS_INSTRUMENTATION_SINKS', [ 'log' ])
+
+# Number of (most recent) wall times kept per key by the memory sink, for percentiles
+MEMORY_SAMPLES = getattr(settings, 'SWCOMMENTS_INSTRUMENTATION_SAMPLES', 1000)
+PERCENTILES = (50, 90, 99)
+
+logger = logging.getLogger('swcomments.instrumentation')
+
+class Call(object):
+  """
+  A measured call: 'kind' (tag, filter, hook or view), 'name' (tag, filter, hook or view name), 'model' (comment
+  model class, None if not known), 'elapsed' and 'query_time' (seconds), 'queries' and 'rows'
+  (numbers), 'failed' (True if it raised an exception).
+  """
+  def __init__(self, kind, name, model, elapsed, queries, query_time, rows, failed=False):
+    self.kind = kind
+    self.name = name
+    self.model = model
+    self.elapsed = elapsed
+    self.queries = queries
+    self.query_time = query_time
+    self.rows = rows
+    self.failed = failed
+
+  @property
+  def model_label(self):
+    return self.model is not None and str(self.model._meta) or ''
+
+  def as_dict(self):
+    return dict(kind=self.kind, name=self.name, model=self.model_label, elapsed=self.elapsed,
+                queries=self.queries, query_time=self.query_time, rows=self.rows, failed=self.failed)
+
+  def __unicode__(self):
+    return u'%s %s %s: %.2fms, %d queries (%.2fms), %d rows%s' % (self.kind, self.name, self.model_label,
+      self.elapsed * 1000, self.queries, self.query_time * 1000, self.rows, self.failed and ' (failed)' or '')
+
+#
+# Measuring
+#
+
+class State(threading.local):
+  """Per-thread state: depth of nested measurements, number of model instances created"""
+  def __init__(self):
+    self.depth = 0
+    self.rows = 0
+    self.debug_cursors = []
+    self.hooks = ()     # hooks being measured (a hook calling its super() is measured once)
+
+_state = State()
+
+def count_row(sender, **kwargs):
+  _state.rows += 1
+
+class Measure(object):
+  """Measures what happens between start() and stop() (can be nested and restarted)"""
+  def __init__(self):
+    self.elapsed = self.query_time = 0.0
+    self.queries = self.rows = 0
+
+  def start(self):
+    if _state.depth == 0:
+      # Record queries with the debug cursor while measuring
+      _state.debug_cursors = [ (c, c.use_debug_cursor, len(c.queries)) for c in connections.all() ]
+      for c in connections.all():
+        c.use_debug_cursor = True
+    _state.depth += 1
+    self._queries = [ (c, len(c.queries)) for c in connections.all() ]
+    self._rows = _state.rows
+    self._start = time.time()
+
+  def stop(self):
+    self.elapsed += time.time() - self._start
+    self.rows += _state.rows - self._rows
+    for c, n in self._queries:
+      queries = c.queries[n:]
+      self.queries += len(queries)
+      self.query_time += sum([ float(q['time']) for q in queries ])
+    _state.depth -= 1
+    if _state.depth == 0:
+      for c, use_debug_cursor, n in _state.debug_cursors:
+        c.use_debug_cursor = use_debug_cursor
+        if not settings.DEBUG:
+          del c.queries[n:]
+      _state.debug_cursors = []
+
+  def call(self, kind, name, model, failed=False):
+    return Call(kind, name, model, self.elapsed, self.queries, self.query_time, self.rows, failed)
+
+def measured(kind, name, model, fn, *args, **kwargs):
+  """Call fn(*args, **kwargs), measuring it, and return its result"""
+  m = Measure()
+  m.start()
+  try:
+    result = fn(*args, **kwargs)
+  except:
+    m.stop()
+    record(m.call(kind, name, model, True))
+    raise
+  m.stop()
+  if kind == 'hook' and isinstance(result, collections.Iterator):
+    return MeasuredIterator(result, m, kind, name, model)
+  record(m.call(kind, name, model))
+  return result
+
+class MeasuredIterator(object):
+  """Iterator that adds the time spent producing each item to measure 'm', and records the call
+  once exhausted"""
+  def __init__(self, iterator, m, kind, name, model):
+    self.iterator = iterator
+    self.m = m
+    self.args = (kind, name, model)
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    self.m.start()
+    try:
+      item = self.iterator.next()
+    except StopIteration:
+      self.m.stop()
+      record(self.m.call(*self.args))
+      raise
+    except:
+      self.m.stop()
+      record(self.m.call(*(self.args + (True,))))
+      raise
+    self.m.stop()
+    return item
+
+#
+# Sinks
+#
+
+def log_sink(call):
+  logger.info(unicode(call), extra={ 'swcomments_call': call })
+
+def signal_sink(call):
+  signals.call_measured.send(sender=call.model, call=call)
+
+class MemorySink(object):
+  """Aggregates calls per (kind, name, comment model): count, failures, totals and the most
+  recent MEMORY_SAMPLES wall times (for percentiles)"""
+  def __init__(self, samples=MEMORY_SAMPLES):
+    self.samples = samples
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.lock.acquire()
+    try:
+      self.stats = {}
+    finally:
+      self.lock.release()
+
+  def __call__(self, call):
+    key = (call.kind, call.name, call.model_label)
+    self.lock.acquire()
+    try:
+      s = self.stats.get(key)
+      if s is None:
+        s = self.stats[key] = dict(count=0, failed=0, elapsed=0.0, queries=0, query_time=0.0, rows=0,
+                                   times=collections.deque(maxlen=self.samples))
+      s['count'] += 1
+      s['failed'] += call.failed and 1 or 0
+      s['elapsed'] += call.elapsed
+      s['queries'] += call.queries
+      s['query_time'] += call.query_time
+      s['rows'] += call.rows
+      s['times'].append(call.elapsed)
+    finally:
+      self.lock.release()
+
+  def get_stats(self):
+    """Return a list of dicts (kind, name, model, count, failed, mean/max and percentiles of the
+    wall time, in seconds, and mean queries, query time and rows), slowest (total) first"""
+    self.lock.acquire()
+    try:
+      items = [ (key, dict(s, times=sorted(s['times']))) for key, s in self.stats.items() ]
+    finally:
+      self.lock.release()
+    results = []
+    for (kind, name, model), s in items:
+      times, n = s['times'], s['count']
+      d = dict(kind=kind, name=name, model=model, count=n, failed=s['failed'], total=s['elapsed'],
+               mean=s['elapsed'] / n, max=times[-1], queries=s['queries'] / float(n),
+               query_time=s['query_time'] / n, rows=s['rows'] / float(n))
+      for p in PERCENTILES:
+        d['p%s' % (p,)] = times[min(len(times) * p // 100, len(times) - 1)]
+      results.append(d)
+    results.sort(key=lambda d: -d['total'])
+    return results
+
+memory_sink = MemorySink()
+
+BUILTIN_SINKS = {
+  'log': log_sink,
+  'signal': signal_sink,
+  'memory': memory_sink,
+}
+
+_sinks = None
+
+def get_sinks():
+  """Return the sinks of settings.SWCOMMENTS_INSTRUMENTATION_SINKS (resolved once per process)"""
+  global _sinks
+  if _sinks is None:
+    sinks = []
+    for name in SINKS:
+      if name in BUILTIN_SINKS:
+        sinks.append(BUILTIN_SINKS[name])
+        continue
+      module, sep, attr = name.rpartition('.')
+      try:
+        sinks.append(getattr(import_module(module), attr))
+      except (ImportError, AttributeError, ValueError):
+        raise ValueError('settings.SWCOMMENTS_INSTRUMENTATION_SINKS: unknown sink %s' % (name,))
+    _sinks = sinks
+  return _sinks
+
+def record(call):
+  for sink in get_sinks():
+    sink(call)
+
+def get_stats():
+  """Return the statistics of the memory sink (see MemorySink.get_stats)"""
+  return memory_sink.get_stats()
+
+def reset_stats():
+  memory_sink.reset()
+
+#
+# Wrapping (only done when instrumentation is enabled)
+#
+
+def instrument_node(node_class, tag_name):
+  """Measure the render() of template node class 'node_class' (of tag 'tag_name')"""
+  if not ENABLED:
+    return
+  render = node_class.render
+  def instrumented_render(self, context):
+    return measured('tag', tag_name, getattr(self, 'model_class', None), render, self, context)
+  node_class.render = instrumented_render
+
+def instrument_filter(filter_func, filter_name):
+  """Measure template filter 'filter_func' (of name 'filter_name'), whose argument is a comment
+  queryset or list"""
+  if not ENABLED:
+    return filter_func
+  def instrumented_filter(arg):
+    model = getattr(arg, 'model', None)
+    if model is None and isinstance(arg, (list, tuple)) and arg:
+      model = type(arg[0])
+    return measured('filter', filter_name, model, filter_func, arg)
+  instrumented_filter.__name__ = filter_func.__name__
+  instrumented_filter.__doc__ = filter_func.__doc__
+  return instrumented_filter
+
+HOOKS = ('do_thread', 'do_count')
+
+def instrument_model(model_class):
+  """Measure the do_thread()/do_count() hooks of comment model 'model_class'"""
+  if not ENABLED:
+    return
+  for name in HOOKS:
+    # Wrap the function itself (as a classmethod): the hook of a model inheriting from another
+    # instrumented model must still be called on its own class
+    for klass in model_class.__mro__:
+      if name in klass.__dict__:
+        hook = klass.__dict__[name].__func__
+        break
+    hook = getattr(hook, 'instrumented', hook)
+    def instrumented_hook(cls, qs, hook=hook, name=name):
+      if name in _state.hooks:
+        return hook(cls, qs)
+      _state.hooks += (name,)
+      try:
+        return measured('hook', name, cls, hook, cls, qs)
+      finally:
+        _state.hooks = _state.hooks[:-1]
+    instrumented_hook.instrumented = hook
+    setattr(model_class, name, classmethod(instrumented_hook))
+
+def instrument_view(view):
+  """Measure comment view 'view' (the comment model is the request's 'comment_model')"""
+  if not ENABLED:
+    return view
+  from swcomments.registry import registry
+  def instrumented_view(request, *args, **kwargs):
+    model = registry.get_comment_model(request.REQUEST.get('comment_model'))
+    return measured('view', view.__name__, model, view, request, *args, **kwargs)
+  instrumented_view.__name__ = view.__name__
+  instrumented_view.__doc__ = view.__doc__
+  return instrumented_view
+
+if ENABLED:
+  dbsignals.post_init.connect(count_row, dispatch_uid='swcomments.instrumentation')
@@ -0,0 +1,112 @@
+"""
+Schema helpers for swcomments.
+
+Django can't declare composite indexes on models, so comment models list them in their
+get_indexes() classmethod (as do the other swcomments models that need some) and they are
+created here: right after syncdb creates a table, or by the swcomments_backfill_object_id
+command for tables that already exist.
+"""
+
+import sys
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import get_models, signals as dbsignals
+from django.utils.hashcompat import md5_constructor
+
+from swcomments import models
+
+def comment_models():
+  """Return all concrete (non-proxy, non-abstract) comment models"""
+  return [ m for m in get_models() if issubclass(m, models.BaseComment) and not m._meta.proxy ]
+
+def index_name(model, fields):
+  """Return the (short, stable) name of the composite index on 'fields' of 'model'"""
+  digest = md5_constructor(",".join(fields)).hexdigest()[:8]
+  return "%s_swc_%s" % (model._meta.db_table[:40], digest)
+
+def existing_columns(model, cursor):
+  return [ row[0] for row in connection.introspection.get_table_description(cursor, model._meta.db_table) ]
+
+def add_missing_columns(model, verbosity=1, stdout=None):
+  """Add columns (nullable or with a numeric default) that were added to comment models after 
+  'model' table was created (ie. object_id, stack_id, answer_count).  Returns the list of 
+  columns added."""
+  stdout = stdout or sys.stdout
+  cursor = connection.cursor()
+  qn = connection.ops.quote_name
+  columns = existing_columns(model, cursor)
+  added = []
+  for f in model._meta.local_fields:
+    if f.column in columns:
+      continue
+    if f.null:
+      extra = "NULL"
+    elif f.has_default() and isinstance(f.get_default(), (int, long)):
+      extra = "DEFAULT %d NOT NULL" % (f.get_default(),)
+    else:
+      continue
+    cursor.execute("ALTER TABLE %s ADD COLUMN %s %s %s" % (qn(model._meta.db_table), qn(f.column), f.db_type(connection=connection), extra))
+    added.append(f.column)
+    if verbosity >= 1:
+      stdout.write("Added column %s.%s\n" % (model._meta.db_table, f.column))
+  transaction.commit_unless_managed()
+  return added
+
+# Queries listing the names of the indexes of a table, per database vendor
+INDEX_NAMES_SQL = {
+  'sqlite': "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s",
+  'postgresql': "SELECT indexname FROM pg_indexes WHERE tablename = %s",
+  'mysql': "SELECT DISTINCT index_name FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s",
+  'oracle': "SELECT LOWER(index_name) FROM user_indexes WHERE table_name = UPPER(%s)",
+}
+
+def existing_indexes(model, cursor):
+  """Return the set of the names of the indexes of 'model' table (None if the database can't
+  tell)"""
+  if hasattr(connection.introspection, 'get_constraints'):
+    return set(connection.introspection.get_constraints(cursor, model._meta.db_table).keys())
+  sql = INDEX_NAMES_SQL.get(connection.vendor)
+  if sql is None:
+    return None
+  cursor.execute(sql, [ model._meta.db_table ])
+  return set([ row[0].lower() for row in cursor.fetchall() ])
+
+def create_indexes(model, verbosity=1, stdout=None):
+  """Create the composite indexes listed by model.get_indexes() (if they don't exist yet)."""
+  stdout = stdout or sys.stdout
+  cursor = connection.cursor()
+  qn = connection.ops.quote_name
+  existing = existing_indexes(model, cursor)
+  for fields in model.get_indexes():
+    name = index_name(model, fields)
+    if existing is not None and name.lower() in existing:
+      if verbosity >= 2:
+        stdout.write("Index %s already exists\n" % (name,))
+      continue
+    columns = [ qn(model._meta.get_field(f).column) for f in fields ]
+    sql = "CREATE INDEX %s ON %s (%s)" % (qn(name), qn(model._meta.db_table), ", ".join(columns))
+    if existing is not None:
+      cursor.execute(sql)
+    else:
+      # The database can't list its indexes: the index may already exist
+      sid = transaction.savepoint()
+      try:
+        cursor.execute(sql)
+        transaction.savepoint_commit(sid)
+      except DatabaseError, e:
+        transaction.savepoint_rollback(sid)
+        stdout.write("Could not create index %s (it may already exist): %s\n" % (name, e))
+        continue
+    if verbosity >= 1:
+      stdout.write("Created index %s on %s (%s)\n" % (name, model._meta.db_table, ", ".join(fields)))
+  transaction.commit_unless_managed()
+
+def _post_syncdb(sender, app, created_models, verbosity=1, **kwargs):
+  for m in created_models:
+    if hasattr(m, 'get_indexes') and not m._meta.proxy:
+      create_indexes(m, verbosity)
+  from swcomments import search
+  if search.search_enabled():
+    search.get_backend().setup()
+
+dbsignals.post_syncdb.connect(_post_syncdb, sender=models)
@@ -0,0 +1,161 @@
+import datetime
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Q
+
+from swcomments import models, signals
+from swcomments.management import comment_models
+
+# Retention policy: deleted comments are archived after ARCHIVE_DELETED_DAYS days, all
+# comments after ARCHIVE_AGE_DAYS days (None: never)
+ARCHIVE_DELETED_DAYS = getattr(settings, 'SWCOMMENTS_ARCHIVE_DELETED_DAYS', 30)
+ARCHIVE_AGE_DAYS = getattr(settings, 'SWCOMMENTS_ARCHIVE_AGE_DAYS', None)
+
+class Command(BaseCommand):
+  """
+  Move the comments matching the retention policy from the comment tables to their archive
+  tables (see models.make_archive_model), one batch per transaction.  Comments are moved
+  newest first, and a comment that is still referenced by a comment that stays (question with
+  answers, parent with replies) stays too, so that no hot comment points to an archived one.
+  The command can be interrupted and run again at any time: it resumes with the comments
+  that are left (or before --before-id).
+
+  Derived data is kept consistent: answer counts of questions and stack dates are
+  recomputed, stacks left without comments are deleted, and comments_bulk_changed is sent for the objects involved (counters, cache,
+  rating aggregates).
+  """
+  args = '[app_label.model ...]'
+  help = 'Moves deleted and old comments to the archive tables.'
+  option_list = BaseCommand.option_list + (
+    make_option('--deleted-days', type='int', dest='deleted_days', default=ARCHIVE_DELETED_DAYS,
+                help='Archive deleted comments older than this many days (default %s).' % (ARCHIVE_DELETED_DAYS,)),
+    make_option('--age-days', type='int', dest='age_days', default=ARCHIVE_AGE_DAYS,
+                help='Archive all comments older than this many days (default %s).' % (ARCHIVE_AGE_DAYS,)),
+    make_option('--batch-size', type='int', dest='batch_size', default=500,
+                help='Number of comments moved per transaction (default 500).'),
+    make_option('--before-id', type='int', dest='before_id', default=None,
+                help='Only consider comments with a lower id (to resume an interrupted run).'),
+    make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                help='Only count the comments that match the retention policy.'),
+  )
+
+  def handle(self, *labels, **options):
+    self.verbosity = int(options.get('verbosity', 1))
+    model_classes = [ m for m in comment_models() if m.get_archive_model() is not None ]
+    if labels:
+      labels = [ ('.' in l and l or 'swcomments.' + l).lower() for l in labels ]
+      model_classes = [ m for m in model_classes if str(m._meta) in labels ]
+      if len(model_classes) != len(labels):
+        raise CommandError('Unknown or non-archivable comment model in: %s' % (", ".join(labels),))
+
+    policy = self.get_policy(options['deleted_days'], options['age_days'])
+    if policy is None:
+      raise CommandError('No retention policy: give --deleted-days and/or --age-days')
+
+    for m in model_classes:
+      qs = m._base_manager.filter(policy)
+      if options['before_id']:
+        qs = qs.filter(id__lt=options['before_id'])
+      if options['dry_run']:
+        self.stdout.write("%s: %d comment(s) to archive\n" % (m._meta, qs.count()))
+        continue
+      total = self.archive(m, qs, options['batch_size'])
+      if self.verbosity >= 1:
+        self.stdout.write("%s: %d comment(s) archived\n" % (m._meta, total))
+
+  def get_policy(self, deleted_days, age_days):
+    now = datetime.datetime.now()
+    policy = None
+    if deleted_days is not None:
+      policy = Q(status=models.BaseComment.STATUS_DELETED, submit_date__lt=now - datetime.timedelta(days=deleted_days))
+    if age_days is not None:
+      q = Q(submit_date__lt=now - datetime.timedelta(days=age_days))
+      policy = policy is None and q or policy | q
+    return policy
+
+  def archive(self, model, qs, batch_size):
+    start = time.time()
+    total = 0
+    last_id = None
+    while True:
+      batch = qs
+      if last_id is not None:
+        batch = batch.filter(id__lt=last_id)
+      ids = list(batch.order_by('-id').values_list('id', flat=True)[:batch_size])
+      if not ids:
+        break
+      last_id = ids[-1]
+      total += self.move(model, ids)
+      if self.verbosity >= 2:
+        elapsed = max(time.time() - start, 0.001)
+        self.stderr.write("%s: %d comment(s) archived, next batch before id %d (%.0f/s)\n" % (model._meta, total, last_id, total / elapsed))
+    return total
+
+  def referenced(self, model, ids):
+    # Ids of 'ids' that comments not in 'ids' point to (as their question, parent...)
+    found = set()
+    for f in model._meta.local_fields:
+      if f.rel and issubclass(f.rel.to, models.BaseComment):
+        found.update(model._base_manager
+            .filter(**{ '%s__in' % (f.name,): ids })
+            .exclude(id__in=ids)
+            .values_list(f.attname, flat=True))
+    return found
+
+  @transaction.commit_on_success
+  def move(self, model, ids):
+    ids = set(ids)
+    while ids:
+      keep = self.referenced(model, ids)
+      if not keep:
+        break
+      ids -= keep
+    if not ids:
+      return 0
+    ids = sorted(ids)
+
+    # Data to fix up once the comments are gone
+    is_qa = issubclass(model, models.BaseQAComment)
+    is_stacked = issubclass(model, models.BaseStackedComment)
+    objects, questions, stacks = set(), set(), set()
+    columns = [ 'site', 'content_type', 'object_pk' ] + (is_qa and [ 'question' ] or []) + (is_stacked and [ 'stack' ] or [])
+    for row in model._base_manager.filter(id__in=ids).values_list(*columns):
+      objects.add(tuple(row[:3]))
+      if is_qa and row[3]:
+        questions.add(row[3])
+      if is_stacked and row[-1]:
+        stacks.add(row[-1])
+
+    # Copy, then delete (set-based: no per-comment delete signals)
+    qn = connection.ops.quote_name
+    archive_model = model.get_archive_model()
+    names = ", ".join([ qn(f.column) for f in model._meta.local_fields ])
+    placeholders = ", ".join([ '%s' ] * len(ids))
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO %s (%s, %s) SELECT %s, %%s FROM %s WHERE %s IN (%s)" % (
+                     qn(archive_model._meta.db_table), names, qn('archive_date'), names,
+                     qn(model._meta.db_table), qn('id'), placeholders),
+                   [ datetime.datetime.now() ] + ids)
+    cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (qn(model._meta.db_table), qn('id'), placeholders), ids)
+
+    hot = model._base_manager
+    for question_id in hot.filter(id__in=questions).values_list('id', flat=True):
+      model.update_answer_data(question_id)
+    if stacks:
+      latest = hot.filter(stack__in=stacks).values('stack').annotate(last=Max('submit_date')).order_by()
+      empty = set(stacks)
+      for s in latest:
+        models.CommentStack.objects.filter(pk=s['stack']).update(stack_date=s['last'])
+        hot.filter(stack=s['stack']).update(stack_date=s['last'])
+        empty.discard(s['stack'])
+      # Stacks whose comments have all been archived (archived comments keep their stack id
+      # as a plain integer)
+      if empty:
+        models.CommentStack.objects.filter(pk__in=empty).delete()
+
+    signals.comments_bulk_changed.send(sender=model, objects=sorted(objects), ids=ids)
+    return len(ids)
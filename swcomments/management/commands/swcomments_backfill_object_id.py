@@ -0,0 +1,62 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from swcomments import models
+from swcomments.management import comment_models, add_missing_columns, create_indexes
+
+class Command(BaseCommand):
+  """
+  Fill the integer object_id column of all comment models from object_pk, in chunks
+  (comments saved since object_id was added already have it).  Once it has run, set
+  settings.SWCOMMENTS_OBJECT_ID_BACKFILLED to True: lookups then use object_id only.
+  """
+  help = 'Backfills BaseComment.object_id from object_pk (and optionally adds the column/indexes).'
+  option_list = BaseCommand.option_list + (
+    make_option('--schema', action='store_true', dest='schema', default=False,
+                help='Add the object_id column and composite indexes to existing tables first.'),
+    make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                help='Number of comments updated per transaction (default 1000).'),
+  )
+
+  def handle(self, *args, **options):
+    verbosity = int(options.get('verbosity', 1))
+    chunk_size = options['chunk_size']
+    for m in comment_models():
+      if options['schema']:
+        add_missing_columns(m, verbosity, self.stdout)
+        create_indexes(m, verbosity, self.stdout)
+      total = self.backfill(m, chunk_size)
+      if verbosity >= 1:
+        self.stdout.write("%s: %d comment(s) updated\n" % (m._meta, total))
+    if verbosity >= 1 and not models.OBJECT_ID_BACKFILLED:
+      self.stdout.write("Set settings.SWCOMMENTS_OBJECT_ID_BACKFILLED = True to look comments up by object_id only\n")
+
+  @transaction.commit_manually
+  def backfill(self, model, chunk_size):
+    # Walk the table by id, one chunk per transaction, grouping the updates by object
+    total = 0
+    last_id = 0
+    try:
+      while True:
+        rows = list(model._base_manager
+                      .filter(id__gt=last_id, object_id__isnull=True)
+                      .order_by('id')
+                      .values_list('id', 'object_pk')[:chunk_size])
+        if not rows:
+          transaction.commit()
+          break
+        last_id = rows[-1][0]
+        by_key = {}
+        for id, object_pk in rows:
+          key = models.object_key(object_pk)
+          if key is not None:
+            by_key.setdefault(key, []).append(id)
+        for key, ids in by_key.items():
+          total += model._base_manager.filter(id__in=ids).update(object_id=key)
+        transaction.commit()
+    except:
+      transaction.rollback()
+      raise
+    return total
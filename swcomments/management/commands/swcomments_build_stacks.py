@@ -0,0 +1,85 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from swcomments import models
+from swcomments.management import comment_models, add_missing_columns, create_indexes
+
+class Command(BaseCommand):
+  """
+  Build the CommentStack rows of all stacked comment models from existing comments (for
+  comments saved before stacks were stored in their own table, ie. with no stack), and the
+  comments' copy of their stack's date where it is missing.
+  """
+  help = 'Creates the stacks (CommentStack) of existing stacked comments.'
+  option_list = BaseCommand.option_list + (
+    make_option('--schema', action='store_true', dest='schema', default=False,
+                help='Add the stack_id/stack_date columns and indexes to existing tables first.'),
+    make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                help='Number of comments handled per transaction (default 1000).'),
+  )
+
+  def handle(self, *args, **options):
+    verbosity = int(options.get('verbosity', 1))
+    for m in comment_models():
+      if not issubclass(m, models.BaseStackedComment):
+        continue
+      if options['schema']:
+        add_missing_columns(m, verbosity, self.stdout)
+        create_indexes(m, verbosity, self.stdout)
+      total = self.build(m, options['chunk_size'])
+      if verbosity >= 1:
+        self.stdout.write("%s: %d comment(s) stacked\n" % (m._meta, total))
+
+  @transaction.commit_manually
+  def build(self, model, chunk_size):
+    # Comments with no stack (or no stack date) are read chunk_size ids at a time; each chunk
+    # is handled with a few set-based statements: create the missing stacks with one
+    # INSERT ... SELECT ... GROUP BY, attach the comments with one UPDATE, then bring the dates
+    # of the stacks involved (and of their comments) up to date
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    stacks = qn(models.CommentStack._meta.db_table)
+    label = str(model._meta)
+    same_stack = "%s.comment_model = %%s AND %s.site_id = %s.site_id AND %s.user_id = %s.user_id"  \
+                 " AND %s.content_type_id = %s.content_type_id AND %s.object_pk = %s.object_pk" % (
+                   (stacks,) + (stacks, table) * 4)
+    qs = model._base_manager.filter(Q(stack__isnull=True) | Q(stack_date__isnull=True))
+    cursor = connection.cursor()
+    total, last = 0, 0
+    try:
+      while True:
+        ids = list(qs.filter(id__gt=last).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+          break
+        first, last = ids[0], ids[-1]
+        cursor.execute(
+          "INSERT INTO %s (comment_model, site_id, user_id, content_type_id, object_pk, object_id, stack_date)"
+          " SELECT %%s, site_id, user_id, content_type_id, object_pk, MAX(object_id), MAX(submit_date)"
+          " FROM %s WHERE stack_id IS NULL AND id BETWEEN %%s AND %%s"
+          " AND NOT EXISTS (SELECT 1 FROM %s WHERE %s)"
+          " GROUP BY site_id, user_id, content_type_id, object_pk" % (stacks, table, stacks, same_stack),
+          [ label, first, last, label ])
+        cursor.execute(
+          "UPDATE %s SET stack_id = (SELECT %s.id FROM %s WHERE %s)"
+          " WHERE stack_id IS NULL AND id BETWEEN %%s AND %%s" % (table, stacks, stacks, same_stack),
+          [ label, first, last ])
+        touched = sorted(set(model._base_manager.filter(id__gte=first, id__lte=last).values_list('stack', flat=True)) - set([ None ]))
+        for i in range(0, len(touched), 500):
+          chunk = touched[i:i + 500]
+          placeholders = ", ".join([ '%s' ] * len(chunk))
+          cursor.execute(
+            "UPDATE %s SET stack_date = (SELECT MAX(submit_date) FROM %s WHERE %s.stack_id = %s.id)"
+            " WHERE id IN (%s)" % (stacks, table, table, stacks, placeholders), chunk)
+          cursor.execute(
+            "UPDATE %s SET stack_date = (SELECT stack_date FROM %s WHERE %s.id = %s.stack_id)"
+            " WHERE stack_id IN (%s)" % (table, stacks, stacks, table, placeholders), chunk)
+        transaction.commit()
+        total += len(ids)
+      transaction.commit()
+    except:
+      transaction.rollback()
+      raise
+    return total
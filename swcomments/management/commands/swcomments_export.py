@@ -0,0 +1,83 @@
+import datetime
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from swcomments.management import comment_models
+
+# Fields that are derived from other data: not exported, recomputed by swcomments_import
+DERIVED_FIELDS = ('object_id', 'stack', 'stack_date', 'answer_count', 'last_answer_date')
+
+def export_fields(model):
+  """Return the fields of 'model' that are exported (all local fields but derived ones)"""
+  return [ f for f in model._meta.local_fields if f.name not in DERIVED_FIELDS ]
+
+class Command(BaseCommand):
+  """
+  Export all comments (every concrete comment model) as JSON Lines: one object per line,
+  {"model": "app_label.model", "pk": ID, "fields": {column: value, ...}}.  Tables are read in
+  id-ordered chunks, so memory use does not depend on their size.
+  """
+  args = '[output file]'
+  help = 'Exports all comments to a JSON Lines file (or stdout).'
+  option_list = BaseCommand.option_list + (
+    make_option('--model', action='append', dest='models', default=[],
+                help='Only export this comment model (app_label.model); can be repeated.'),
+    make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                help='Number of comments read per query (default 1000).'),
+  )
+
+  def handle(self, *args, **options):
+    verbosity = int(options.get('verbosity', 1))
+    if len(args) > 1:
+      raise CommandError('Only one output file can be given')
+    out = args and args[0] != '-' and open(args[0], 'w') or sys.stdout
+
+    models = comment_models()
+    if options['models']:
+      labels = [ l.lower() for l in options['models'] ]
+      models = [ m for m in models if str(m._meta) in labels ]
+      if len(models) != len(labels):
+        raise CommandError('Unknown comment model in: %s' % (", ".join(options['models']),))
+
+    try:
+      for m in models:
+        self.export(m, out, options['chunk_size'], verbosity)
+    finally:
+      if out is not sys.stdout:
+        out.close()
+
+  def export(self, model, out, chunk_size, verbosity):
+    label = str(model._meta)
+    fields = export_fields(model)
+    names = [ f.name for f in fields ]
+    columns = [ f.attname for f in fields ]
+    start = time.time()
+    total = 0
+    last_id = 0
+    while True:
+      rows = list(model._base_manager.filter(id__gt=last_id).order_by('id').values_list(*names)[:chunk_size])
+      if not rows:
+        break
+      for row in rows:
+        data = dict(zip(columns, row))
+        pk = data.pop('id')
+        for k, v in data.items():
+          if isinstance(v, (datetime.datetime, datetime.date)):
+            data[k] = v.isoformat()
+        out.write(simplejson.dumps({ 'model': label, 'pk': pk, 'fields': data }))
+        out.write("\n")
+      last_id = rows[-1][0]
+      total += len(rows)
+      if verbosity >= 2:
+        self.report(label, total, start)
+    if verbosity >= 1:
+      self.report(label, total, start)
+    return total
+
+  def report(self, label, total, start):
+    elapsed = max(time.time() - start, 0.001)
+    self.stderr.write("%s: %d comment(s) exported (%.0f/s)\n" % (label, total, total / elapsed))
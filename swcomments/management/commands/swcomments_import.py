@@ -0,0 +1,152 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import get_model
+from django.utils import simplejson
+
+from swcomments import models, counters, ratings, search
+from swcomments.management import comment_models
+from swcomments.management.commands.swcomments_export import export_fields
+
+def bulk_create(model, batch):
+  """Insert comments 'batch' of 'model' with bulk_create(), keeping their dates (bulk_create()
+  calls pre_save(), which would set auto_now/auto_now_add fields to "now")"""
+  auto = [ f for f in model._meta.local_fields if getattr(f, 'auto_now_add', False) or getattr(f, 'auto_now', False) ]
+  saved = [ (f.auto_now, f.auto_now_add) for f in auto ]
+  try:
+    for f in auto:
+      f.auto_now = f.auto_now_add = False
+    model._base_manager.bulk_create(batch)
+  finally:
+    for f, (auto_now, auto_now_add) in zip(auto, saved):
+      f.auto_now, f.auto_now_add = auto_now, auto_now_add
+
+@transaction.commit_on_success
+def reset_sequences(loaded):
+  """Rows of models 'loaded' were inserted with their ids: move the sequences past them (as
+  loaddata does)"""
+  sql = connection.ops.sequence_reset_sql(no_style(), loaded)
+  if sql:
+    cursor = connection.cursor()
+    for line in sql:
+      cursor.execute(line)
+
+def rebuild_derived(loaded, verbosity=1):
+  """Recompute the data derived from comments of models 'loaded' that were inserted in bulk:
+  stacks, answer counts, rating aggregates, counters and search index (when enabled)"""
+  if [ m for m in loaded if issubclass(m, models.BaseStackedComment) ]:
+    call_command('swcomments_build_stacks', verbosity=verbosity)
+  if [ m for m in loaded if issubclass(m, models.BaseQAComment) ]:
+    call_command('swcomments_rebuild_answers', verbosity=verbosity)
+  rated = [ str(m._meta) for m in loaded if ratings.is_rating_model(m) ]
+  if rated:
+    call_command('swcomments_rebuild_ratings', *rated, **dict(verbosity=verbosity))
+  if counters.counters_enabled():
+    call_command('swcomments_rebuild_counts', *[ str(m._meta) for m in loaded ], **dict(verbosity=verbosity, create=True))
+  if search.search_enabled():
+    # Only the models loaded, not the whole index
+    search.get_backend().setup()
+    for m in loaded:
+      total = search.index_model(m)
+      if verbosity >= 1:
+        sys.stdout.write("%s: %d comment(s) indexed for search\n" % (m._meta, total))
+
+class Command(BaseCommand):
+  """
+  Load comments written by swcomments_export.  Rows are inserted with bulk_create, in batches
+  of --batch-size per model (one transaction per batch), keeping their ids.  Since this skips
+  save() and the signals, derived data is then recomputed with set-based passes: object_id
+  while loading, then stacks (swcomments_build_stacks), answer counts
+  (swcomments_rebuild_answers), rating aggregates (swcomments_rebuild_ratings) and, if enabled,
+  counters (swcomments_rebuild_counts) and the search index (search.index_model, for the
+  models loaded only).
+  """
+  args = '[input file]'
+  help = 'Imports comments from a JSON Lines file (or stdin) written by swcomments_export.'
+  option_list = BaseCommand.option_list + (
+    make_option('--batch-size', type='int', dest='batch_size', default=500,
+                help='Number of comments inserted per query (default 500).'),
+    make_option('--skip-derived', action='store_false', dest='derived', default=True,
+                help='Do not recompute stacks, answer counts, rating aggregates, counters and search index after loading.'),
+  )
+
+  def handle(self, *args, **options):
+    verbosity = int(options.get('verbosity', 1))
+    if len(args) > 1:
+      raise CommandError('Only one input file can be given')
+    input = args and args[0] != '-' and open(args[0]) or sys.stdin
+
+    self.batch_size = options['batch_size']
+    self.verbosity = verbosity
+    self.batches = {}
+    self.fields = {}
+    self.loaded = {}
+    self.start = time.time()
+    self.total = 0
+    allowed = comment_models()
+    try:
+      for n, line in enumerate(input):
+        line = line.strip()
+        if not line:
+          continue
+        try:
+          data = simplejson.loads(line)
+          model = get_model(*data['model'].split(".", 1))
+        except (ValueError, KeyError), e:
+          raise CommandError('Line %d: invalid comment (%s)' % (n + 1, e))
+        if model not in allowed:
+          raise CommandError('Line %d: unknown comment model %s' % (n + 1, data['model']))
+        self.add(model, data['pk'], data['fields'])
+      for model in self.batches.keys():
+        self.flush(model)
+    finally:
+      if input is not sys.stdin:
+        input.close()
+
+    reset_sequences(self.loaded.keys())
+    if verbosity >= 1:
+      for model, total in self.loaded.items():
+        self.stdout.write("%s: %d comment(s) loaded\n" % (model._meta, total))
+      self.report()
+
+    if options['derived'] and self.loaded:
+      rebuild_derived(self.loaded.keys(), verbosity)
+
+  def add(self, model, pk, data):
+    if model not in self.fields:
+      self.fields[model] = [ f for f in export_fields(model) if f.attname != 'id' ]
+    obj = model(id=pk)
+    for f in self.fields[model]:
+      if f.attname in data:
+        value = data[f.attname]
+        if value is not None and not f.rel:
+          value = f.to_python(value)
+        setattr(obj, f.attname, value)
+    obj.object_id = models.object_key(obj.object_pk)
+    batch = self.batches.setdefault(model, [])
+    batch.append(obj)
+    if len(batch) >= self.batch_size:
+      self.flush(model)
+
+  @transaction.commit_on_success
+  def flush(self, model):
+    batch = self.batches.pop(model, [])
+    if not batch:
+      return
+    bulk_create(model, batch)
+    for site_id, ct_id, object_pk in set([ (c.site_id, c.content_type_id, c.object_pk) for c in batch ]):
+      models.CommentVersion.bump(model, site_id, ct_id, object_pk)
+    self.loaded[model] = self.loaded.get(model, 0) + len(batch)
+    self.total += len(batch)
+    if self.verbosity >= 2:
+      self.report()
+
+  def report(self):
+    elapsed = max(time.time() - self.start, 0.001)
+    self.stderr.write("%d comment(s) loaded in %.1fs (%.0f/s)\n" % (self.total, elapsed, self.total / elapsed))
+
@@ -0,0 +1,74 @@
+import csv
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models as dbmodels
+
+from swcomments import analytics, models, ratings
+
+class Command(BaseCommand):
+  """
+  Write rating statistics (see swcomments.analytics) as CSV: one row per rated object, or per
+  day/week/month, with count, mean, stddev, min, max, percentiles and histogram buckets.
+  """
+  args = '[app_label.model]'
+  help = 'Writes rating statistics per object or per period as CSV (to a file or stdout).'
+  option_list = BaseCommand.option_list + (
+    make_option('--by', dest='by', default='object',
+                help='Group ratings by object (default), day, week or month.'),
+    make_option('--output', dest='output', default='-',
+                help='CSV file to write (default stdout).'),
+    make_option('--percentiles', dest='percentiles', default=",".join(map(str, analytics.PERCENTILES)),
+                help='Comma-separated percentiles to compute (default %s).' % (",".join(map(str, analytics.PERCENTILES)),)),
+    make_option('--chunk-size', type='int', dest='chunk_size', default=analytics.CHUNK_SIZE,
+                help='Number of ratings read per query (default %d).' % (analytics.CHUNK_SIZE,)),
+  )
+
+  def handle(self, *labels, **options):
+    verbosity = int(options.get('verbosity', 1))
+    if not ratings.ratings_available():
+      raise CommandError("Rating comments are not available (djangoratings is not installed)")
+    if len(labels) > 1:
+      raise CommandError('Only one rating comment model can be given')
+    label = labels and labels[0] or 'RatingComment'
+    if '.' in label:
+      model_class = dbmodels.get_model(*label.lower().split(".", 1))
+    else:
+      model_class = dbmodels.get_model('swcomments', label.lower())
+    if model_class is None or not ratings.is_rating_model(model_class):
+      raise CommandError("Unknown rating comment model: %s" % (label,))
+
+    by = options['by']
+    if by != 'object' and by not in analytics.PERIODS:
+      raise CommandError("--by must be one of: object, %s" % (", ".join(analytics.PERIODS),))
+    try:
+      percentiles = [ float(p) for p in options['percentiles'].split(",") if p.strip() ]
+    except ValueError:
+      raise CommandError("Invalid percentiles: %s" % (options['percentiles'],))
+    percentiles = [ int(p) == p and int(p) or p for p in percentiles ]
+
+    start = time.time()
+    if by == 'object':
+      results = analytics.stats_by_object(model_class, percentiles=percentiles, chunk_size=options['chunk_size'])
+      columns = [ 'content_type', 'object_pk' ]
+    else:
+      results = analytics.stats_by_period(model_class, by, percentiles=percentiles, chunk_size=options['chunk_size'])
+      columns = [ 'period' ]
+    columns += [ 'count', 'mean', 'stddev', 'min', 'max' ] + [ 'p%s' % (p,) for p in percentiles ]
+    buckets = [ '%(low)s-%(high)s' % b for b in models.RatingAggregate().distribution ]
+
+    out = options['output'] != '-' and open(options['output'], 'wb') or sys.stdout
+    try:
+      writer = csv.writer(out)
+      writer.writerow(columns + buckets)
+      for d in results:
+        writer.writerow([ unicode(d[c]).encode('utf-8') for c in columns ] + d['histogram'])
+    finally:
+      if out is not sys.stdout:
+        out.close()
+
+    if verbosity >= 1:
+      self.stderr.write("%s: %d row(s) written in %.1fs (%s)\n" % (model_class._meta, len(results), time.time() - start,
+                                                                    analytics.numpy_enabled() and 'numpy' or 'python'))
@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max
+
+from swcomments import models
+from swcomments.management import comment_models, add_missing_columns, create_indexes
+
+class Command(BaseCommand):
+  """
+  Recompute answer_count and last_answer_date of all questions (QA comment models) from
+  their active answers.
+  """
+  help = 'Rebuilds the answer counts of QA comment questions.'
+  option_list = BaseCommand.option_list + (
+    make_option('--schema', action='store_true', dest='schema', default=False,
+                help='Add the answer_count/last_answer_date columns and indexes to existing tables first.'),
+  )
+
+  def handle(self, *args, **options):
+    verbosity = int(options.get('verbosity', 1))
+    for m in comment_models():
+      if not issubclass(m, models.BaseQAComment):
+        continue
+      if options['schema']:
+        add_missing_columns(m, verbosity, self.stdout)
+        create_indexes(m, verbosity, self.stdout)
+      total = self.rebuild(m)
+      if verbosity >= 1:
+        self.stdout.write("%s: %d question(s) updated\n" % (m._meta, total))
+
+  @transaction.commit_on_success
+  def rebuild(self, model):
+    # One GROUP BY over the answers, then only touch questions whose data changed
+    qs = model._base_manager
+    stats = qs.filter(comment_type=model.COMMENTTYPE_ANSWER, status=model.STATUS_ACTIVE, question__isnull=False)  \
+        .values('question')  \
+        .annotate(count=Count('id'), last=Max('submit_date'))  \
+        .order_by()
+    stats = dict([ (s['question'], (s['count'], s['last'])) for s in stats ])
+    total = 0
+    current = qs.filter(comment_type=model.COMMENTTYPE_QUESTION).values_list('id', 'answer_count', 'last_answer_date')
+    for id, count, last in current.iterator():
+      data = stats.get(id, (0, None))
+      if (count, last) != data:
+        qs.filter(pk=id).update(answer_count=data[0], last_answer_date=data[1])
+        total += 1
+    return total
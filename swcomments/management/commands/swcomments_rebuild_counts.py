@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models as dbmodels
+
+from swcomments import models, counters
+
+class Command(BaseCommand):
+  """
+  Reconcile the denormalized comment counter table (swcomments.CommentCount) with the
+  comment tables.
+  """
+  args = '[app_label.model ...]'
+  help = 'Recounts all comment counters (optionally only for the given comment models).'
+  option_list = BaseCommand.option_list + (
+    make_option('--create', action='store_true', dest='create', default=False,
+                help='Also create default counters for every object that has comments.'),
+  )
+
+  def handle(self, *labels, **options):
+    model_classes = []
+    for label in labels:
+      if '.' in label:
+        m = dbmodels.get_model(*label.lower().split(".", 1))
+      else:
+        m = dbmodels.get_model('swcomments', label.lower())
+      if m is None or not issubclass(m, models.BaseComment):
+        raise CommandError("Unknown comment model: %s" % (label,))
+      model_classes.append(m)
+
+    changed = 0
+    if not model_classes:
+      changed += counters.rebuild_counts()
+      if options['create']:
+        model_classes = [ m for m in dbmodels.get_models() if issubclass(m, models.BaseComment) ]
+    else:
+      for m in model_classes:
+        changed += counters.rebuild_counts(m)
+    if options['create']:
+      for m in model_classes:
+        changed += counters.create_counts(m)
+
+    self.stdout.write("%d comment counter(s) updated\n" % (changed,))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models as dbmodels, transaction
+
+from swcomments import ratings
+from swcomments.management import comment_models
+
+class Command(BaseCommand):
+  """
+  Reconcile the denormalized rating aggregate table (swcomments.RatingAggregate) with the
+  rating comment tables.
+  """
+  args = '[app_label.model ...]'
+  help = 'Recomputes all rating aggregates (optionally only for the given rating comment models).'
+
+  def handle(self, *labels, **options):
+    verbosity = int(options.get('verbosity', 1))
+    if not ratings.ratings_available():
+      raise CommandError("Rating comments are not available (djangoratings is not installed)")
+    model_classes = []
+    for label in labels:
+      if '.' in label:
+        m = dbmodels.get_model(*label.lower().split(".", 1))
+      else:
+        m = dbmodels.get_model('swcomments', label.lower())
+      if m is None or not ratings.is_rating_model(m):
+        raise CommandError("Unknown rating comment model: %s" % (label,))
+      model_classes.append(m)
+    if not model_classes:
+      model_classes = [ m for m in comment_models() if ratings.is_rating_model(m) ]
+
+    for m in model_classes:
+      changed = self.rebuild(m)
+      if verbosity >= 1:
+        self.stdout.write("%s: %d rating aggregate(s) updated\n" % (m._meta, changed))
+
+  @transaction.commit_on_success
+  def rebuild(self, model):
+    return ratings.rebuild_ratings(model)
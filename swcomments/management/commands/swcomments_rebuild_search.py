@@ -0,0 +1,33 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from swcomments import search
+from swcomments.management import comment_models
+
+class Command(BaseCommand):
+  """
+  Create the search index (see swcomments.search) and (re)index all active comments of all
+  comment models, in id-ordered chunks (one transaction per chunk).
+  """
+  help = 'Creates the comment search index and indexes all existing comments.'
+  option_list = BaseCommand.option_list + (
+    make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+                help='Number of comments indexed per transaction (default 500).'),
+  )
+
+  def handle(self, *args, **options):
+    verbosity = int(options.get('verbosity', 1))
+    if not search.search_enabled():
+      raise CommandError('Comment search is not enabled (settings.SWCOMMENTS_SEARCH)')
+    backend = search.get_backend()
+    backend.setup()
+    if verbosity >= 1:
+      self.stdout.write("Using the %s search backend\n" % (backend.name,))
+    for m in comment_models():
+      start = time.time()
+      total = search.index_model(m, options['chunk_size'])
+      if verbosity >= 1:
+        elapsed = max(time.time() - start, 0.001)
+        self.stdout.write("%s: %d comment(s) processed (%.0f/s)\n" % (m._meta, total, total / elapsed))
@@ -4,11 +4,18 @@ swcomments
 Defines comment models that we can use.  
 """
 
+import base64
+import copy
 import datetime
+import itertools
+import math
+import sys
 
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Q
 from django.db.models.query import QuerySet
 from django.core import validators
+from django.core.exceptions import ValidationError
 from django.contrib.auth import models as authmodels
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
@@ -16,6 +23,50 @@ from django.contrib.sites.models import Site
 
 import settings
 
+from swcomments import signals
+
+# Default and maximum number of comments per page (keyset pagination, see BaseComment.get_page)
+PAGE_LIMIT = getattr(settings, 'SWCOMMENTS_PAGE_LIMIT', 20)
+PAGE_LIMIT_MAX = getattr(settings, 'SWCOMMENTS_PAGE_LIMIT_MAX', 100)
+
+# Largest object_id (a 32-bit PositiveIntegerField); larger keys are only found by object_pk
+OBJECT_ID_MAX = 2**31 - 1
+
+# Set to True once swcomments_backfill_object_id has filled object_id for the comments saved
+# before the column was added: until then, comments without object_id are found by object_pk
+OBJECT_ID_BACKFILLED = getattr(settings, 'SWCOMMENTS_OBJECT_ID_BACKFILLED', False)
+
+def object_key(pk):
+  """Return the integer key (BaseComment.object_id) for an object primary key, or None if the
+  primary key is not an integer between 0 and OBJECT_ID_MAX."""
+  try:
+    key = int(pk)
+  except (TypeError, ValueError):
+    return None
+  if key < 0 or key > OBJECT_ID_MAX or unicode(key) != unicode(pk):
+    return None
+  return key
+
+def object_filter(pk):
+  """Return the filter (Q object) that selects comments for object primary key 'pk' (uses the
+  indexed object_id column whenever possible, see OBJECT_ID_BACKFILLED)."""
+  key = object_key(pk)
+  if key is None:
+    return Q(object_pk=unicode(pk))
+  if OBJECT_ID_BACKFILLED:
+    return Q(object_id=key)
+  return Q(object_id=key) | Q(object_id__isnull=True, object_pk=unicode(pk))
+
+def objects_filter(pks):
+  """Same as object_filter(), for a list of object primary keys."""
+  keys = [ object_key(pk) for pk in pks ]
+  pks = [ unicode(pk) for pk in pks ]
+  if None in keys:
+    return Q(object_pk__in=pks)
+  if OBJECT_ID_BACKFILLED:
+    return Q(object_id__in=keys)
+  return Q(object_id__in=keys) | Q(object_id__isnull=True, object_pk__in=pks)
+
 class BaseCommentManager(models.Manager):
   """
   Manager for all Comment models.
@@ -33,6 +84,30 @@ class BaseCommentManager(models.Manager):
       qs = qs.filter(status=BaseComment.STATUS_ACTIVE)
     return qs
 
+class ArchiveAwareManager(BaseCommentManager):
+  """
+  Manager that reads comments from both the hot table and the archive table of a comment
+  model (see make_archive_model), when explicitly asked to: all(), filter(), exclude() and
+  order_by() return an ArchiveQuerySet.  Its own queryset (used by Django internals) only
+  covers the hot table.
+  """
+  def with_archive(self):
+    archive_model = self.model.get_archive_model()
+    archive = archive_model and archive_model.objects.filter(site=settings.SITE_ID) or None
+    return ArchiveQuerySet(self.model, self.model.objects.all(), archive)
+
+  def all(self):
+    return self.with_archive()
+
+  def filter(self, *args, **kwargs):
+    return self.with_archive().filter(*args, **kwargs)
+
+  def exclude(self, *args, **kwargs):
+    return self.with_archive().exclude(*args, **kwargs)
+
+  def order_by(self, *fields):
+    return self.with_archive().order_by(*fields)
+
 class BaseComment(models.Model):
   """
   A very basic comment with the bare essentials.
@@ -54,6 +129,9 @@ class BaseComment(models.Model):
     'desc' : '-submit_date',
   }
 
+  # Managers that views may use on behalf of clients (their 'filter' parameter), default first
+  PUBLIC_MANAGERS = ('active',)
+
   status         = models.IntegerField(choices=STATUSES, default=STATUS_ACTIVE)
 
   user           = models.ForeignKey(authmodels.User, related_name="%(app_label)s_%(class)s_set")
@@ -67,16 +145,87 @@ class BaseComment(models.Model):
 
   content_type   = models.ForeignKey(ContentType, related_name="content_type_set_for_%(app_label)s_%(class)s")
   object_pk      = models.TextField()
+  object_id      = models.PositiveIntegerField(blank=True, null=True)   # object_pk as integer (indexed), if possible
   content_object = GenericForeignKey(ct_field="content_type", fk_field="object_pk")
 
   objects = BaseCommentManager()
   active = BaseCommentManager(True)
+  with_archive = ArchiveAwareManager()     # hot + archived comments (see swcomments_archive)
 
   def save(self, *args, **kwargs):
     # If we did not specify a site, use current site
     if self.site_id is None:
       self.site = Site.objects.get_current()
+    self.object_id = object_key(self.object_pk)
+    # The comment, the data derived from it and what the receivers of comment_changed store
+    # (counters, rating aggregates...) are written in one transaction
+    if transaction.is_managed():
+      self._save(*args, **kwargs)
+    else:
+      transaction.commit_on_success(self._save)(*args, **kwargs)
+
+  def _save(self, *args, **kwargs):
+    is_insert = not self.id
+    self.prepare_derived_data(is_insert)
     super(BaseComment, self).save(*args, **kwargs)
+    self.update_derived_data(is_insert)
+    CommentVersion.bump(type(self), self.site_id, self.content_type_id, self.object_pk)
+    signals.comment_changed.send(sender=self.__class__, comment=self)
+
+  def prepare_derived_data(self, is_insert):
+    """Sub-classes of BaseComment can implement this to set fields, or create data, that this
+    comment depends on (called right before the comment is saved, in the same transaction)."""
+    pass
+
+  def update_derived_data(self, is_insert):
+    """Sub-classes of BaseComment can implement this to update data that depends on this comment
+    (called right after the comment is saved, in the same transaction, before comment_changed is
+    sent)."""
+    pass
+
+  @classmethod
+  def update_bulk_derived_data(cls, ids):
+    """Same as update_derived_data, for comments 'ids' changed in bulk (see bulk_update_status)"""
+    pass
+
+  def count_scope(self):
+    """Return the filter (Q object) selecting the comments that saving or deleting this comment
+    can add to or remove from a counted queryset (see swcomments.counters): the comment itself,
+    plus the comments whose derived data it changes."""
+    return Q(pk__in=[ pk for pk in [ self.pk ] if pk is not None ])
+
+  @classmethod
+  def bulk_update_status(cls, qs, status, chunk_size=500):
+    """
+    Set the status of the comments of queryset 'qs' with set-based UPDATEs (save() is not
+    called), then update derived data (update_bulk_derived_data) and send
+    comments_bulk_changed (counters, cache...).  Returns the number of comments changed.
+    """
+    model = cls.get_nonproxy_model()
+    rows = list(qs.exclude(status=status).order_by().values_list('id', 'site', 'content_type', 'object_pk'))
+    if not rows:
+      return 0
+    ids = [ r[0] for r in rows ]
+    def update():
+      for i in range(0, len(ids), chunk_size):
+        model._base_manager.filter(id__in=ids[i:i + chunk_size]).update(status=status)
+      model.update_bulk_derived_data(ids)
+    if transaction.is_managed():
+      update()
+    else:
+      transaction.commit_on_success(update)()
+    signals.comments_bulk_changed.send(sender=model, objects=sorted(set([ r[1:] for r in rows ])), ids=ids)
+    return len(ids)
+
+  @classmethod
+  def get_indexes(cls):
+    """Return the composite indexes (tuples of field names) to create for this model (see 
+    swcomments.management).  Sub-classes can add indexes matching their managers/ordering."""
+    return [
+      ('site', 'content_type', 'object_id', 'submit_date'),
+      ('site', 'content_type', 'object_id', 'status', 'submit_date'),
+      ('status', 'submit_date'),     # admin status filter, archiving
+    ]
 
   @classmethod
   def do_thread(cls, qs):
@@ -90,6 +239,164 @@ class BaseComment(models.Model):
       raise TypeError("Parameter passed to do_count() method must be a QuerySet")
     return qs
 
+  @classmethod
+  def get_manager(cls, filter=None):
+    """Return the manager named 'filter' (eg. 'active'), or the default manager if None/unknown"""
+    if filter and isinstance(getattr(cls, filter, None), models.Manager):
+      return getattr(cls, filter)
+    return cls.objects
+
+  @classmethod
+  def get_public_manager(cls, filter=None):
+    """Return the manager named 'filter' for views serving clients: only PUBLIC_MANAGERS are
+    allowed, the first one if 'filter' is None.  Raises ValueError for any other name."""
+    if not filter:
+      filter = cls.PUBLIC_MANAGERS[0]
+    if filter not in cls.PUBLIC_MANAGERS:
+      raise ValueError('Invalid filter: %s' % (filter,))
+    return getattr(cls, filter)
+
+  @classmethod
+  def get_page_ordering(cls, order=None):
+    """Return the ordering used to page through comments: ORDER[order] if given, else the model's
+    ordering (ORDER['desc'] if it has none), with 'id' added as a tie-breaker so that every
+    comment has a unique position."""
+    if order and cls.ORDER.get(order):
+      ordering = [ cls.ORDER[order] ]
+    else:
+      ordering = list(cls._meta.ordering) or [ cls.ORDER['desc'] ]
+    if ordering[-1].lstrip('-') != 'id':
+      ordering.append(ordering[-1].startswith('-') and '-id' or 'id')
+    return ordering
+
+  @classmethod
+  def encode_cursor(cls, comment, ordering):
+    """Return the (opaque) cursor pointing right after 'comment' for 'ordering'"""
+    values = []
+    for o in ordering:
+      v = comment
+      names = o.lstrip('-').split('__')
+      for name in names[:-1]:
+        v = getattr(v, name)
+      v = getattr(v, v._meta.get_field(names[-1]).attname)
+      values.append(unicode(v).encode('utf-8'))
+    return base64.urlsafe_b64encode("|".join(values))
+
+  @classmethod
+  def decode_cursor(cls, cursor, ordering):
+    """Return the filter (Q object) selecting comments after 'cursor' for 'ordering'.
+    Raises ValueError if the cursor is invalid."""
+    try:
+      values = base64.urlsafe_b64decode(str(cursor)).decode('utf-8').split("|")
+    except (TypeError, UnicodeError):
+      raise ValueError('Invalid cursor: %s' % (cursor,))
+    if len(values) != len(ordering):
+      raise ValueError('Invalid cursor: %s' % (cursor,))
+    keys = []
+    for o, v in zip(ordering, values):
+      name = o.lstrip('-')
+      model = cls
+      for n in name.split('__')[:-1]:
+        model = model._meta.get_field(n).rel.to
+      try:
+        v = model._meta.get_field(name.split('__')[-1]).to_python(v)
+      except ValidationError:
+        raise ValueError('Invalid cursor: %s' % (cursor,))
+      keys.append((name, o.startswith('-'), v))
+    # (k1 > v1) or (k1 = v1 and k2 > v2) or ... (< for descending keys)
+    q = None
+    for i, (name, desc, v) in enumerate(keys):
+      d = dict([ (k[0], k[2]) for k in keys[:i] ])
+      d['%s__%s' % (name, desc and 'lt' or 'gt')] = v
+      q = q is None and Q(**d) or q | Q(**d)
+    return q
+
+  @classmethod
+  def get_page(cls, qs, after=None, limit=None, order=None):
+    """
+    Keyset (cursor) pagination: return a tuple (comments, next_cursor) with at most 'limit'
+    comments of queryset 'qs' that come after cursor 'after' (None for the first page).
+    next_cursor is None on the last page.  Fetching any page costs the same, no matter how
+    deep it is (no OFFSET).  Raises ValueError if 'after' is not a valid cursor.
+
+    The cursor holds the values of the ordering fields of the last comment of the page, so
+    pages are stable as long as those values do not change.  Stacked comments are ordered by
+    stack_date, which changes when a user comments again: that user's stack moves to the
+    first page, and its comments that were not reached yet are skipped by the next pages
+    (none is shown twice).  order='desc' or 'asc' (by submit_date, which never changes)
+    pages through every comment exactly once.
+    """
+    ordering = cls.get_page_ordering(order)
+    qs = qs.order_by(*ordering)
+    if after:
+      qs = qs.filter(cls.decode_cursor(after, ordering))
+    limit = max(1, min(limit or PAGE_LIMIT, PAGE_LIMIT_MAX))
+    comments = list(qs[:limit + 1])
+    if len(comments) <= limit:
+      return comments, None
+    comments = comments[:limit]
+    return comments, cls.encode_cursor(comments[-1], ordering)
+
+  def as_dict(self):
+    """Return a dict of the public data of this comment (suitable for JSON).  Sub-classes can
+    override this method and add to the dictionary."""
+    return dict(
+      id = self.id,
+      status = self.status,
+      user = self.user_id and self.user.username or None,
+      submit_date = self.submit_date and self.submit_date.isoformat() or None,
+      title = self.title,
+      comment = self.comment,
+    )
+
+  @classmethod
+  def prefetch_content_objects(cls, comments, objects=None):
+    """Fill the content_object cache of a list of comments so that accessing comment.content_object
+    does not hit the database.  If 'objects' (a list of model instances) is passed, those are
+    used; otherwise objects are fetched in bulk (one query per content type).  Returns 'comments'."""
+    comments = list(comments)
+    if not comments:
+      return comments
+    found = {}
+    if objects is not None:
+      for o in objects:
+        found[(ContentType.objects.get_for_model(o).id, unicode(o.pk))] = o
+    else:
+      by_ct = {}
+      for c in comments:
+        by_ct.setdefault(c.content_type_id, set()).add(c.object_pk)
+      for ct_id, pks in by_ct.items():
+        ct = ContentType.objects.get_for_id(ct_id)
+        for o in ct.model_class()._default_manager.filter(pk__in=pks):
+          found[(ct_id, unicode(o.pk))] = o
+    cache_attr = type(comments[0]).content_object.cache_attr
+    for c in comments:
+      o = found.get((c.content_type_id, unicode(c.object_pk)))
+      if o is not None:
+        setattr(c, cache_attr, o)
+    return comments
+
+  @classmethod
+  def get_counts(cls, objects, filter=None):
+    """Return a dict of object -> number of comments (as counted by do_count) for a list/queryset
+    of objects (all of the same model), using a single GROUP BY query.  'filter' is the name of
+    the manager to use (default manager if None)."""
+    o_list = list(objects)
+    if not o_list:
+      return {}
+    qs = cls.get_manager(filter)
+    ct = ContentType.objects.get_for_model(o_list[0])
+    qs = qs.filter(objects_filter([ o.pk for o in o_list ]), content_type=ct)
+    qs = cls.do_count(qs).order_by()
+    counts = {}
+    if qs.query.aggregates:
+      # Manager already groups (eg. annotate/filter on a count): can't regroup, count rows here
+      for pk in qs.values_list('object_pk', flat=True):
+        counts[pk] = counts.get(pk, 0) + 1
+    else:
+      counts = dict(qs.values_list('object_pk').annotate(num=models.Count('id')))
+    return dict([ (o, counts.get(unicode(o.pk), 0)) for o in o_list ])
+
   @classmethod
   def get_form_class(cls):
     """Comment models are responsible for telling django what form is associated with them.
@@ -100,15 +407,25 @@ class BaseComment(models.Model):
     raise NotImplementedError("No form has been defined for class '%s'" % (cls.__name__,))
 
   @classmethod
-  def get_nonproxy_model_name(cls):
-    """Return the app_label and model name of the first non-proxy comment model that is associated 
-    with this model (useful for template loading)"""
+  def get_archive_model(cls):
+    """Return the archive model of this comment model (None if it has none)"""
+    return ARCHIVE_MODELS.get(cls.get_nonproxy_model())
+
+  @classmethod
+  def get_nonproxy_model(cls):
+    """Return the first non-proxy comment model that is associated with this model"""
     m = cls
     while m._meta.proxy:
       m = m._meta.proxy_for_model
     if not issubclass(m, BaseComment):
       raise TypeError('Model has no non-proxy super class: %s' % (m.__name__,))
-    ct = ContentType.objects.get_for_model(m)
+    return m
+
+  @classmethod
+  def get_nonproxy_model_name(cls):
+    """Return the app_label and model name of the first non-proxy comment model that is associated 
+    with this model (useful for template loading)"""
+    ct = ContentType.objects.get_for_model(cls.get_nonproxy_model())
     return ct.app_label, ct.model
 
   class Meta:
@@ -133,6 +450,14 @@ class BaseAnonComment(BaseComment):
     # This model is meant to be inherited
     abstract = True
 
+  def as_dict(self):
+    d = super(BaseAnonComment, self).as_dict()
+    d.update(dict(
+      user_name = self.user_name,
+      user_url = self.user_url,
+    ))
+    return d
+
 class AnonComment(BaseAnonComment):
   """Actual Anonymous Comment"""
 
@@ -140,6 +465,9 @@ class AnonComment(BaseAnonComment):
 # QA Comment
 #
 
+# Number of questions whose answers are fetched with one query when threading a queryset
+THREAD_CHUNK_SIZE = getattr(settings, 'SWCOMMENTS_THREAD_CHUNK_SIZE', 100)
+
 class BaseQACommentManager(BaseCommentManager):
   """
   Manager for all QAComment models (and descendants).
@@ -153,7 +481,7 @@ class BaseQACommentManager(BaseCommentManager):
   def get_query_set(self):
     qs = super(BaseQACommentManager, self).get_query_set()
     if self.__whichtype is not None: qs = qs.filter(comment_type=self.__whichtype)
-    if self.__unansweredonly: qs = qs.annotate(num_answers=models.Count('answers')).filter(num_answers=0)
+    if self.__unansweredonly: qs = qs.filter(answer_count=0)
     return qs
   #def questions(self):
   #  return self.active().get_query_set().filter(comment_type=BaseQAComment.COMMENTTYPE_QUESTION)
@@ -174,11 +502,73 @@ class BaseQAComment(BaseAnonComment):
   comment_type = models.IntegerField(choices=COMMENTTYPES, default=COMMENTTYPE_QUESTION)
   question = models.ForeignKey("QAComment", related_name="answers", blank=True, null=True)
 
+  # Maintained on questions (see update_answer_data): number of active answers and date of the latest one
+  answer_count = models.PositiveIntegerField(default=0, editable=False)
+  last_answer_date = models.DateTimeField(blank=True, null=True, editable=False)
+
   objects = BaseQACommentManager()
   active = BaseQACommentManager(activeonly=True)
 
+  def __init__(self, *args, **kwargs):
+    super(BaseQAComment, self).__init__(*args, **kwargs)
+    # Question this comment was an answer to when loaded/last saved (see update_derived_data);
+    # read from __dict__ so that deferred fields are not loaded
+    d = self.__dict__
+    self._saved_question_id = d.get('comment_type') == self.COMMENTTYPE_ANSWER and d.get('question_id') or None
+
+  def answered_question_id(self):
+    """Return the id of the question this comment answers (None if it is not an answer)"""
+    return self.is_answer() and self.question_id or None
+
+  def count_scope(self):
+    # The questions answered before and after the change ('unanswered' depends on answer_count)
+    ids = set([ self.pk, self._saved_question_id, self.answered_question_id() ]) - set([ None ])
+    return Q(pk__in=sorted(ids))
+
+  def update_derived_data(self, is_insert):
+    super(BaseQAComment, self).update_derived_data(is_insert)
+    # Both the question answered before (if the answer was moved or turned into a question) and
+    # the one answered now, whose counts also depend on the answer's status
+    question_id = self.answered_question_id()
+    for q in sorted(set([ self._saved_question_id, question_id ]) - set([ None ])):
+      self.update_answer_data(q)
+    self._saved_question_id = question_id
+
+  @classmethod
+  def update_bulk_derived_data(cls, ids):
+    super(BaseQAComment, cls).update_bulk_derived_data(ids)
+    qs = cls.get_nonproxy_model()._base_manager
+    questions = set()
+    for i in range(0, len(ids), 500):
+      questions.update(qs.filter(id__in=ids[i:i + 500], comment_type=cls.COMMENTTYPE_ANSWER, question__isnull=False)
+                         .values_list('question', flat=True))
+    for question_id in questions:
+      cls.update_answer_data(question_id)
+
+  @classmethod
+  def update_answer_data(cls, question_id):
+    """Recompute answer_count and last_answer_date of a question from its active answers.  The
+    question row is locked first so that concurrent answers are all counted."""
+    qs = cls.get_nonproxy_model()._base_manager
+    def update():
+      list(qs.select_for_update().filter(pk=question_id).values_list('id'))
+      stats = qs.filter(question=question_id, comment_type=cls.COMMENTTYPE_ANSWER, status=cls.STATUS_ACTIVE)  \
+          .aggregate(count=models.Count('id'), last=models.Max('submit_date'))
+      qs.filter(pk=question_id).update(answer_count=stats['count'], last_answer_date=stats['last'])
+    if transaction.is_managed():
+      update()
+    else:
+      transaction.commit_on_success(update)()
+
+  @classmethod
+  def get_indexes(cls):
+    return super(BaseQAComment, cls).get_indexes() + [
+      ('site', 'content_type', 'object_id', 'status', 'comment_type', 'submit_date'),
+      ('site', 'content_type', 'object_id', 'status', 'comment_type', 'answer_count'),
+    ]
+
   def is_answered(self):
-    return self.answers.count() > 0
+    return self.answer_count > 0
 
   def is_question(self):
     return self.comment_type == self.COMMENTTYPE_QUESTION
@@ -189,24 +579,72 @@ class BaseQAComment(BaseAnonComment):
   def __unicode__(self):
     return 'QAComment: %s (id# %s)' % (self.title or '-no title-', self.id)
 
+  def as_dict(self):
+    d = super(BaseQAComment, self).as_dict()
+    d.update(dict(
+      comment_type = self.comment_type,
+      question_id = self.question_id,
+      answer_count = self.answer_count,
+      last_answer_date = self.last_answer_date and self.last_answer_date.isoformat() or None,
+    ))
+    return d
+
   @classmethod
   def do_thread(cls, qs):
     """Given a queryset (or any sequence, really) of QAComment objects, "thread" it (ie.
-    sort them by question and answer per question) and return a sequence."""
+    sort them by question and answer per question) and return an iterator.  Querysets are
+    streamed (see iter_queryset_thread), other sequences are threaded in memory (see iter_thread)."""
     qs = super(BaseQAComment, cls).do_thread(qs)
-    cl = list(qs)
-    ql = [ c for c in cl if c.is_question() ]
+    if isinstance(qs, QuerySet) and qs.query.can_filter():
+      return cls.iter_queryset_thread(qs)
+    return cls.iter_thread(qs)
+
+  @classmethod
+  def iter_thread(cls, qs):
+    """Generator version of do_thread for a list (or a sliced queryset): reads 'qs' once, then
+    yields each question followed by its answers (oldest first).  Answers are grouped on
+    question_id, so no question is loaded from the database."""
+    ql = []
     ad = {}
-    for a in [ c for c in cl if c.is_answer() ]:
-      if a.question not in ad:
-        ad[a.question] = [a]
-      else:
-        ad[a.question].append(a)
-    tl = []
+    for c in qs:
+      if c.is_question():
+        ql.append(c)
+      elif c.question_id is not None:
+        ad.setdefault(c.question_id, []).append(c)
     for q in ql:
-      tl.append(q)
-      if q in ad: tl.extend(ad[q])
-    return tl
+      yield q
+      answers = ad.pop(q.id, None)
+      if answers:
+        answers.sort(key=lambda a: (a.submit_date, a.id))
+        for a in answers:
+          yield a
+
+  @classmethod
+  def iter_queryset_thread(cls, qs, chunk_size=THREAD_CHUNK_SIZE):
+    """Generator version of do_thread for a queryset: the questions of 'qs' are streamed
+    (iterator(), in the queryset's order) and the answers of each 'chunk_size' questions are
+    fetched with one query (oldest first), so that at most one chunk is held in memory."""
+    questions = qs.filter(comment_type=cls.COMMENTTYPE_QUESTION).iterator()
+    while True:
+      ql = list(itertools.islice(questions, chunk_size))
+      if not ql:
+        break
+      ad = {}
+      answers = qs.filter(comment_type=cls.COMMENTTYPE_ANSWER, question__in=[ q.id for q in ql ])  \
+          .order_by('question', 'submit_date', 'id')
+      for a in answers:
+        ad.setdefault(a.question_id, []).append(a)
+      for q in ql:
+        yield q
+        for a in ad.pop(q.id, ()):
+          yield a
+
+  @classmethod
+  def thread_for_object(cls, o, filter=None):
+    """Return an iterator over the threaded questions/answers for object 'o' (see
+    iter_queryset_thread).  'filter' is the name of the manager to use (default manager if None)."""
+    ct = ContentType.objects.get_for_model(o)
+    return cls.do_thread(cls.get_manager(filter).filter(object_filter(o.pk), content_type=ct))
 
   class Meta:
     # This model is meant to be inherited
@@ -216,6 +654,13 @@ class BaseQAComment(BaseAnonComment):
 class QAComment(BaseQAComment):
   """Actual QA Comment Model"""
 
+def _qacomment_deleted(sender, instance, **kwargs):
+  # Deleted answers no longer count for their question
+  if isinstance(instance, BaseQAComment) and instance.is_answer() and instance.question_id:
+    instance.update_answer_data(instance.question_id)
+
+models.signals.post_delete.connect(_qacomment_deleted)
+
 class QuestionComment(QAComment):
   """
   Proxy model that automatically sets type to 'Question'.  
@@ -224,10 +669,19 @@ class QuestionComment(QAComment):
   objects = BaseQACommentManager(activeonly=True, whichtype=QAComment.COMMENTTYPE_QUESTION)
   unanswered = BaseQACommentManager(activeonly=True, whichtype=QAComment.COMMENTTYPE_QUESTION, unansweredonly=True)
 
+  # 'active' (inherited from QAComment) would include answers
+  PUBLIC_MANAGERS = ('objects', 'unanswered')
+
   def save(self, *args, **kwargs):
     self.comment_type = self.COMMENTTYPE_QUESTION
     super(QAComment, self).save(*args, **kwargs)
 
+  @classmethod
+  def get_unanswered_counts(cls, objects):
+    """Return a dict of object -> number of active unanswered questions, for a list/queryset of
+    objects (a single GROUP BY query over the answer_count index)."""
+    return cls.get_counts(objects, 'unanswered')
+
   class Meta:
     # This model is just a proxy over QAComment
     proxy = True
@@ -239,6 +693,7 @@ class AnswerComment(QAComment):
   """
 
   objects = BaseQACommentManager(activeonly=True, whichtype=QAComment.COMMENTTYPE_ANSWER)
+  PUBLIC_MANAGERS = ('objects',)
 
   def save(self, *args, **kwargs):
     self.comment_type = self.COMMENTTYPE_ANSWER
@@ -252,28 +707,96 @@ class AnswerComment(QAComment):
 # StackedComment
 #
 
+class CommentStack(models.Model):
+  """
+  The 'stack' of a user's comments on an object: there is one row per comment model
+  ('app_label.model' of the non-proxy model), site, content object and user, holding the
+  date of the latest comment (stack_date).  Stacked comments point to their stack, and
+  keep a copy of its date for ordering and counting.
+  """
+  comment_model  = models.CharField(max_length=100)
+  site           = models.ForeignKey(Site, related_name="swcomments_commentstack_set")
+  user           = models.ForeignKey(authmodels.User, related_name="swcomments_commentstack_set")
+  content_type   = models.ForeignKey(ContentType, related_name="swcomments_commentstack_set")
+  object_pk      = models.CharField(max_length=255)
+  object_id      = models.PositiveIntegerField(blank=True, null=True)
+  stack_date     = models.DateTimeField(db_index=True)
+
+  def __unicode__(self):
+    return 'CommentStack: %s by %s on %s #%s' % (self.comment_model, self.user_id, self.content_type_id, self.object_pk)
+
+  @classmethod
+  def get_for_comment(cls, comment):
+    """Return the stack 'comment' belongs to (created if it doesn't exist yet)"""
+    stack, created = cls.objects.get_or_create(
+      comment_model = str(comment.get_nonproxy_model()._meta),
+      site = comment.site,
+      user = comment.user,
+      content_type = comment.content_type,
+      object_pk = unicode(comment.object_pk),
+      defaults = dict(
+        object_id = object_key(comment.object_pk),
+        stack_date = comment.submit_date or datetime.datetime.now(),
+      ))
+    return stack
+
+  class Meta:
+    unique_together = [ ('comment_model', 'site', 'content_type', 'object_pk', 'user') ]
+
 class BaseStackedComment(models.Model):
   """
   A stacked comment is where a user's multiple comments will 'stack' together.
   Its not really meant as a "conversation" style, as you can't reply to someone else.
-  It uses a 'stackdate' variable to allow retrieving of comments by 'stack' (sorted 
-  by 'stackdate' rather than by date).
+  Each comment points to its stack (CommentStack, ie. user/content_object), whose 
+  'stack_date' is the date of the user's latest comment.  Comments keep a copy of it, 
+  which allows retrieving of comments by 'stack' (sorted by 'stack_date' rather than by 
+  date) from the comment table's indexes alone.
   """
 
-  stack_date = models.DateTimeField(auto_now_add=True)
+  stack = models.ForeignKey(CommentStack, related_name="%(app_label)s_%(class)s_set", blank=True, null=True)
+  stack_date = models.DateTimeField(blank=True, null=True)
 
-  def save(self, *args, **kwargs):
-    is_insert = not self.id
-    super(BaseStackedComment, self).save(*args, **kwargs)
-    # On insert, update all comments in this "stack" (ie user/content_object) to have same stack_date
+  def prepare_derived_data(self, is_insert):
+    super(BaseStackedComment, self).prepare_derived_data(is_insert)
     if is_insert:
-      self.__class__.objects  \
-          .filter(user=self.user, content_type=self.content_type, object_pk=self.object_pk)  \
-          .update(stack_date=self.submit_date)
+      if self.stack_id is None:
+        self.stack = CommentStack.get_for_comment(self)
+      self.stack_date = self.submit_date or datetime.datetime.now()
+
+  def update_derived_data(self, is_insert):
+    super(BaseStackedComment, self).update_derived_data(is_insert)
+    # On insert, this comment is the latest of its stack: the stack row is updated first (it
+    # serializes concurrent posts to the stack), then the stack's comments through their index
+    if is_insert:
+      CommentStack.objects.filter(pk=self.stack_id).update(stack_date=self.submit_date)
+      self.__class__._base_manager.filter(stack=self.stack_id).update(stack_date=self.submit_date)
+      self.stack.stack_date = self.stack_date = self.submit_date
+
+  @classmethod
+  def get_indexes(cls):
+    return super(BaseStackedComment, cls).get_indexes() + [
+      ('site', 'content_type', 'object_id', 'stack_date', 'user', 'submit_date'),
+      ('site', 'content_type', 'object_id', 'status', 'stack_date', 'user', 'submit_date'),
+      ('stack', 'submit_date'),     # restacking on insert
+    ]
+
+  def count_scope(self):
+    # The whole stack: a new comment becomes its top
+    scope = super(BaseStackedComment, self).count_scope()
+    if self.stack_id is not None:
+      scope = scope | Q(stack=self.stack_id)
+    return scope
 
   def is_top(self):
     return self.stack_date is not None and self.stack_date == self.submit_date
 
+  def as_dict(self):
+    d = super(BaseStackedComment, self).as_dict()
+    d.update(dict(
+      stack_date = self.stack_date and self.stack_date.isoformat() or None,
+    ))
+    return d
+
   @classmethod
   def do_count(cls, qs):
     """
@@ -281,32 +804,59 @@ class BaseStackedComment(models.Model):
     Logically there should be exactly one stack per user per content_object...
     """
     qs = super(BaseStackedComment, cls).do_count(qs)
-    qs = qs.extra(where=['stack_date = submit_date'])
+    # A plain condition rather than F('stack_date'): the F() expression makes every clone of
+    # the queryset (count(), slicing...) deep-copy the query it refers to, which is slow
+    table = connection.ops.quote_name(cls._meta.db_table)
+    qs = qs.extra(where=[ '%s.submit_date = %s.stack_date' % (table, table) ])
     return qs
 
   @classmethod
   def do_thread(cls, qs):
     """
+    Given a queryset (or any sequence) of stacked comments in stack order, yield the top of
+    each stack with the rest of the stack in its 'others' attribute.  Querysets are read in
+    chunks with iterator() and comments are grouped on user_id/stack_id, so the whole list is
+    never held in memory and no user is loaded.
     """
-    comments = list(qs)
-    count = len(comments)
-    idx = 0
-    while idx < count:
-      top = comments[idx]
-      top.others = []
-      idx += 1
-      while idx < count:
-        c = comments[idx]
-        if c.user != top.user:
-          break
+    if isinstance(qs, QuerySet):
+      qs = qs.iterator()
+    top = None
+    for c in qs:
+      if top is not None and (c.user_id, c.stack_id) == (top.user_id, top.stack_id):
         top.others.append(c)
-        idx += 1
+        continue
+      if top is not None:
+        yield top
+      top = c
+      top.others = []
+    if top is not None:
       yield top
 
+  @classmethod
+  def get_tops(cls, qs):
+    """
+    Return the list of stack tops of queryset 'qs' (in its order), each with an 'others_count'
+    attribute: the number of other comments of 'qs' in its stack (for "and N more" displays).
+    Uses two queries, whatever the size of the stacks.  'qs' can also be a list of comments
+    (eg. a cached or paged list), which is used as is.
+    """
+    if not isinstance(qs, QuerySet):
+      comments = list(qs)
+      counts = {}
+      for c in comments:
+        counts[c.stack_id] = counts.get(c.stack_id, 0) + 1
+      tops = [ c for c in comments if c.is_top() ]
+    else:
+      counts = dict(qs.order_by().values_list('stack').annotate(num=models.Count('id')))
+      tops = list(cls.do_count(qs))
+    for t in tops:
+      t.others_count = counts.get(t.stack_id, 1) - 1
+    return tops
+
   class Meta:
     # This model is meant to be inherited
     abstract = True
-    ordering = [ '-stack_date', 'user', '-submit_date' ]
+    ordering = [ '-stack_date', '-user', '-submit_date' ]
 
 class StackedComment(BaseStackedComment, BaseComment):
   """Actual Stacked Comment Model"""
@@ -338,6 +888,13 @@ if 'djangoratings' in settings.INSTALLED_APPS:
                 validators=[rating_vmin, rating_vmax])
     rated = RatingField(range=2)                  # Rating on the comment itself.
 
+    def as_dict(self):
+      d = super(BaseRatingComment, self).as_dict()
+      d.update(dict(
+        score = self.score,
+      ))
+      return d
+
     class Meta:
       # This model is meant to be inherited
       abstract = True
@@ -351,10 +908,470 @@ if 'djangoratings' in settings.INSTALLED_APPS:
     class Meta(BaseStackedComment.Meta):
       pass
 
+  # Number of histogram buckets of rating aggregates (scores 0-RATING_RANGE are split evenly)
+  RATING_BUCKETS = getattr(settings, 'SWCOMMENTS_RATING_BUCKETS', min(RATING_RANGE + 1, 10))
+  if not isinstance(RATING_BUCKETS, int) or not 0 < RATING_BUCKETS <= RATING_RANGE + 1:
+    raise TypeError('settings.SWCOMMENTS_RATING_BUCKETS must be an integer between 1 and SWCOMMENTS_RATING_RANGE + 1')
+
+  # Prior of the Bayesian-adjusted score: mean rating, and how many ratings it is worth
+  RATING_PRIOR_MEAN = getattr(settings, 'SWCOMMENTS_RATING_PRIOR_MEAN', RATING_RANGE / 2.0)
+  RATING_PRIOR_WEIGHT = getattr(settings, 'SWCOMMENTS_RATING_PRIOR_WEIGHT', 5)
+
+  def rating_bucket(score):
+    """Return the histogram bucket (0 to RATING_BUCKETS - 1) of rating 'score'"""
+    return score * RATING_BUCKETS // (RATING_RANGE + 1)
+
+  class RatingAggregate(models.Model):
+    """
+    Denormalized ratings of one object: number of ratings, their sum and sum of squares, and
+    a histogram (RATING_BUCKETS comma-separated counts).  There is one row per rating comment
+    model ('app_label.model'), site and content object; only active comments count (and only
+    the latest rating of each stack for stacked models, like do_count).
+    Rows are created on first read and kept up to date by swcomments.ratings.
+    """
+    comment_model  = models.CharField(max_length=100)
+    site           = models.ForeignKey(Site, related_name="swcomments_ratingaggregate_set")
+    content_type   = models.ForeignKey(ContentType, related_name="swcomments_ratingaggregate_set")
+    object_pk      = models.CharField(max_length=255)
+    count          = models.PositiveIntegerField(default=0)
+    total          = models.BigIntegerField(default=0)
+    total_squares  = models.BigIntegerField(default=0)
+    histogram      = models.TextField(blank=True, default='')
+
+    def get_histogram(self):
+      """Return the list of the number of ratings in each bucket"""
+      h = [ int(n) for n in self.histogram.split(",") if n ]
+      if len(h) != RATING_BUCKETS:
+        return [ 0 ] * RATING_BUCKETS
+      return h
+
+    def set_histogram(self, h):
+      self.histogram = ",".join([ str(n) for n in h ])
+
+    @property
+    def average(self):
+      """Mean rating (None if there is no rating)"""
+      if not self.count:
+        return None
+      return float(self.total) / self.count
+
+    @property
+    def stddev(self):
+      """Standard deviation of the ratings (None if there is no rating)"""
+      if not self.count:
+        return None
+      mean = float(self.total) / self.count
+      return math.sqrt(max(float(self.total_squares) / self.count - mean * mean, 0))
+
+    @property
+    def distribution(self):
+      """List of { low, high, count, percent } dicts, one per histogram bucket"""
+      d = []
+      for b, n in enumerate(self.get_histogram()):
+        low = -(-b * (RATING_RANGE + 1) // RATING_BUCKETS)
+        high = -(-(b + 1) * (RATING_RANGE + 1) // RATING_BUCKETS) - 1
+        d.append(dict(low=low, high=high, count=n, percent=self.count and 100.0 * n / self.count or 0))
+      return d
+
+    def bayesian_score(self, prior_mean=None, prior_weight=None):
+      """Mean rating pulled towards 'prior_mean' (default RATING_PRIOR_MEAN) as if there were
+      'prior_weight' (default RATING_PRIOR_WEIGHT) more ratings of that value: objects with few
+      ratings do not outrank well-established ones."""
+      if prior_mean is None:
+        prior_mean = RATING_PRIOR_MEAN
+      if prior_weight is None:
+        prior_weight = RATING_PRIOR_WEIGHT
+      if not self.count and not prior_weight:
+        return None
+      return (prior_weight * prior_mean + self.total) / float(prior_weight + self.count)
+
+    @property
+    def score(self):
+      """bayesian_score() with the default prior (for templates)"""
+      return self.bayesian_score()
+
+    def __unicode__(self):
+      return 'RatingAggregate: %s for %s #%s (%s)' % (self.comment_model, self.content_type_id, self.object_pk, self.count)
+
+    class Meta:
+      unique_together = [ ('comment_model', 'site', 'content_type', 'object_pk') ]
+
+#
+# Comment Versions
+#
+
+class CommentVersion(models.Model):
+  """
+  Version of the comments of one object: there is one row per comment model ('app_label.model'
+  of the non-proxy model), site and content object.  'version' is incremented and
+  'modified_date' set by every change to the object's comments, whatever their status (save,
+  delete, bulk change), so they validate anything derived from them (see
+  views.thread_comments).  Objects whose comments did not change since the table was created
+  have no row.
+  """
+  comment_model  = models.CharField(max_length=100)
+  site           = models.ForeignKey(Site, related_name="swcomments_commentversion_set")
+  content_type   = models.ForeignKey(ContentType, related_name="swcomments_commentversion_set")
+  object_pk      = models.CharField(max_length=255)
+  version        = models.PositiveIntegerField(default=0)
+  modified_date  = models.DateTimeField()
+
+  def __unicode__(self):
+    return 'CommentVersion: %s for %s #%s (%s)' % (self.comment_model, self.content_type_id, self.object_pk, self.version)
+
+  @classmethod
+  def key(cls, model_class, site_id, content_type_id, object_pk):
+    return dict(comment_model=str(model_class.get_nonproxy_model()._meta), site=site_id,
+                content_type=content_type_id, object_pk=unicode(object_pk))
+
+  @classmethod
+  def get_for_object(cls, model_class, site_id, content_type_id, object_pk):
+    """Return (version, modified_date) of the comments of 'model_class' for one object ((0, None)
+    if they never changed)"""
+    rows = cls.objects.filter(**cls.key(model_class, site_id, content_type_id, object_pk))  \
+        .values_list('version', 'modified_date')[:1]
+    return rows and tuple(rows[0]) or (0, None)
+
+  @classmethod
+  def bump(cls, model_class, site_id, content_type_id, object_pk):
+    """Increment the version of the comments of 'model_class' for one object (in the current
+    transaction)"""
+    key = cls.key(model_class, site_id, content_type_id, object_pk)
+    now = datetime.datetime.now()
+    if cls.objects.filter(**key).update(version=models.F('version') + 1, modified_date=now):
+      return
+    # First change: create the row; if another process beat us to it, increment its row
+    sid = transaction.savepoint()
+    try:
+      cls.objects.create(comment_model=key['comment_model'], site_id=site_id, content_type_id=content_type_id,
+                         object_pk=key['object_pk'], version=1, modified_date=now)
+      transaction.savepoint_commit(sid)
+    except IntegrityError:
+      transaction.savepoint_rollback(sid)
+      cls.objects.filter(**key).update(version=models.F('version') + 1, modified_date=now)
+
+  class Meta:
+    unique_together = [ ('comment_model', 'site', 'content_type', 'object_pk') ]
+
+def _comment_deleted_version(sender, instance, **kwargs):
+  if isinstance(instance, BaseComment):
+    CommentVersion.bump(type(instance), instance.site_id, instance.content_type_id, instance.object_pk)
+
+def _comments_bulk_changed_version(sender, objects, **kwargs):
+  for site_id, ct_id, object_pk in objects:
+    CommentVersion.bump(sender, site_id, ct_id, object_pk)
+
+models.signals.post_delete.connect(_comment_deleted_version)
+signals.comments_bulk_changed.connect(_comments_bulk_changed_version)
+
+#
+# Comment Counters
+#
+
+class CommentCount(models.Model):
+  """
+  Denormalized number of comments for one object, as returned by swcomments_get_count.
+  There is one row per comment model ('app_label.model', proxies included), site, 
+  content object and filter (manager name, '' for the default manager).
+  Rows are created on first read and kept up to date by swcomments.counters (only when
+  settings.SWCOMMENTS_USE_COUNTERS is True).
+  """
+  comment_model  = models.CharField(max_length=100)
+  site           = models.ForeignKey(Site, related_name="swcomments_commentcount_set")
+  content_type   = models.ForeignKey(ContentType, related_name="swcomments_commentcount_set")
+  object_pk      = models.CharField(max_length=255)
+  filter         = models.CharField(max_length=50, blank=True, default='')
+  count          = models.PositiveIntegerField(default=0)
+
+  def get_comment_model(self):
+    """Return the comment model class this counter is for (None if it no longer exists)"""
+    return models.get_model(*self.comment_model.split(".", 1))
+
+  def __unicode__(self):
+    return 'CommentCount: %s for %s #%s (%s)' % (self.comment_model, self.content_type_id, self.object_pk, self.count)
+
+  class Meta:
+    unique_together = [ ('comment_model', 'site', 'content_type', 'object_pk', 'filter') ]
+
+#
+# Search
+#
+
+class SearchToken(models.Model):
+  """
+  Inverted index of comment titles and bodies, used by swcomments.search when neither SQLite
+  FTS5 nor PostgreSQL full-text search is available: one row per comment and distinct token
+  (with its number of occurrences).  Only active comments are indexed.
+  """
+  comment_model  = models.CharField(max_length=100)
+  comment_id     = models.PositiveIntegerField()
+  site           = models.ForeignKey(Site, related_name="swcomments_searchtoken_set")
+  content_type   = models.ForeignKey(ContentType, related_name="swcomments_searchtoken_set")
+  object_pk      = models.CharField(max_length=255)
+  token          = models.CharField(max_length=64)
+  count          = models.PositiveIntegerField(default=1)
+
+  @classmethod
+  def get_indexes(cls):
+    return [
+      ('token', 'site'),
+      ('comment_model', 'comment_id'),
+    ]
+
+  def __unicode__(self):
+    return 'SearchToken: %s in %s #%s' % (self.token, self.comment_model, self.comment_id)
+
 #
 # Threaded Comment
 # 
 
-if 'treebeard' in settings.INSTALLED_APPS:
-  pass
+# Maximum depth of a reply (0 = top-level comment); replies to comments at that depth are
+# attached to the same parent instead (ie. the thread is flattened at that level)
+THREAD_MAX_DEPTH = getattr(settings, 'SWCOMMENTS_THREAD_MAX_DEPTH', 8)
+
+PATH_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+PATH_STEP_LENGTH = 7     # base36: up to 78 billion comments
+PATH_MAX_LENGTH = 255    # a path has THREAD_MAX_DEPTH + 1 steps at most
+
+if not isinstance(THREAD_MAX_DEPTH, int) or not 0 <= THREAD_MAX_DEPTH < PATH_MAX_LENGTH // PATH_STEP_LENGTH:
+  raise TypeError('settings.SWCOMMENTS_THREAD_MAX_DEPTH must be an integer between 0 and %d' % (PATH_MAX_LENGTH // PATH_STEP_LENGTH - 1,))
+
+def path_step(id):
+  """Return the (fixed length, base36) path step of comment id 'id'"""
+  step = ''
+  while id:
+    id, r = divmod(id, 36)
+    step = PATH_DIGITS[r] + step
+  return step.rjust(PATH_STEP_LENGTH, '0')
+
+class BaseThreadedComment(models.Model):
+  """
+  A threaded comment is a reply to another comment (parent) of the same object.
+  Threads are stored as materialized paths: 'path' is the path of the parent followed by
+  the comment's own id (fixed length, base36), so sorting by path gives the thread in
+  display order (each comment followed by its replies, oldest first) and a whole thread or a
+  subtree is a single range of the (site, content_type, object_id, path) index.
+  """
+
+  parent = models.ForeignKey('self', related_name="children", blank=True, null=True)
+  path   = models.CharField(max_length=PATH_MAX_LENGTH, blank=True, default='', editable=False)
+  depth  = models.PositiveIntegerField(default=0, editable=False)
+
+  def prepare_derived_data(self, is_insert):
+    super(BaseThreadedComment, self).prepare_derived_data(is_insert)
+    if is_insert:
+      # Enforce maximum depth by replying to the parent's parent instead
+      parent = self.parent
+      while parent is not None and parent.depth >= THREAD_MAX_DEPTH:
+        parent = parent.parent
+      self.parent = parent
+      self.depth = parent is not None and parent.depth + 1 or 0
+
+  def update_derived_data(self, is_insert):
+    super(BaseThreadedComment, self).update_derived_data(is_insert)
+    # The path includes our own id, so it is only known after insert
+    if is_insert:
+      self.path = (self.parent_id and self.parent.path or '') + path_step(self.id)
+      self.__class__._base_manager.filter(pk=self.id).update(path=self.path)
+
+  def get_subtree(self, include_self=True):
+    """Return the queryset of this comment's replies (and theirs...) in display order.  The
+    subtree is the range of paths from this comment's path to the same path followed by the
+    highest path digits (a range of the path index, which LIKE 'path%' is not on every database)."""
+    last = self.path + PATH_DIGITS[-1] * (PATH_MAX_LENGTH - len(self.path))
+    qs = self.__class__.objects  \
+        .filter(object_filter(self.object_pk), site=self.site_id, content_type=self.content_type_id,
+                path__gte=self.path, path__lte=last)  \
+        .order_by('path')
+    if not include_self:
+      qs = qs.exclude(pk=self.id)
+    return qs
+
+  @classmethod
+  def get_indexes(cls):
+    return super(BaseThreadedComment, cls).get_indexes() + [
+      ('site', 'content_type', 'object_id', 'path'),
+    ]
+
+  def as_dict(self):
+    d = super(BaseThreadedComment, self).as_dict()
+    d.update(dict(
+      parent_id = self.parent_id,
+      depth = self.depth,
+    ))
+    return d
+
+  @classmethod
+  def do_thread(cls, qs):
+    """
+    Given a queryset (or any sequence) of threaded comments, yield them in display order (by
+    path, each comment followed by its replies).  Querysets are ordered and read by the
+    database (iterator()); other sequences (and sliced querysets) are sorted.  There is no
+    recursion: each comment's 'depth' attribute tells how far to indent it.
+    """
+    if isinstance(qs, QuerySet) and qs.query.can_filter():
+      return qs.order_by('path').iterator()
+    return iter(sorted(qs, key=lambda c: c.path))
+
+  class Meta:
+    # This model is meant to be inherited
+    abstract = True
+    ordering = [ 'path' ]
 
+class ThreadedComment(BaseThreadedComment, BaseComment):
+  """Actual Threaded Comment Model"""
+
+
+#
+# Archive
+#
+
+# Comment model -> archive model (see make_archive_model)
+ARCHIVE_MODELS = {}
+
+class BaseCommentArchive(models.Model):
+  """
+  Archived comments (see the swcomments_archive command): same columns as the comment table,
+  same ids, plus the date the comment was archived.  References to other comments (question,
+  parent) or to stacks are plain integers, since they may point to hot or archived rows.
+  """
+  archive_date = models.DateTimeField(default=datetime.datetime.now, db_index=True)
+
+  COMMENT_MODEL = None    # Set by make_archive_model
+
+  @classmethod
+  def get_indexes(cls):
+    return [
+      ('site', 'content_type', 'object_id', 'submit_date'),
+    ]
+
+  def to_comment(self):
+    """Return this archived comment as an (unsaved) instance of its comment model, with an
+    'archived' attribute set to True"""
+    model = self.COMMENT_MODEL
+    c = model()
+    for f in model._meta.local_fields:
+      setattr(c, f.attname, getattr(self, self._meta.get_field(f.name).attname))
+    c.archived = True
+    return c
+
+  class Meta:
+    abstract = True
+
+def make_archive_model(model):
+  """
+  Create (and register) the archive model of concrete comment model 'model': table
+  '<comment table>_archive' with the same columns.  Applications defining their own
+  concrete comment models can call this in their models.py to make them archivable.
+  """
+  if model in ARCHIVE_MODELS:
+    return ARCHIVE_MODELS[model]
+  attrs = {
+    '__module__': model.__module__,
+    'COMMENT_MODEL': model,
+    'Meta': type('Meta', (object,), dict(app_label=model._meta.app_label, db_table=model._meta.db_table + '_archive')),
+  }
+  for f in model._meta.local_fields:
+    if f.primary_key:
+      attrs[f.name] = models.IntegerField(primary_key=True, db_column=f.column)
+    elif f.rel and (issubclass(f.rel.to, BaseComment) or f.rel.to is CommentStack):
+      attrs[f.name] = models.IntegerField(blank=True, null=True, db_column=f.column, db_index=True)
+    elif f.rel:
+      attrs[f.name] = models.ForeignKey(f.rel.to, blank=f.blank, null=f.null, db_column=f.column, related_name='+')
+    else:
+      field = copy.deepcopy(f)
+      if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+        field.auto_now = field.auto_now_add = False
+      attrs[f.name] = field
+  archive_model = type(model.__name__ + 'Archive', (BaseCommentArchive,), attrs)
+  setattr(sys.modules[model.__module__], archive_model.__name__, archive_model)
+  ARCHIVE_MODELS[model] = archive_model
+  return archive_model
+
+for m in [ Comment, AnonComment, QAComment, StackedComment, ThreadedComment ]:
+  make_archive_model(m)
+if 'djangoratings' in settings.INSTALLED_APPS:
+  make_archive_model(RatingComment)
+  make_archive_model(StackedRatingComment)
+
+class ArchiveQuerySet(object):
+  """
+  Comments of a comment model from both its hot table and its archive table, merged in
+  order.  Supports filter(), exclude(), order_by() (plain field names only), count(),
+  iteration and slicing; archived comments are returned as comment model instances with
+  'archived' set (see BaseCommentArchive.to_comment).
+  """
+  def __init__(self, model, hot, archive, ordering=None):
+    self.model = model
+    self.hot = hot
+    self.archive = archive
+    if ordering is None:
+      ordering = [ o for o in model._meta.ordering if '__' not in o ] or [ '-submit_date' ]
+      ordering = ordering + [ ordering[0].startswith('-') and '-id' or 'id' ]
+    self.ordering = ordering
+
+  def _clone(self, hot, archive, ordering=None):
+    return ArchiveQuerySet(self.model, hot, archive, ordering or self.ordering)
+
+  def filter(self, *args, **kwargs):
+    return self._clone(self.hot.filter(*args, **kwargs), self.archive is not None and self.archive.filter(*args, **kwargs) or None)
+
+  def exclude(self, *args, **kwargs):
+    return self._clone(self.hot.exclude(*args, **kwargs), self.archive is not None and self.archive.exclude(*args, **kwargs) or None)
+
+  def order_by(self, *fields):
+    for f in fields:
+      if '__' in f or f.startswith('?'):
+        raise ValueError("Comments across hot and archived data can only be ordered by plain fields: %s" % (f,))
+    return self._clone(self.hot, self.archive, list(fields) or None)
+
+  def count(self):
+    return self.hot.count() + (self.archive is not None and self.archive.count() or 0)
+
+  def _compare(self, a, b):
+    for o in self.ordering:
+      desc = o.startswith('-')
+      name = self.model._meta.get_field(o.lstrip('-')).attname
+      c = cmp(getattr(a, name), getattr(b, name))
+      if c:
+        return desc and -c or c
+    return 0
+
+  def _merge(self, hot, archived):
+    hot = iter(hot)
+    archived = ( a.to_comment() for a in archived )
+    a, b = next(hot, None), next(archived, None)
+    while a is not None and b is not None:
+      if self._compare(a, b) <= 0:
+        yield a
+        a = next(hot, None)
+      else:
+        yield b
+        b = next(archived, None)
+    while a is not None:
+      yield a
+      a = next(hot, None)
+    while b is not None:
+      yield b
+      b = next(archived, None)
+
+  def __iter__(self):
+    hot = self.hot.order_by(*self.ordering).iterator()
+    if self.archive is None:
+      return hot
+    return self._merge(hot, self.archive.order_by(*self.ordering).iterator())
+
+  def __getitem__(self, k):
+    if isinstance(k, slice):
+      if k.step or (k.start or 0) < 0 or (k.stop is not None and k.stop < 0):
+        raise ValueError("Only non-negative slices without step are supported")
+      if k.stop is None:
+        return list(self)[k.start or 0:]
+      hot = self.hot.order_by(*self.ordering)[:k.stop]
+      if self.archive is None:
+        return list(hot)[k.start or 0:]
+      return list(self._merge(hot, self.archive.order_by(*self.ordering)[:k.stop]))[k.start or 0:k.stop]
+    found = self[k:k + 1]
+    if not found:
+      raise IndexError("ArchiveQuerySet index out of range")
+    return found[0]
@@ -0,0 +1,246 @@
+"""
+Denormalized rating aggregates.
+
+For rating comment models (based on BaseRatingComment), swcomments_get_rating and
+swcomments_get_ratings read an object's ratings (count, average, standard deviation,
+distribution, Bayesian-adjusted score) from the RatingAggregate table instead of
+aggregating every comment.  Rows are created the first time they are read (one GROUP BY
+query for all the objects missing a row).  When a rating comment is saved (including status
+changes) or deleted, the row of its object is adjusted in the same transaction by the change
+it made: the ratings of the comment's count_scope() are aggregated before and after, and the
+differences are added to the row, which is locked while its histogram is rewritten.  Objects
+whose comments are changed in bulk are recomputed, and the swcomments_rebuild_ratings
+management command reconciles the table with the comment tables.
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, signals as dbsignals
+
+from swcomments import models, signals
+
+def ratings_available():
+  """Returns True if rating comment models exist (djangoratings is installed)"""
+  return hasattr(models, 'RatingAggregate')
+
+def is_rating_model(model_class):
+  return ratings_available() and issubclass(model_class, models.BaseRatingComment)
+
+def model_label(model_class):
+  """Returns the 'app_label.model' label used to identify comment models in aggregate rows"""
+  return str(model_class.get_nonproxy_model()._meta)
+
+def set_stats(row, scores):
+  """Set the statistics of aggregate 'row' from 'scores', a sequence of (score, number of ratings)"""
+  count = total = total_squares = 0
+  h = [ 0 ] * models.RATING_BUCKETS
+  for score, n in scores:
+    if score is None:
+      continue
+    count += n
+    total += score * n
+    total_squares += score * score * n
+    h[models.rating_bucket(score)] += n
+  row.count, row.total, row.total_squares = count, total, total_squares
+  row.set_histogram(h)
+  return row
+
+def rating_scores(model_class):
+  """Return the queryset of the active ratings of 'model_class' that count (do_count), to be
+  grouped on score with values_list()/annotate()"""
+  qs = model_class.get_nonproxy_model().active.all()
+  return model_class.do_count(qs).order_by()
+
+def new_row(model_class, content_type_id, object_pk):
+  return models.RatingAggregate(comment_model=model_label(model_class), site_id=settings.SITE_ID,
+                                content_type_id=content_type_id, object_pk=unicode(object_pk))
+
+def compute_stats(model_class, content_type_id, object_pk, row=None, scope=None):
+  """Compute the ratings of one object into 'row' (a new RatingAggregate if None), exactly
+  like swcomments_get_rating does without the aggregate table (only the ratings selected by Q
+  object 'scope', if given)"""
+  if row is None:
+    row = new_row(model_class, content_type_id, object_pk)
+  scores = rating_scores(model_class)  \
+      .filter(models.object_filter(object_pk), content_type=content_type_id)
+  if scope is not None:
+    scores = scores.filter(scope)
+  return set_stats(row, scores.values_list('score').annotate(n=Count('id')))
+
+def _store(row):
+  # Update the existing row, or create it; if another process beat us to it, update its row
+  fields = dict(count=row.count, total=row.total, total_squares=row.total_squares, histogram=row.histogram)
+  existing = models.RatingAggregate.objects.filter(comment_model=row.comment_model, site=row.site_id,
+                                                   content_type=row.content_type_id, object_pk=row.object_pk)
+  if existing.update(**fields):
+    return row
+  sid = transaction.savepoint()
+  try:
+    row.save()
+    transaction.savepoint_commit(sid)
+  except IntegrityError:
+    transaction.savepoint_rollback(sid)
+    existing.update(**fields)
+  return row
+
+def _create_rows(rows):
+  # Insert new rows (one INSERT); if another process created some of them meanwhile, insert
+  # the others one by one and use its rows
+  def create():
+    sid = transaction.savepoint()
+    try:
+      models.RatingAggregate.objects.bulk_create(rows)
+      transaction.savepoint_commit(sid)
+      return rows
+    except IntegrityError:
+      transaction.savepoint_rollback(sid)
+    result = []
+    for row in rows:
+      sid = transaction.savepoint()
+      try:
+        row.save()
+        transaction.savepoint_commit(sid)
+        result.append(row)
+      except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        result.append(models.RatingAggregate.objects.get(comment_model=row.comment_model, site=row.site_id,
+                                                         content_type=row.content_type_id, object_pk=row.object_pk))
+    return result
+  if transaction.is_managed():
+    return create()
+  return transaction.commit_on_success(create)()
+
+def get_ratings(model_class, objects):
+  """
+  Return a dict of object -> RatingAggregate of the ratings of type 'model_class' for a
+  queryset/list/tuple of objects, reading from the aggregate table.  Missing rows are
+  computed (one GROUP BY query for all of them) and stored.
+  """
+  o_list = list(objects)
+  if not o_list:
+    return {}
+
+  ct = ContentType.objects.get_for_model(o_list[0])
+  pks = set([ unicode(o.pk) for o in o_list ])
+
+  rows = models.RatingAggregate.objects  \
+      .filter(comment_model=model_label(model_class), site=settings.SITE_ID, content_type=ct, object_pk__in=pks)
+  rows = dict([ (r.object_pk, r) for r in rows ])
+
+  missing = sorted(pks - set(rows))
+  if missing:
+    scores = rating_scores(model_class)  \
+        .filter(models.objects_filter(missing), content_type=ct)  \
+        .values_list('object_pk', 'score')  \
+        .annotate(n=Count('id'))
+    by_object = {}
+    for pk, score, n in scores:
+      by_object.setdefault(pk, []).append((score, n))
+    new = [ set_stats(new_row(model_class, ct.id, pk), by_object.get(pk, ())) for pk in missing ]
+    for r in _create_rows(new):
+      rows[r.object_pk] = r
+  return dict([ (o, rows[unicode(o.pk)]) for o in o_list ])
+
+def get_rating(model_class, o):
+  """Return the RatingAggregate of the ratings of type 'model_class' for object 'o'"""
+  return get_ratings(model_class, [ o ])[o]
+
+def _counted(comment):
+  # Comment managers only see the current site; let swcomments_rebuild_ratings handle others
+  return is_rating_model(type(comment)) and comment.site_id == settings.SITE_ID
+
+def refresh_rating(comment):
+  """Recompute the aggregate row of the object 'comment' is attached to"""
+  if not _counted(comment):
+    return
+  _store(compute_stats(type(comment), comment.content_type_id, comment.object_pk))
+
+def rating_before(comment):
+  """Remember, on 'comment', the ratings of its count scope (called right before the comment
+  is written; see apply_rating)"""
+  if not _counted(comment):
+    return
+  scope = comment.count_scope()
+  comment._rating_before = (scope, compute_stats(type(comment), comment.content_type_id, comment.object_pk, scope=scope))
+
+def apply_rating(comment):
+  """
+  Add to the aggregate row of the object of 'comment' the difference between the ratings of
+  its count scope now and before the change (see rating_before).  Objects with no row yet are
+  left alone: their row is computed when it is first read.
+  """
+  if not _counted(comment):
+    return
+  before = getattr(comment, '_rating_before', None)
+  if before is None:
+    refresh_rating(comment)
+    return
+  del comment._rating_before
+  scope, before = before
+  after = compute_stats(type(comment), comment.content_type_id, comment.object_pk, scope=scope | comment.count_scope())
+  h = [ a - b for a, b in zip(after.get_histogram(), before.get_histogram()) ]
+  if after.count == before.count and after.total == before.total and not any(h):
+    return
+  # The row is locked while its histogram is rewritten; the sums are added in the UPDATE itself
+  qs = models.RatingAggregate.objects.filter(comment_model=after.comment_model, site=after.site_id,
+                                             content_type=after.content_type_id, object_pk=after.object_pk)
+  for row in qs.select_for_update():
+    row.set_histogram([ n + d for n, d in zip(row.get_histogram(), h) ])
+    qs.filter(pk=row.pk).update(count=F('count') + (after.count - before.count),
+                                total=F('total') + (after.total - before.total),
+                                total_squares=F('total_squares') + (after.total_squares - before.total_squares),
+                                histogram=row.histogram)
+
+def rebuild_ratings(model_class):
+  """
+  Reconcile the aggregate table with the ratings of 'model_class': one GROUP BY over all
+  ratings, then only rows that changed are written (missing rows are created).  Returns the
+  number of rows changed.
+  """
+  label = model_label(model_class)
+  scores = rating_scores(model_class)  \
+      .values_list('content_type', 'object_pk', 'score')  \
+      .annotate(n=Count('id'))
+  by_object = {}
+  for ct_id, pk, score, n in scores.iterator():
+    by_object.setdefault((ct_id, pk), []).append((score, n))
+
+  changed = 0
+  rows = models.RatingAggregate.objects.filter(comment_model=label, site=settings.SITE_ID)
+  for row in rows.iterator():
+    before = (row.count, row.total, row.total_squares, row.histogram)
+    set_stats(row, by_object.pop((row.content_type_id, row.object_pk), ()))
+    if (row.count, row.total, row.total_squares, row.histogram) != before:
+      _store(row)
+      changed += 1
+  for (ct_id, pk), data in by_object.items():
+    row = models.RatingAggregate(comment_model=label, site_id=settings.SITE_ID, content_type_id=ct_id, object_pk=pk)
+    _store(set_stats(row, data))
+    changed += 1
+  return changed
+
+def _comment_pre_save(sender, instance, **kwargs):
+  if isinstance(instance, models.BaseComment):
+    rating_before(instance)
+
+def _comment_changed(sender, comment, **kwargs):
+  apply_rating(comment)
+
+def _comment_pre_delete(sender, instance, **kwargs):
+  if isinstance(instance, models.BaseComment):
+    rating_before(instance)
+
+def _comment_deleted(sender, instance, **kwargs):
+  if isinstance(instance, models.BaseComment):
+    apply_rating(instance)
+
+def _comments_bulk_changed(sender, objects, **kwargs):
+  for site_id, ct_id, object_pk in objects:
+    refresh_rating(sender(site_id=site_id, content_type_id=ct_id, object_pk=object_pk))
+
+dbsignals.pre_save.connect(_comment_pre_save)
+signals.comment_changed.connect(_comment_changed)
+signals.comments_bulk_changed.connect(_comments_bulk_changed)
+dbsignals.pre_delete.connect(_comment_pre_delete)
+dbsignals.post_delete.connect(_comment_deleted)
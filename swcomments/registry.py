@@ -0,0 +1,70 @@
+"""
+Registry of comment models and commentable models.
+
+Comment models are registered when they are bound to their form (see swcomments.__init__).
+Commentable models are the ones listed in settings.SWCOMMENTS_COMMENTABLE_MODELS
+("app_label.model" strings, default none): comments can't be posted on any other model.
+Comment models, archive models and the other swcomments models can't be listed.  The
+registry is built once per process (on first use) and then answers every lookup from
+memory: label -> model and label -> ContentType.
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import get_model
+
+class CommentRegistry(object):
+  def __init__(self):
+    self._comment_models = []
+    self.clear()
+
+  def clear(self):
+    """Forget everything built (comment models stay registered); rebuilt on next lookup"""
+    self._built = False
+    self._by_label = {}
+    self._commentable_by_label = {}
+    self._content_types = {}
+
+  def register(self, model_class):
+    """Register a comment model (it can then be posted with post_comment)"""
+    if model_class not in self._comment_models:
+      self._comment_models.append(model_class)
+      self.clear()
+
+  def build(self):
+    from swcomments.models import BaseComment, BaseCommentArchive
+    commentables = []
+    for label in getattr(settings, 'SWCOMMENTS_COMMENTABLE_MODELS', []):
+      m = get_model(*label.lower().split(".", 1))
+      if m is None:
+        raise ValueError('settings.SWCOMMENTS_COMMENTABLE_MODELS: unknown model %s' % (label,))
+      if m._meta.app_label == 'swcomments' or issubclass(m, (BaseComment, BaseCommentArchive)):
+        raise ValueError('settings.SWCOMMENTS_COMMENTABLE_MODELS: %s is not commentable' % (label,))
+      commentables.append(m)
+    self._by_label = dict([ (str(m._meta), m) for m in self._comment_models ])
+    self._commentable_by_label = dict([ (str(m._meta), m) for m in commentables ])
+    self._content_types = ContentType.objects.get_for_models(*commentables)
+    self._built = True
+
+  def _check(self):
+    if not self._built:
+      self.build()
+
+  def get_comment_model(self, label):
+    """Return the comment model for label "app_label.model" (None if not registered)"""
+    self._check()
+    return self._by_label.get((label or '').lower())
+
+  def get_commentable_model(self, label):
+    """Return the commentable model for label "app_label.model" (None if not commentable)"""
+    self._check()
+    return self._commentable_by_label.get((label or '').lower())
+
+  def get_content_type(self, label_or_model):
+    """Return the ContentType of a commentable model (or its label), without hitting the database"""
+    self._check()
+    if isinstance(label_or_model, basestring):
+      label_or_model = self.get_commentable_model(label_or_model)
+    return self._content_types.get(label_or_model)
+
+registry = CommentRegistry()
@@ -0,0 +1,379 @@
+"""
+Full-text search over comment titles and bodies.
+
+When settings.SWCOMMENTS_SEARCH is True, every active comment of every concrete comment model
+is kept in a search index: it is (re)indexed whenever it is saved (comment_changed, which
+includes status changes: non-active comments are removed), removed when deleted, and
+reindexed when changed in bulk (comments_bulk_changed).  The index is stored with the best
+backend available (settings.SWCOMMENTS_SEARCH_BACKEND, default 'auto'):
+
+- 'fts5': an SQLite FTS5 virtual table for the text and a table of the indexed comments
+  (ranked with bm25)
+- 'postgresql': a table with a tsvector column and a GIN index (ranked with ts_rank, text
+  search configuration settings.SWCOMMENTS_SEARCH_CONFIG, default 'simple')
+- 'tokens': the SearchToken table (pure Python tokenizer, tf-idf like ranking)
+
+search() returns one page of comments, best matches first, for all words of the query;
+results can be limited to some comment models, a site and/or a content object.  The
+swcomments_rebuild_search command creates the index and indexes existing comments.
+"""
+
+import math
+import re
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Count, get_model, signals as dbsignals
+
+from swcomments import models, signals
+
+PER_PAGE = getattr(settings, 'SWCOMMENTS_SEARCH_PER_PAGE', 20)
+PER_PAGE_MAX = 100
+TOKEN_MAX_LENGTH = 64
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def search_enabled():
+  """Returns True if comments are indexed for search"""
+  return getattr(settings, 'SWCOMMENTS_SEARCH', False)
+
+def tokenize(text):
+  """Return the list of (lowercase) tokens of 'text'"""
+  return [ t for t in TOKEN_RE.findall((text or u'').lower()) if len(t) <= TOKEN_MAX_LENGTH ]
+
+def document(comment):
+  """Return the text indexed for 'comment'"""
+  return u'%s\n%s' % (comment.title or u'', comment.comment or u'')
+
+def model_label(model_class):
+  return str(model_class.get_nonproxy_model()._meta)
+
+def get_comment_model(label):
+  return get_model(*label.split(".", 1))
+
+class SearchBackend(object):
+  """
+  Base class of search backends.  Comments are identified by (label, id), where label is the
+  'app_label.model' of their non-proxy model.
+  """
+  name = None
+
+  def setup(self):
+    """Create the index storage (if needed)"""
+    pass
+
+  def index(self, comment):
+    raise NotImplementedError()
+
+  def remove(self, label, ids):
+    raise NotImplementedError()
+
+  def search(self, tokens, labels, site_id, content_type_id, object_pk, offset, limit):
+    """Return a list of (label, id, rank) of at most 'limit' comments matching all of 'tokens',
+    best first, starting at 'offset'"""
+    raise NotImplementedError()
+
+  def _execute(self, sql, params=()):
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+    return cursor
+
+class TokenSearchBackend(SearchBackend):
+  """Inverted index in the SearchToken table"""
+  name = 'tokens'
+
+  def index(self, comment):
+    label = model_label(type(comment))
+    self.remove(label, [ comment.id ])
+    counts = {}
+    for t in tokenize(document(comment)):
+      counts[t] = counts.get(t, 0) + 1
+    models.SearchToken.objects.bulk_create([
+      models.SearchToken(comment_model=label, comment_id=comment.id, site_id=comment.site_id,
+                         content_type_id=comment.content_type_id, object_pk=unicode(comment.object_pk),
+                         token=t, count=n)
+      for t, n in counts.items() ])
+
+  def remove(self, label, ids):
+    models.SearchToken.objects.filter(comment_model=label, comment_id__in=ids).delete()
+
+  def search(self, tokens, labels, site_id, content_type_id, object_pk, offset, limit):
+    # Score: sum over the query tokens of occurrences / log(2 + number of comments with the
+    # token), so rare tokens weigh more; comments must contain all tokens.  Both the number of
+    # comments per token and the ranked page are computed by the database.
+    tokens = sorted(set(tokens))
+    qs = models.SearchToken.objects.filter(token__in=tokens, site=site_id)
+    if labels:
+      qs = qs.filter(comment_model__in=labels)
+    if content_type_id is not None:
+      qs = qs.filter(content_type=content_type_id, object_pk=object_pk)
+    frequencies = dict(qs.order_by().values_list('token').annotate(n=Count('id')))
+    if len(frequencies) < len(tokens):
+      return []
+
+    qn = connection.ops.quote_name
+    weights = " ".join([ "WHEN %s THEN %s" ] * len(tokens))
+    params = []
+    for t in tokens:
+      params += [ t, 1.0 / math.log(2 + frequencies[t]) ]
+    where = [ "%s IN (%s)" % (qn('token'), ", ".join([ '%s' ] * len(tokens))), "%s = %%s" % (qn('site_id'),) ]
+    params += tokens + [ site_id ]
+    if labels:
+      where.append("%s IN (%s)" % (qn('comment_model'), ", ".join([ '%s' ] * len(labels))))
+      params += labels
+    if content_type_id is not None:
+      where.append("%s = %%s AND %s = %%s" % (qn('content_type_id'), qn('object_pk')))
+      params += [ content_type_id, unicode(object_pk) ]
+    sql = "SELECT %(model)s, %(id)s, SUM(%(count)s * CASE %(token)s %(weights)s END) AS score FROM %(table)s " \
+          "WHERE %(where)s GROUP BY %(model)s, %(id)s HAVING COUNT(*) = %%s " \
+          "ORDER BY score DESC, %(id)s DESC, %(model)s LIMIT %%s OFFSET %%s" % dict(
+            model=qn('comment_model'), id=qn('comment_id'), count=qn('count'), token=qn('token'), weights=weights,
+            table=qn(models.SearchToken._meta.db_table), where=" AND ".join(where))
+    cursor = connection.cursor()
+    cursor.execute(sql, params + [ len(tokens), limit, offset ])
+    return [ (l, id, float(score)) for l, id, score in cursor.fetchall() ]
+
+class FTS5SearchBackend(SearchBackend):
+  """
+  SQLite FTS5 virtual table holding the text, and a table of the indexed comments (comment_model,
+  comment_id, site and object, unique on (comment_model, comment_id)) whose id is the rowid of
+  their text.  Removing or filtering comments uses the indexes of that table: columns of an
+  FTS5 table can't be indexed.
+  """
+  name = 'fts5'
+  table = 'swcomments_search_fts5'
+  doc_table = 'swcomments_search_document'
+
+  @staticmethod
+  def available():
+    if connection.vendor != 'sqlite':
+      return False
+    cursor = connection.cursor()
+    try:
+      cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.swcomments_fts5_check USING fts5(body)")
+      cursor.execute("DROP TABLE temp.swcomments_fts5_check")
+    except Exception:
+      return False
+    return True
+
+  def setup(self):
+    # Earlier single table, whose rowids packed the comment id with a content type id
+    self._execute("DROP TABLE IF EXISTS swcomments_search_fts")
+    self._execute("CREATE TABLE IF NOT EXISTS %s (id integer NOT NULL PRIMARY KEY, comment_model varchar(100) NOT NULL, "
+                  "comment_id integer NOT NULL, site_id integer NOT NULL, content_type_id integer NOT NULL, "
+                  "object_pk varchar(255) NOT NULL, UNIQUE (comment_model, comment_id))" % (self.doc_table,))
+    self._execute("CREATE INDEX IF NOT EXISTS %s_object ON %s (site_id, content_type_id, object_pk)" % (self.doc_table, self.doc_table))
+    self._execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(body, tokenize='unicode61')" % (self.table,))
+
+  def index(self, comment):
+    label = model_label(type(comment))
+    self.remove(label, [ comment.id ])
+    cursor = self._execute("INSERT INTO %s (comment_model, comment_id, site_id, content_type_id, object_pk) "
+                           "VALUES (%%s, %%s, %%s, %%s, %%s)" % (self.doc_table,),
+                           [ label, comment.id, comment.site_id, comment.content_type_id, unicode(comment.object_pk) ])
+    rowid = connection.ops.last_insert_id(cursor, self.doc_table, 'id')
+    self._execute("INSERT INTO %s (rowid, body) VALUES (%%s, %%s)" % (self.table,),
+                  [ rowid, u' '.join(tokenize(document(comment))) ])
+
+  def remove(self, label, ids):
+    for i in range(0, len(ids), 500):
+      chunk = list(ids[i:i + 500])
+      where = "comment_model = %%s AND comment_id IN (%s)" % (", ".join([ '%s' ] * len(chunk)),)
+      self._execute("DELETE FROM %s WHERE rowid IN (SELECT id FROM %s WHERE %s)" % (self.table, self.doc_table, where),
+                    [ label ] + chunk)
+      self._execute("DELETE FROM %s WHERE %s" % (self.doc_table, where), [ label ] + chunk)
+
+  def search(self, tokens, labels, site_id, content_type_id, object_pk, offset, limit):
+    match = u' '.join([ u'"%s"' % (t,) for t in tokens ])
+    sql = "SELECT d.comment_model, d.comment_id, %(fts)s.rank FROM %(fts)s JOIN %(doc)s d ON d.id = %(fts)s.rowid " \
+          "WHERE %(fts)s MATCH %%s AND d.site_id = %%s" % dict(fts=self.table, doc=self.doc_table)
+    params = [ match, site_id ]
+    if labels:
+      sql += " AND d.comment_model IN (%s)" % (", ".join([ '%s' ] * len(labels)),)
+      params += labels
+    if content_type_id is not None:
+      sql += " AND d.content_type_id = %s AND d.object_pk = %s"
+      params += [ content_type_id, unicode(object_pk) ]
+    sql += " ORDER BY %s.rank, d.comment_id DESC LIMIT %%s OFFSET %%s" % (self.table,)
+    cursor = connection.cursor()
+    cursor.execute(sql, params + [ limit, offset ])
+    return [ (l, id, -rank) for l, id, rank in cursor.fetchall() ]
+
+class PostgreSQLSearchBackend(SearchBackend):
+  """Table with a tsvector column (GIN index)"""
+  name = 'postgresql'
+  table = 'swcomments_search_document'
+
+  def __init__(self):
+    self.config = getattr(settings, 'SWCOMMENTS_SEARCH_CONFIG', 'simple')
+
+  def setup(self):
+    self._execute("CREATE TABLE IF NOT EXISTS %s (comment_model varchar(100) NOT NULL, comment_id integer NOT NULL, "
+                  "site_id integer NOT NULL, content_type_id integer NOT NULL, object_pk varchar(255) NOT NULL, "
+                  "document tsvector NOT NULL, PRIMARY KEY (comment_model, comment_id))" % (self.table,))
+    self._execute("CREATE INDEX IF NOT EXISTS %s_document ON %s USING gin(document)" % (self.table, self.table))
+    self._execute("CREATE INDEX IF NOT EXISTS %s_object ON %s (site_id, content_type_id, object_pk)" % (self.table, self.table))
+
+  def index(self, comment):
+    label = model_label(type(comment))
+    self.remove(label, [ comment.id ])
+    self._execute("INSERT INTO %s (comment_model, comment_id, site_id, content_type_id, object_pk, document) "
+                  "VALUES (%%s, %%s, %%s, %%s, %%s, to_tsvector(%%s, %%s))" % (self.table,),
+                  [ label, comment.id, comment.site_id, comment.content_type_id, unicode(comment.object_pk),
+                    self.config, document(comment) ])
+
+  def remove(self, label, ids):
+    for i in range(0, len(ids), 500):
+      chunk = list(ids[i:i + 500])
+      self._execute("DELETE FROM %s WHERE comment_model = %%s AND comment_id IN (%s)" % (self.table, ", ".join([ '%s' ] * len(chunk))),
+                    [ label ] + chunk)
+
+  def search(self, tokens, labels, site_id, content_type_id, object_pk, offset, limit):
+    sql = "SELECT comment_model, comment_id, ts_rank(document, q) AS rank FROM %s, plainto_tsquery(%%s, %%s) q " \
+          "WHERE document @@ q AND site_id = %%s" % (self.table,)
+    params = [ self.config, u' '.join(tokens), site_id ]
+    if labels:
+      sql += " AND comment_model IN (%s)" % (", ".join([ '%s' ] * len(labels)),)
+      params += labels
+    if content_type_id is not None:
+      sql += " AND content_type_id = %s AND object_pk = %s"
+      params += [ content_type_id, unicode(object_pk) ]
+    sql += " ORDER BY rank DESC, comment_id DESC LIMIT %s OFFSET %s"
+    cursor = connection.cursor()
+    cursor.execute(sql, params + [ limit, offset ])
+    return cursor.fetchall()
+
+BACKENDS = {
+  'tokens': TokenSearchBackend,
+  'fts5': FTS5SearchBackend,
+  'postgresql': PostgreSQLSearchBackend,
+}
+
+_backend = None
+
+def get_backend():
+  """Return the search backend (chosen once per process)"""
+  global _backend
+  if _backend is None:
+    name = getattr(settings, 'SWCOMMENTS_SEARCH_BACKEND', 'auto')
+    if name == 'auto':
+      if connection.vendor == 'postgresql':
+        name = 'postgresql'
+      elif FTS5SearchBackend.available():
+        name = 'fts5'
+      else:
+        name = 'tokens'
+    if name not in BACKENDS:
+      raise ValueError('settings.SWCOMMENTS_SEARCH_BACKEND: unknown backend %s' % (name,))
+    _backend = BACKENDS[name]()
+  return _backend
+
+def index_comment(comment):
+  """Add 'comment' to the search index (or remove it, if it is not active)"""
+  if comment.status == models.BaseComment.STATUS_ACTIVE:
+    get_backend().index(comment)
+  else:
+    get_backend().remove(model_label(type(comment)), [ comment.id ])
+
+def reindex(model_class, ids):
+  """Reindex comments 'ids' of 'model_class' (comments that no longer exist are removed)"""
+  model_class = model_class.get_nonproxy_model()
+  for i in range(0, len(ids), 500):
+    chunk = ids[i:i + 500]
+    found = model_class._base_manager.in_bulk(chunk)
+    for c in found.values():
+      index_comment(c)
+    missing = [ id for id in chunk if id not in found ]
+    if missing:
+      get_backend().remove(model_label(model_class), missing)
+
+def index_model(model_class, chunk_size=500):
+  """(Re)index all comments of 'model_class', in id-ordered chunks of 'chunk_size' (one
+  transaction per chunk).  Returns the number of comments processed."""
+  total = 0
+  last_id = 0
+  while True:
+    ids = list(model_class._base_manager.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+    if not ids:
+      break
+    last_id = ids[-1]
+    transaction.commit_on_success(reindex)(model_class, ids)
+    total += len(ids)
+  return total
+
+class SearchResults(object):
+  """One page of search results: iterable list of comments (best first, each with a
+  'search_rank' attribute), with page/has_next/has_previous attributes"""
+  def __init__(self, comments, page, per_page, has_next):
+    self.comments = comments
+    self.page = page
+    self.per_page = per_page
+    self.has_next = has_next
+    self.has_previous = page > 1
+    self.next_page_number = page + 1
+    self.previous_page_number = page - 1
+
+  def __iter__(self):
+    return iter(self.comments)
+
+  def __len__(self):
+    return len(self.comments)
+
+def search(query, model_classes=None, site=None, o=None, page=1, per_page=None):
+  """
+  Return page 'page' (SearchResults) of the active comments containing all words of 'query',
+  best matches first.  The search can be limited to comments of 'model_classes' (default all),
+  of 'site' (Site or id, default the current site) and/or for object 'o'.
+  """
+  if not search_enabled():
+    raise ValueError('Comment search is not enabled (settings.SWCOMMENTS_SEARCH)')
+  per_page = min(per_page or PER_PAGE, PER_PAGE_MAX)
+  page = max(int(page or 1), 1)
+  tokens = tokenize(query)
+  if not tokens:
+    return SearchResults([], page, per_page, False)
+
+  labels = model_classes and sorted(set([ model_label(m) for m in model_classes ])) or None
+  site_id = site is None and settings.SITE_ID or getattr(site, 'pk', site)
+  ct_id = pk = None
+  if o is not None:
+    ct_id, pk = ContentType.objects.get_for_model(o).id, o.pk
+
+  found = get_backend().search(tokens, labels, site_id, ct_id, pk, (page - 1) * per_page, per_page + 1)
+  has_next = len(found) > per_page
+  found = found[:per_page]
+
+  # One query per comment model
+  by_label = {}
+  for label, id, rank in found:
+    by_label.setdefault(label, []).append(id)
+  comments = {}
+  for label, ids in by_label.items():
+    model_class = get_comment_model(label)
+    for id, c in model_class._base_manager.select_related('user').in_bulk(ids).items():
+      comments[(label, id)] = c
+  results = []
+  for label, id, rank in found:
+    c = comments.get((label, id))
+    if c is not None:
+      c.search_rank = rank
+      results.append(c)
+  return SearchResults(results, page, per_page, has_next)
+
+def _comment_changed(sender, comment, **kwargs):
+  if search_enabled():
+    index_comment(comment)
+
+def _comment_deleted(sender, instance, **kwargs):
+  if search_enabled() and isinstance(instance, models.BaseComment):
+    get_backend().remove(model_label(type(instance)), [ instance.id ])
+
+def _comments_bulk_changed(sender, ids, **kwargs):
+  if search_enabled():
+    reindex(sender, ids)
+
+signals.comment_changed.connect(_comment_changed)
+signals.comments_bulk_changed.connect(_comments_bulk_changed)
+dbsignals.post_delete.connect(_comment_deleted)
@@ -6,3 +6,15 @@ from django.dispatch import Signal
 # Right after comment was saved (includes request for convenience)
 comment_saved = Signal(providing_args=["comment", "request"])
 
+
+# Right after a comment (and any data derived from it) was saved, from any code path
+comment_changed = Signal(providing_args=["comment"])
+
+# Right after comments were changed in bulk, without save()/delete() being called on each of
+# them (eg. archived).  'objects' is a list of (site_id, content_type_id, object_pk) of the
+# objects they belong to, 'ids' the ids of the comments.
+comments_bulk_changed = Signal(providing_args=["objects", "ids"])
+
+# A call to a template tag, hook or view was measured (see swcomments.instrumentation); the
+# sender is the comment model (None if not known)
+call_measured = Signal(providing_args=["call"])
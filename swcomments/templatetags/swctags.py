@@ -8,7 +8,8 @@ from django.contrib.contenttypes import models as ctmodels
 from django.db import models as dbmodels
 from django.db.models.query import QuerySet
 
-from swcomments import models, views
+from swcomments import models, views, counters, ratings, search, instrumentation
+from swcomments import cache as swcache
 
 register = template.Library()
 
@@ -69,13 +70,13 @@ class SWCommentsBaseNode(template.Node):
       if o_list: 
         ct = ctmodels.ContentType.objects.get_for_model(o_list[0])
         pk = [ _.pk for _ in o_list ]
-        qs = qs.filter(content_type=ct, object_pk__in=pk)
+        qs = qs.filter(models.objects_filter(pk), content_type=ct)
       else:
         qs = qs.none()
     else:
       ct = ctmodels.ContentType.objects.get_for_model(o_expr)
       pk = o_expr.pk
-      qs = qs.filter(content_type=ct, object_pk=pk)
+      qs = qs.filter(models.object_filter(pk), content_type=ct)
 
     if order:
       if hasattr(self.model_class, 'ORDER') and self.model_class.ORDER.get(order):
@@ -86,6 +87,20 @@ class SWCommentsBaseNode(template.Node):
 
     return qs
 
+  def _cached(self, o_expr, parts, compute):
+    """
+    Return compute() through the versioned comment cache (see swcomments.cache) if it is enabled.
+    'parts' must contain everything other than the object(s) and filter the result depends on.
+    """
+    if not swcache.cache_enabled() or not o_expr:
+      return compute()
+    if isinstance(o_expr, (QuerySet, tuple, list)):
+      o_list = list(o_expr)
+    else:
+      o_list = [ o_expr ]
+    ct = ctmodels.ContentType.objects.get_for_model(o_list[0])
+    return swcache.cached(self.model_class, ct.id, [ o.pk for o in o_list ], (self.filter,) + parts, compute)
+
   def render(self):
     """Dummy render method -- needs to be implemented by subclasses"""
     raise NotImplementedError()
@@ -94,24 +109,148 @@ class SWCommentsGetListNode(SWCommentsBaseNode):
   """
   Actual implementation of swcomments_get_list tag.
   """
+  def __init__(self, *args, **kw):
+    super(SWCommentsGetListNode, self).__init__(*args, **kw)
+    self.after = self.after and template.Variable(self.after) or None
+    self.limit = self.limit and template.Variable(self.limit) or None
+
   def _get_qs(self, *args, **kws):
     qs = super(SWCommentsGetListNode, self)._get_qs(*args, **kws)
     return qs#.order_by('submit_date') #XXX let models do this
 
+  def _get_list(self, o_expr, order, after, limit):
+    # Returns (comments, cursor of next page)
+    qs = self._get_qs(o_expr, order=order)
+    if not (after or limit):
+      return qs, None
+    # Keyset pagination: only fetch one page
+    try:
+      return self.model_class.get_page(qs, after, limit, order)
+    except ValueError:
+      return self.model_class.get_page(qs, None, limit, order)
+
+  def _get_limit(self, context):
+    # Like a bad 'after' (first page), a bad limit falls back to the default page size
+    try:
+      limit = int(self.limit.resolve(context))
+    except (TypeError, ValueError, template.VariableDoesNotExist):
+      return models.PAGE_LIMIT
+    return max(1, min(limit, models.PAGE_LIMIT_MAX))
+
   def render(self, context):
     o_expr = self.o_expr.resolve(context)
     order = self.order and self.order.resolve(context) or None
-    context[self.varname] = self._get_qs(o_expr, order=order)
+    after = self.after and self.after.resolve(context) or None
+    limit = self.limit and self._get_limit(context) or None
+    if swcache.cache_enabled():
+      def compute():
+        qs, next = self._get_list(o_expr, order, after, limit)
+        return list(qs), next
+      qs, next = self._cached(o_expr, ('list', order, after, limit), compute)
+    else:
+      qs, next = self._get_list(o_expr, order, after, limit)
+    if self.after or self.limit:
+      context[self.varname + '_next'] = next
+    if self.prefetch:
+      # Comments are for the object(s) we were given: no need to fetch them again
+      if isinstance(o_expr, (QuerySet, tuple, list)):
+        qs = self.model_class.prefetch_content_objects(qs, o_expr)
+      else:
+        qs = self.model_class.prefetch_content_objects(qs, [ o_expr ])
+    context[self.varname] = qs
     return ''
 
 class SWCommentsGetCountNode(SWCommentsBaseNode):
   """
   Actual implementation of swcomments_get_count tag.
   """
+  def _get_count(self, o_expr):
+    if counters.counters_enabled() and o_expr:
+      # Read from denormalized counter table
+      return counters.get_count(self.model_class, o_expr, self.filter)
+    qs = self._get_qs(o_expr, for_count=True)  # Get query set (for count)
+    return qs.count()
+
   def render(self, context):
     o_expr = self.o_expr.resolve(context)
-    qs = self._get_qs(o_expr, for_count=True)  # Get query set (for count)
-    context[self.varname] = qs.count()
+    context[self.varname] = self._cached(o_expr, ('count',), lambda: self._get_count(o_expr))
+    return ''
+
+class SWCommentsGetCountsNode(SWCommentsBaseNode):
+  """
+  Actual implementation of swcomments_get_counts tag.
+  """
+  def render(self, context):
+    o_expr = self.o_expr.resolve(context)
+    if not o_expr:
+      context[self.varname] = {}
+      return ''
+    if not isinstance(o_expr, (QuerySet, tuple, list)):
+      o_expr = [ o_expr ]
+    if counters.counters_enabled():
+      context[self.varname] = counters.get_counts(self.model_class, o_expr, self.filter)
+    else:
+      context[self.varname] = self.model_class.get_counts(o_expr, self.filter)
+    return ''
+
+class SWCommentsGetRatingNode(SWCommentsBaseNode):
+  """
+  Actual implementation of swcomments_get_rating tag.
+  """
+  def render(self, context):
+    o_expr = self.o_expr.resolve(context)
+    context[self.varname] = o_expr and ratings.get_rating(self.model_class, o_expr) or None
+    return ''
+
+class SWCommentsGetRatingsNode(SWCommentsBaseNode):
+  """
+  Actual implementation of swcomments_get_ratings tag.
+  """
+  def render(self, context):
+    o_expr = self.o_expr.resolve(context)
+    if not o_expr:
+      context[self.varname] = {}
+      return ''
+    if not isinstance(o_expr, (QuerySet, tuple, list)):
+      o_expr = [ o_expr ]
+    context[self.varname] = ratings.get_ratings(self.model_class, o_expr)
+    return ''
+
+class SWCommentsSearchNode(template.Node):
+  """
+  Actual implementation of swcomments_search tag.
+  """
+  def __init__(self, query, varname, model=None, o_expr=None, site=None, page=None, per_page=None):
+    self.query = template.Variable(query)
+    self.varname = varname
+    self.model_classes = None
+    if model:
+      model = model.lower()
+      if '.' not in model:
+        model = "swcomments." + model
+      model_class = dbmodels.get_model(*model.split(".", 1))
+      if model_class is None or not issubclass(model_class, models.BaseComment):
+        raise TypeError("The Comment model '%s' must be based on swcomments.BaseComment" % (model,))
+      self.model_classes = [ model_class ]
+    self.o_expr = o_expr and template.Variable(o_expr) or None
+    self.site = site and template.Variable(site) or None
+    self.page = page and template.Variable(page) or None
+    self.per_page = per_page and template.Variable(per_page) or None
+
+  def render(self, context):
+    o = self.o_expr and self.o_expr.resolve(context) or None
+    page = self.page and self.page.resolve(context) or 1
+    try:
+      page = int(page)
+    except (TypeError, ValueError):
+      page = 1
+    context[self.varname] = search.search(
+      self.query.resolve(context),
+      model_classes = self.model_classes,
+      site = self.site and self.site.resolve(context) or None,
+      o = o,
+      page = page,
+      per_page = self.per_page and int(self.per_page.resolve(context)) or None)
     return ''
 
 class SWCommentsGetListsNode(SWCommentsBaseNode):
@@ -124,9 +263,23 @@ class SWCommentsGetListsNode(SWCommentsBaseNode):
 
   def render(self, context):
     o_expr = self.o_expr.resolve(context)
+    if isinstance(o_expr, (QuerySet, tuple, list)):
+      o_list = list(o_expr)
+    elif o_expr:
+      o_list = [ o_expr ]
+    else:
+      o_list = []
+    # Group by object_pk and map back to the objects we were given (no content_object lookups)
+    o_map = dict([ (unicode(o.pk), o) for o in o_list ])
+    cache_attr = self.model_class.content_object.cache_attr
+    if swcache.cache_enabled():
+      comments = self._cached(o_list, ('lists',), lambda: list(self._get_qs(o_list)))
+    else:
+      comments = self._get_qs(o_list)
     d = {}
-    for comment in self._get_qs(o_expr):
-      o = comment.content_object
+    for comment in comments:
+      o = o_map[comment.object_pk]
+      setattr(comment, cache_attr, o)
       if o not in d: d[o] = []
       d[o].append(comment)
     context[self.varname] = d
@@ -151,28 +304,19 @@ class SWCommentsRenderFormNode(SWCommentsBaseNode):
     if not isinstance(o, dbmodels.Model):
       raise TypeError("Object passed after 'for' must be a model instance")
   
-    # Find template
-    tn = (self.templatename or 'form.html') 
-    o_name = type(o).__name__.lower()
-    app_label, model = self.model_class.get_nonproxy_model_name()
-    _d = dict(app_label=app_label, model=model, objmodel=o_name, template_name=tn)
-    templates = [ _s % _d for _s in views.FORM_TEMPLATES ]
-    t = template.loader.select_template(templates)
-
-    # Create form
-    form = self.model_class.get_form_class()(o, template_name=tn)
-
-    # Create context (copy from existing to retain all variables that exist) and render
-    context.push()
-    context.update({
-      'object': o,
-      'form': form,
-    })
-    c = template.Context(context)
-    html = t.render(c)
-    context.pop()
+    return views.render_forms(self.model_class, [ o ], context, self.templatename, self.deferred and True or None)[0]
 
-    return html
+class SWCommentsRenderFormsNode(SWCommentsBaseNode):
+  """
+  Actual implementation of swcomments_render_forms tag.
+  """
+  def render(self, context):
+    o_expr = self.o_expr.resolve(context)
+    if not o_expr:
+      return ''
+    if not isinstance(o_expr, (QuerySet, tuple, list)):
+      raise TypeError("Object passed after 'for' must be a queryset/list/tuple of model instances")
+    return ''.join(views.render_forms(self.model_class, o_expr, context, self.templatename, self.deferred and True or None))
 
 def _parse(token, accept={}):
   """
@@ -213,7 +357,7 @@ def swcomments_get_list(parser, token):
   """
   Usage:
 
-    {% swcomments_get_list for [object_or_queryset] (of [model]) (as [varname]) (order [oname]) %}
+    {% swcomments_get_list for [object_or_queryset] (of [model]) (as [varname]) (order [oname]) (prefetch [yes]) (after [cursor]) (limit [n]) %}
 
   Sets a list 'varname' (default 'comment_list') in current context, of comment objects of type 'model' 
   (default swcomments.Comment) for the object (instance) or queryset/list of objects.
@@ -224,6 +368,11 @@ def swcomments_get_list(parser, token):
   - model must be a valid comment model, ie based on swcomments.BaseComment.
   - in all cases above, 'model' does not need to include app_label (it is assumed to
     be swcomments).  If you need to include an app_label, the syntax is "app_label.model".
+  - if 'prefetch' is given, the list is evaluated and each comment's content_object is set to
+    the object(s) passed (no extra query per comment when accessing comment.content_object).
+  - if 'after' and/or 'limit' is given, only one page of comments (keyset pagination) is set,
+    starting after 'cursor' (first page if empty/invalid).  The cursor of the next page is set
+    in '[varname]_next' (None on the last page).
   """
   SYNTAX_EXCEPTION_STR = "%r tag syntax incorrect (requires a 'for [object_or_qs]', 'as [varname]', and optional 'of [model]')" 
 
@@ -234,6 +383,9 @@ def swcomments_get_list(parser, token):
       'as': { 'name': 'varname' },
       'filter': { 'name': 'filter' },
       'order': { 'name': 'order' },
+      'prefetch': { 'name': 'prefetch' },
+      'after': { 'name': 'after' },
+      'limit': { 'name': 'limit' },
     })
   except Exception, e:
     raise template.TemplateSyntaxError(SYNTAX_EXCEPTION_STR % (str(e),))
@@ -256,6 +408,8 @@ def swcomments_get_count(parser, token):
   - model must be a valid comment model, ie based on swcomments.BaseComment.
   - in all cases above, 'model' does not need to include app_label (it is assumed to
     be swcomments).  If you need to include an app_label, the syntax is "app_label.model".
+  - if settings.SWCOMMENTS_USE_COUNTERS is True, the count is read from the denormalized
+    counter table (see swcomments.counters) instead of being counted.
   """
   SYNTAX_EXCEPTION_STR = "%r tag syntax incorrect (requires a 'for [object_or_qs]', 'as [varname]', and optional 'of [model]')" 
 
@@ -271,6 +425,127 @@ def swcomments_get_count(parser, token):
 
   return SWCommentsGetCountNode(**d)
 
+@register.tag
+def swcomments_get_counts(parser, token):
+  """
+  Usage:
+
+    {% swcomments_get_counts for [objects_or_queryset] (of [model]) (as [varname]) %}
+
+  Sets a dictionary 'varname' in current context, of the number of comments of type 'model' 
+  (default swcomments.Comment) for each object of the queryset/list of objects.  The key for each
+  count is the object from the list of objects or queryset.
+
+  Notes:
+  - counts are computed with a single query (GROUP BY) using the model's do_count semantics, or
+    read from the counter table if settings.SWCOMMENTS_USE_COUNTERS is True.
+  - objects_or_queryset can either be a list/tuple of instances of a model, or a queryset containing
+    instance(s) of a model.  It may also be empty/None/empty sequence, in which case an empty dict is set.
+  - model must be a valid comment model, ie based on swcomments.BaseComment.
+  - in all cases above, 'model' does not need to include app_label (it is assumed to
+    be swcomments).  If you need to include an app_label, the syntax is "app_label.model".
+  """
+  SYNTAX_EXCEPTION_STR = "%r tag syntax incorrect (requires a 'for [objects_or_qs]', 'as [varname]', and optional 'of [model]')" 
+
+  try:
+    d = _parse(token, { 
+      'for': { 'name': 'o_expr' }, 
+      'of': { 'name': 'model', 'default': 'Comment' }, 
+      'as': { 'name': 'varname' },
+      'filter': { 'name': 'filter' },
+    })
+  except Exception, e:
+    raise template.TemplateSyntaxError(SYNTAX_EXCEPTION_STR % (str(e),))
+
+  return SWCommentsGetCountsNode(**d)
+
+def _rating_node(NodeClass, token, SYNTAX_EXCEPTION_STR):
+  try:
+    d = _parse(token, { 
+      'for': { 'name': 'o_expr' }, 
+      'of': { 'name': 'model', 'default': 'RatingComment' }, 
+      'as': { 'name': 'varname' },
+    })
+  except Exception, e:
+    raise template.TemplateSyntaxError(SYNTAX_EXCEPTION_STR % (str(e),))
+  node = NodeClass(**d)
+  if not ratings.is_rating_model(node.model_class):
+    raise template.TemplateSyntaxError("The Comment model '%s' must be based on swcomments.BaseRatingComment" % (node.model_class,))
+  return node
+
+@register.tag
+def swcomments_get_rating(parser, token):
+  """
+  Usage:
+
+    {% swcomments_get_rating for [object] (of [model]) (as [varname]) %}
+
+  Sets the ratings 'varname' of the object (instance) in current context: a RatingAggregate with
+  count, average, stddev, distribution (list of { low, high, count, percent }) and score (Bayesian-
+  adjusted average, see settings.SWCOMMENTS_RATING_PRIOR_MEAN/_WEIGHT) attributes, for comments of
+  type 'model' (default swcomments.RatingComment).
+
+  Notes:
+  - ratings are read from the denormalized aggregate table (see swcomments.ratings): only active
+    comments (and only the latest rating of each stack, for stacked models) count.
+  - model must be a rating comment model, ie based on swcomments.BaseRatingComment.
+  - in all cases above, 'model' does not need to include app_label (it is assumed to
+    be swcomments).  If you need to include an app_label, the syntax is "app_label.model".
+  """
+  return _rating_node(SWCommentsGetRatingNode, token,
+                      "%r tag syntax incorrect (requires a 'for [object]', 'as [varname]', and optional 'of [model]')")
+
+@register.tag
+def swcomments_get_ratings(parser, token):
+  """
+  Usage:
+
+    {% swcomments_get_ratings for [objects_or_queryset] (of [model]) (as [varname]) %}
+
+  Same as swcomments_get_rating, for each object of the queryset/list of objects: sets a dictionary
+  'varname' in current context whose keys are the objects and values their ratings.
+  """
+  return _rating_node(SWCommentsGetRatingsNode, token,
+                      "%r tag syntax incorrect (requires a 'for [objects_or_qs]', 'as [varname]', and optional 'of [model]')")
+
+@register.tag
+def swcomments_search(parser, token):
+  """
+  Usage:
+
+    {% swcomments_search query [text] (of [model]) (for [object]) (site [site]) (page [n]) (per_page [n]) (as [varname]) %}
+
+  Sets 'varname' (default 'search_results') in current context to one page of the active comments
+  containing all the words of 'text', best matches first (see swcomments.search).  It can be
+  iterated, and has page, has_next, has_previous, next_page_number and previous_page_number
+  attributes; each comment has a 'search_rank' attribute.
+
+  Notes:
+  - requires settings.SWCOMMENTS_SEARCH to be True.
+  - comments of all comment models are searched, unless 'model' is given (it does not need to
+    include app_label if it is swcomments, otherwise the syntax is "app_label.model").
+  - comments are searched for the current site (or 'site', a Site or site id), and only for
+    'object' if given.
+  """
+  SYNTAX_EXCEPTION_STR = "%r tag syntax incorrect (requires a 'query [text]', and optional 'of [model]', 'for [object]', 'site [site]', 'page [n]', 'per_page [n]', 'as [varname]')"
+
+  try:
+    d = _parse(token, {
+      'query': { 'name': 'query' },
+      'of': { 'name': 'model' },
+      'for': { 'name': 'o_expr' },
+      'site': { 'name': 'site' },
+      'page': { 'name': 'page' },
+      'per_page': { 'name': 'per_page' },
+      'as': { 'name': 'varname', 'default': 'search_results' },
+    })
+  except Exception, e:
+    raise template.TemplateSyntaxError(SYNTAX_EXCEPTION_STR % (str(e),))
+  if not d['query']:
+    raise template.TemplateSyntaxError(SYNTAX_EXCEPTION_STR % ('swcomments_search',))
+
+  return SWCommentsSearchNode(**d)
+
 @register.tag
 def swcomments_get_lists(parser, token):
   """
@@ -337,7 +612,7 @@ def swcomments_render_form(parser, token):
   """
   Usage:
 
-    {% swcomments_render_form for [object] (of [model]) (using [templatename]) %}
+    {% swcomments_render_form for [object] (of [model]) (using [templatename]) (deferred [yes]) %}
 
   renders the form for object 'object' using the Form associated to model 'model' (default
   'swcomments.Comment').
@@ -350,26 +625,81 @@ def swcomments_render_form(parser, token):
 
   There will be a 'form' object made available to the template as well as a 'object' object
   (the original object).
+
+  If 'deferred' is given (or settings.SWCOMMENTS_DEFER_SECURITY_DATA is True), the form is rendered
+  without its timestamp/security_hash so that the page can be cached; they must be filled in from the
+  swcomments_security_data view before posting.
   """
   SYNTAX_EXCEPTION_STR = "%r tag syntax incorrect (requires a 'for [object]', optional 'of [model]' and optional 'using [templatename]')" 
 
   try:
-    d = _parse(token, { 'for': { 'name': 'o_expr' }, 'of': { 'name': 'model', 'default': 'Comment' }, 'using': { 'name': 'templatename' } })
+    d = _parse(token, { 'for': { 'name': 'o_expr' }, 'of': { 'name': 'model', 'default': 'Comment' }, 'using': { 'name': 'templatename' }, 'deferred': { 'name': 'deferred' } })
   except:
     raise template.TemplateSyntaxError(SYNTAX_EXCEPTION_STR % (tag_name,))
 
   return SWCommentsRenderFormNode(**d)
 
+@register.tag
+def swcomments_render_forms(parser, token):
+  """
+  Usage:
+
+    {% swcomments_render_forms for [objects_or_queryset] (of [model]) (using [templatename]) (deferred [yes]) %}
+
+  renders the form of each object of 'objects_or_queryset' (one after the other), exactly like
+  calling swcomments_render_form for each of them, but resolving the template and model data once.
+  """
+  SYNTAX_EXCEPTION_STR = "%r tag syntax incorrect (requires a 'for [objects_or_qs]', optional 'of [model]' and optional 'using [templatename]')" 
+
+  try:
+    d = _parse(token, { 'for': { 'name': 'o_expr' }, 'of': { 'name': 'model', 'default': 'Comment' }, 'using': { 'name': 'templatename' }, 'deferred': { 'name': 'deferred' } })
+  except Exception, e:
+    raise template.TemplateSyntaxError(SYNTAX_EXCEPTION_STR % (str(e),))
+
+  return SWCommentsRenderFormsNode(**d)
+
 @register.filter
 def swcomments_thread(arg):
   """Filter to be used in a for loop/with statement that threads the comment list/queryset.
-  Uses the actual comment class' "thread" method (if available) to do the work"""
-  if not isinstance(arg, (QuerySet, tuple, list)): return arg
-  l = list(arg)
-  if not l: return arg
-  cls = type(l[0])
+  Uses the actual comment class' "thread" method (if available) to do the work.  Querysets are
+  passed to it as-is (so that it can stream them); the model is taken from the queryset."""
+  if isinstance(arg, QuerySet):
+    cls = arg.model
+  elif isinstance(arg, (tuple, list)) and arg:
+    cls = type(arg[0])
+  else:
+    return arg
   if not hasattr(cls, 'do_thread') or not callable(cls.do_thread): return arg
-  return cls.do_thread(l)
-
-
+  return cls.do_thread(arg)
 
+@register.filter
+def swcomments_stack_tops(arg):
+  """Filter to be used in a for loop/with statement that returns only the tops of the stacks of
+  a StackedComment queryset or list (eg. from a cached or paged swcomments_get_list), each with
+  an 'others_count' attribute (number of other comments in its stack).  Anything else is
+  returned as-is."""
+  if isinstance(arg, QuerySet):
+    cls = arg.model
+  elif isinstance(arg, (tuple, list)) and arg:
+    cls = type(arg[0])
+  else:
+    return arg
+  if not hasattr(cls, 'get_tops'): return arg
+  return cls.get_tops(arg)
+
+# Measure the tags and filters when instrumentation is enabled (see swcomments.instrumentation)
+for _node_class, _tag_name in (
+    (SWCommentsGetListNode, 'swcomments_get_list'),
+    (SWCommentsGetListsNode, 'swcomments_get_lists'),
+    (SWCommentsGetCountNode, 'swcomments_get_count'),
+    (SWCommentsGetCountsNode, 'swcomments_get_counts'),
+    (SWCommentsGetRatingNode, 'swcomments_get_rating'),
+    (SWCommentsGetRatingsNode, 'swcomments_get_ratings'),
+    (SWCommentsSearchNode, 'swcomments_search'),
+    (SWCommentsRenderListNode, 'swcomments_render_list'),
+    (SWCommentsRenderFormNode, 'swcomments_render_form'),
+    (SWCommentsRenderFormsNode, 'swcomments_render_forms'),
+  ):
+  instrumentation.instrument_node(_node_class, _tag_name)
+for _filter in (swcomments_thread, swcomments_stack_tops):
+  register.filter(_filter.__name__, instrumentation.instrument_filter(_filter, _filter.__name__))
@@ -0,0 +1,35 @@
+"""
+Base test case of the swcomments tests (see runtests.py): users, articles to comment on and
+a helper to post comments.
+"""
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.test import TestCase
+
+from bench.models import Article
+from swcomments import models
+
+class SWCommentsTestCase(TestCase):
+
+  def setUp(self):
+    self.site = Site.objects.get_current()
+    self.users = [ User.objects.create(username='user%d' % i) for i in range(3) ]
+    self.article = Article.objects.create(title='Article')
+    self.other_article = Article.objects.create(title='Other article')
+    self.ct = ContentType.objects.get_for_model(Article)
+
+  def post(self, model_class, o=None, user=None, **kwargs):
+    """Save and return a new comment of 'model_class' on 'o' (default self.article)"""
+    kwargs.setdefault('comment', 'Comment')
+    return model_class.objects.create(site=self.site, content_object=o or self.article,
+                                      user=user or self.users[0], **kwargs)
+
+  def comments(self, model_class, o=None, filter=None):
+    """Return the queryset of the comments of 'model_class' on 'o' (default self.article)"""
+    o = o or self.article
+    return model_class.get_manager(filter).filter(models.object_filter(o.pk), content_type=self.ct)
+
+  def reload(self, comment):
+    return type(comment)._base_manager.get(pk=comment.pk)
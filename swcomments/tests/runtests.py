@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""
+swcomments tests.
+
+  python swcomments/tests/runtests.py [-v] [test_module ...]
+
+Runs the test_*.py modules of this directory (or only those named) with the settings of the
+benchmark project (see swcomments/benchmarks/settings.py: SQLite in memory, locmem cache and
+the 'bench' app, whose Article model is commentable).  Exits with status 1 if a test fails.
+"""
+
+import glob
+import os
+import sys
+import unittest
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+def main(argv):
+  verbosity = 1
+  names = []
+  for arg in argv:
+    if arg == '-v':
+      verbosity = 2
+    else:
+      names.append(os.path.splitext(os.path.basename(arg))[0])
+  if not names:
+    names = sorted([ os.path.splitext(os.path.basename(f))[0] for f in glob.glob(os.path.join(DIR, 'test_*.py')) ])
+
+  # Same project as the benchmarks: settings, urls and tables
+  sys.path.insert(0, os.path.join(os.path.dirname(DIR), 'benchmarks'))
+  from run import setup
+  setup()
+  sys.path.insert(0, DIR)
+
+  suite = unittest.TestSuite()
+  for name in names:
+    suite.addTests(unittest.defaultTestLoader.loadTestsFromModule(__import__(name)))
+  result = unittest.TextTestRunner(verbosity=verbosity).run(suite)
+  return not result.wasSuccessful() and 1 or 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,47 @@
+from django.template import Template, Context
+from django.test.utils import override_settings
+
+from base import SWCommentsTestCase
+from swcomments import cache as swcache
+from swcomments import models
+
+LIST = Template('{% load swctags %}'
+                '{% swcomments_get_list for article of Comment filter active as comments %}'
+                '{% swcomments_get_count for article of Comment filter active as count %}'
+                '{{ count }}:{% for c in comments %}{{ c.comment }},{% endfor %}')
+
+class CacheTest(SWCommentsTestCase):
+
+  def setUp(self):
+    super(CacheTest, self).setUp()
+    swcache.get_comment_cache().clear()
+
+  def render(self):
+    return LIST.render(Context({ 'article': self.article }))
+
+  @override_settings(SWCOMMENTS_CACHE=True)
+  def test_cached(self):
+    self.post(models.Comment, comment='c1')
+    self.assertEqual(self.render(), '1:c1,')
+    self.assertNumQueries(0, self.render)
+    self.post(models.Comment, comment='c2')
+    self.assertEqual(self.render(), '2:c2,c1,')
+    self.assertNumQueries(0, self.render)
+
+  @override_settings(SWCOMMENTS_CACHE=True)
+  def test_invalidation(self):
+    c = self.post(models.Comment, comment='c1')
+    self.post(models.Comment, self.other_article, comment='other')
+    self.assertEqual(self.render(), '1:c1,')
+    c.status = models.Comment.STATUS_DELETED
+    c.save()
+    self.assertEqual(self.render(), '0:')
+    models.Comment.bulk_update_status(models.Comment.objects.filter(pk=c.pk), models.Comment.STATUS_ACTIVE)
+    self.assertEqual(self.render(), '1:c1,')
+    models.Comment.objects.get(pk=c.pk).delete()
+    self.assertEqual(self.render(), '0:')
+
+  def test_disabled(self):
+    self.post(models.Comment, comment='c1')
+    self.render()
+    self.assertNumQueries(2, self.render)
@@ -0,0 +1,64 @@
+from django.test.utils import override_settings
+
+from base import SWCommentsTestCase
+from swcomments import models, counters
+
+class CountersTest(SWCommentsTestCase):
+
+  def assertCounters(self):
+    """Every counter row holds what a full COUNT returns"""
+    for row in models.CommentCount.objects.all():
+      count = counters.count_comments(row.get_comment_model(), row.content_type_id, row.object_pk, row.filter)
+      self.assertEqual(row.count, count, '%s/%s: %d, not %d' % (row.comment_model, row.filter, row.count, count))
+
+  @override_settings(SWCOMMENTS_USE_COUNTERS=True)
+  def test_save_and_delete(self):
+    self.assertEqual(counters.get_count(models.Comment, self.article), 0)
+    self.assertEqual(counters.get_count(models.Comment, self.article, 'active'), 0)
+    c = self.post(models.Comment)
+    self.post(models.Comment, user=self.users[1])
+    self.post(models.Comment, self.other_article)
+    self.assertEqual(counters.get_count(models.Comment, self.article, 'active'), 2)
+    c.status = models.Comment.STATUS_DELETED
+    c.save()
+    self.assertEqual(counters.get_count(models.Comment, self.article, 'active'), 1)
+    self.assertEqual(counters.get_count(models.Comment, self.article), 2)
+    c.delete()
+    self.assertEqual(counters.get_count(models.Comment, self.article), 1)
+    self.assertCounters()
+
+  @override_settings(SWCOMMENTS_USE_COUNTERS=True)
+  def test_stacked(self):
+    # Only the tops of the stacks count
+    counters.get_count(models.StackedComment, self.article, 'active')
+    self.post(models.StackedComment)
+    self.post(models.StackedComment)
+    top = self.post(models.StackedComment, user=self.users[1])
+    self.assertEqual(counters.get_count(models.StackedComment, self.article, 'active'), 2)
+    top.delete()
+    self.assertEqual(counters.get_count(models.StackedComment, self.article, 'active'), 1)
+    self.assertCounters()
+
+  @override_settings(SWCOMMENTS_USE_COUNTERS=True)
+  def test_unanswered(self):
+    counters.get_count(models.QuestionComment, self.article, 'unanswered')
+    q = self.post(models.QuestionComment)
+    self.post(models.QuestionComment)
+    self.assertEqual(counters.get_count(models.QuestionComment, self.article, 'unanswered'), 2)
+    a = self.post(models.AnswerComment, question=q)
+    self.assertEqual(counters.get_count(models.QuestionComment, self.article, 'unanswered'), 1)
+    a.status = models.QAComment.STATUS_DELETED
+    a.save()
+    self.assertEqual(counters.get_count(models.QuestionComment, self.article, 'unanswered'), 2)
+    self.assertCounters()
+
+  @override_settings(SWCOMMENTS_USE_COUNTERS=True)
+  def test_bulk_and_rebuild(self):
+    counters.get_count(models.Comment, self.article, 'active')
+    for u in self.users:
+      self.post(models.Comment, user=u)
+    models.Comment.bulk_update_status(self.comments(models.Comment), models.Comment.STATUS_DELETED)
+    self.assertEqual(counters.get_count(models.Comment, self.article, 'active'), 0)
+    models.CommentCount.objects.update(count=42)
+    self.assertEqual(counters.rebuild_counts(models.Comment), 1)
+    self.assertCounters()
@@ -0,0 +1,18 @@
+from base import SWCommentsTestCase
+from swcomments import models
+
+class AnonCommentFormTest(SWCommentsTestCase):
+
+  def test_model_data(self):
+    # The form's name/email/url fields are the model's user_name/user_email/user_url
+    form_class = models.AnonComment.get_form_class()
+    data = dict(form_class(self.article).initial, comment='Anonymous',
+                name='Joe', email='joe@example.com', url='http://example.com/')
+    form = form_class(self.article, data=data)
+    self.assertTrue(form.is_valid(), form.errors)
+    # As post_comment saves it
+    c = models.AnonComment(**form.get_model_data())
+    c.user = self.users[0]
+    c.save()
+    c = self.reload(c)
+    self.assertEqual((c.user_name, c.user_email, c.user_url), ('Joe', 'joe@example.com', 'http://example.com/'))
@@ -0,0 +1,60 @@
+import types
+
+from django.core.management import call_command
+
+from base import SWCommentsTestCase
+from swcomments import models
+
+class AnswerCountTest(SWCommentsTestCase):
+
+  def setUp(self):
+    super(AnswerCountTest, self).setUp()
+    self.q1 = self.post(models.QuestionComment, title='Q1')
+    self.q2 = self.post(models.QuestionComment, title='Q2')
+
+  def assertAnswers(self, question, count):
+    q = self.reload(question)
+    self.assertEqual(q.answer_count, count)
+    if count:
+      last = models.QAComment.active.filter(question=q.pk).order_by('-submit_date')[0].submit_date
+      self.assertEqual(q.last_answer_date, last)
+    else:
+      self.assertEqual(q.last_answer_date, None)
+
+  def test_answers(self):
+    a = self.post(models.AnswerComment, question=self.q1)
+    self.post(models.AnswerComment, question=self.q1, user=self.users[1])
+    self.assertAnswers(self.q1, 2)
+    a.status = models.QAComment.STATUS_DELETED
+    a.save()
+    self.assertAnswers(self.q1, 1)
+    self.reload(a).delete()
+    self.assertAnswers(self.q1, 1)
+
+  def test_moved_answer(self):
+    # Both the question answered before and the one answered now are updated
+    a = self.post(models.AnswerComment, question=self.q1)
+    a = models.QAComment.objects.get(pk=a.pk)
+    a.question = self.q2
+    a.save()
+    self.assertAnswers(self.q1, 0)
+    self.assertAnswers(self.q2, 1)
+
+  def test_bulk_and_rebuild(self):
+    answers = [ self.post(models.AnswerComment, question=self.q1, user=u) for u in self.users ]
+    models.QAComment.bulk_update_status(models.QAComment.objects.filter(pk__in=[ a.pk for a in answers[:2] ]),
+                                        models.QAComment.STATUS_DELETED)
+    self.assertAnswers(self.q1, 1)
+    models.QAComment.objects.update(answer_count=7)
+    call_command('swcomments_rebuild_answers', verbosity=0)
+    self.assertAnswers(self.q1, 1)
+    self.assertAnswers(self.q2, 0)
+
+  def test_thread(self):
+    a1 = self.post(models.AnswerComment, question=self.q2)
+    a2 = self.post(models.AnswerComment, question=self.q1)
+    thread = models.QAComment.do_thread(self.comments(models.QAComment, filter='active'))
+    self.assertTrue(isinstance(thread, types.GeneratorType))
+    self.assertEqual([ c.pk for c in thread ], [ self.q1.pk, a2.pk, self.q2.pk, a1.pk ])
+    chunks = models.QAComment.iter_queryset_thread(self.comments(models.QAComment), chunk_size=1)
+    self.assertEqual([ c.pk for c in chunks ], [ self.q1.pk, a2.pk, self.q2.pk, a1.pk ])
@@ -0,0 +1,43 @@
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from bench.models import Article
+from swcomments import models
+from swcomments.registry import CommentRegistry, registry
+
+class RegistryTest(TestCase):
+
+  def make(self, *comment_models):
+    r = CommentRegistry()
+    for m in comment_models:
+      r.register(m)
+    return r
+
+  @override_settings(SWCOMMENTS_COMMENTABLE_MODELS=[])
+  def test_default(self):
+    r = self.make(models.Comment)
+    self.assertEqual(r.get_comment_model('swcomments.comment'), models.Comment)
+    self.assertEqual(r.get_comment_model('swcomments.threadedcomment'), None)
+    self.assertEqual(r.get_commentable_model('bench.article'), None)
+    self.assertEqual(r.get_content_type('bench.article'), None)
+
+  @override_settings(SWCOMMENTS_COMMENTABLE_MODELS=['bench.Article'])
+  def test_commentable(self):
+    r = self.make()
+    self.assertEqual(r.get_commentable_model('bench.article'), Article)
+    self.assertEqual(r.get_commentable_model('Bench.Article'), Article)
+    self.assertEqual(r.get_content_type('bench.article'), ContentType.objects.get_for_model(Article))
+    self.assertEqual(r.get_content_type(Article), ContentType.objects.get_for_model(Article))
+    self.assertNumQueries(0, r.get_content_type, 'bench.article')
+
+  def test_not_commentable(self):
+    for label in ('swcomments.comment', 'swcomments.commentcount', 'nosuch.model'):
+      r = self.make()
+      with self.settings(SWCOMMENTS_COMMENTABLE_MODELS=[label]):
+        self.assertRaises(ValueError, r.build)
+
+  def test_registered(self):
+    # Comment models register themselves when swcomments is imported
+    for m in (models.Comment, models.StackedComment, models.QAComment, models.ThreadedComment):
+      self.assertEqual(registry.get_comment_model(str(m._meta)), m)
@@ -0,0 +1,55 @@
+from django.test.utils import override_settings
+
+from base import SWCommentsTestCase
+from swcomments import models, search
+
+class SearchTestMixin(object):
+  backend = None
+
+  def setUp(self):
+    super(SearchTestMixin, self).setUp()
+    search._backend = None
+    self.settings_override = override_settings(SWCOMMENTS_SEARCH=True, SWCOMMENTS_SEARCH_BACKEND=self.backend)
+    self.settings_override.enable()
+    search.get_backend().setup()
+
+  def tearDown(self):
+    self.settings_override.disable()
+    search._backend = None
+    super(SearchTestMixin, self).tearDown()
+
+  def found(self, query, **kwargs):
+    return [ (type(c).__name__, c.comment) for c in search.search(query, **kwargs) ]
+
+  def test_models(self):
+    # The same id in two comment models: two documents
+    c = self.post(models.Comment, comment='brown fox')
+    t = self.post(models.ThreadedComment, comment='red fox')
+    self.assertEqual(c.pk, t.pk)
+    self.assertEqual(sorted(self.found('fox')), [ ('Comment', 'brown fox'), ('ThreadedComment', 'red fox') ])
+    self.assertEqual(self.found('fox', model_classes=[ models.ThreadedComment ]), [ ('ThreadedComment', 'red fox') ])
+    t.status = models.ThreadedComment.STATUS_DELETED
+    t.save()
+    self.assertEqual(self.found('fox'), [ ('Comment', 'brown fox') ])
+    c.delete()
+    self.assertEqual(self.found('fox'), [])
+
+  def test_objects(self):
+    self.post(models.Comment, comment='brown fox')
+    self.post(models.Comment, self.other_article, comment='brown dog')
+    self.assertEqual(self.found('brown fox'), [ ('Comment', 'brown fox') ])
+    self.assertEqual(self.found('brown', o=self.other_article), [ ('Comment', 'brown dog') ])
+
+  def test_index_model(self):
+    self.post(models.Comment, comment='brown fox')
+    models.Comment.objects.update(comment='quick dog')
+    self.assertEqual(search.index_model(models.Comment, chunk_size=1), 1)
+    self.assertEqual(self.found('fox'), [])
+    self.assertEqual(self.found('quick'), [ ('Comment', 'quick dog') ])
+
+class TokenSearchTest(SearchTestMixin, SWCommentsTestCase):
+  backend = 'tokens'
+
+if search.FTS5SearchBackend.available():
+  class FTS5SearchTest(SearchTestMixin, SWCommentsTestCase):
+    backend = 'fts5'
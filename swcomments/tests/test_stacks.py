@@ -0,0 +1,64 @@
+from django.core.management import call_command
+
+from base import SWCommentsTestCase
+from swcomments import models
+
+class StacksTest(SWCommentsTestCase):
+
+  def setUp(self):
+    super(StacksTest, self).setUp()
+    u0, u1, u2 = self.users
+    self.a1 = self.post(models.StackedComment, user=u0, comment='a1')
+    self.b1 = self.post(models.StackedComment, user=u1, comment='b1')
+    self.a2 = self.post(models.StackedComment, user=u0, comment='a2')
+    self.c1 = self.post(models.StackedComment, user=u2, comment='c1')
+
+  def texts(self, comments):
+    return [ c.comment for c in comments ]
+
+  def test_stack_dates(self):
+    a1, a2 = self.reload(self.a1), self.reload(self.a2)
+    self.assertEqual(a1.stack_id, a2.stack_id)
+    self.assertEqual(a1.stack_date, a2.submit_date)
+    self.assertEqual(a1.stack.stack_date, a2.submit_date)
+    self.assertFalse(a1.is_top())
+    self.assertTrue(a2.is_top())
+
+  def test_order_and_count(self):
+    qs = self.comments(models.StackedComment, filter='active')
+    self.assertEqual(self.texts(qs), [ 'c1', 'a2', 'a1', 'b1' ])
+    self.assertEqual(models.StackedComment.do_count(qs).count(), 3)
+    tops = models.StackedComment.do_thread(qs)
+    self.assertEqual([ (t.comment, self.texts(t.others)) for t in tops ], [ ('c1', []), ('a2', [ 'a1' ]), ('b1', []) ])
+
+  def test_tops(self):
+    qs = self.comments(models.StackedComment, filter='active')
+    for arg in (qs, list(qs)):
+      tops = models.StackedComment.get_tops(arg)
+      self.assertEqual([ (t.comment, t.others_count) for t in tops ], [ ('c1', 0), ('a2', 1), ('b1', 0) ])
+
+  def test_build_stacks(self):
+    models.StackedComment._base_manager.update(stack=None, stack_date=None)
+    models.CommentStack.objects.all().delete()
+    call_command('swcomments_build_stacks', verbosity=0, chunk_size=2)
+    self.assertEqual(models.CommentStack.objects.count(), 3)
+    self.test_stack_dates()
+    self.test_order_and_count()
+
+  def test_paging(self):
+    # Stack order: a stack moving to the first page is not shown again by the next pages
+    qs = self.comments(models.StackedComment, filter='active')
+    page, after = models.StackedComment.get_page(qs, None, 2)
+    self.assertEqual(self.texts(page), [ 'c1', 'a2' ])
+    self.post(models.StackedComment, user=self.users[1], comment='b2')
+    page, after = models.StackedComment.get_page(qs, after, 2)
+    self.assertEqual(self.texts(page), [ 'a1' ])
+    self.assertEqual(after, None)
+    # Date order: every comment, once
+    seen, after = [], None
+    while True:
+      page, after = models.StackedComment.get_page(qs, after, 2, 'desc')
+      seen += self.texts(page)
+      if after is None:
+        break
+    self.assertEqual(seen, [ 'b2', 'c1', 'a2', 'b1', 'a1' ])
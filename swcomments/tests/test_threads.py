@@ -0,0 +1,51 @@
+from base import SWCommentsTestCase
+from swcomments import models
+
+class ThreadsTest(SWCommentsTestCase):
+
+  def setUp(self):
+    super(ThreadsTest, self).setUp()
+    self.c1 = self.post(models.ThreadedComment, comment='c1')
+    self.c2 = self.post(models.ThreadedComment, comment='c2')
+    self.r1 = self.post(models.ThreadedComment, comment='r1', parent=self.c1)
+    self.r11 = self.post(models.ThreadedComment, comment='r11', parent=self.r1)
+    self.r2 = self.post(models.ThreadedComment, comment='r2', parent=self.c1)
+    self.other = self.post(models.ThreadedComment, self.other_article, comment='other')
+
+  def texts(self, comments):
+    return [ c.comment for c in comments ]
+
+  def test_paths(self):
+    r11 = self.reload(self.r11)
+    self.assertEqual(r11.depth, 2)
+    self.assertEqual(r11.path, models.path_step(self.c1.pk) + models.path_step(self.r1.pk) + models.path_step(r11.pk))
+    self.assertEqual(self.reload(self.c2).path, models.path_step(self.c2.pk))
+
+  def test_max_depth(self):
+    parent = self.r11
+    for i in range(models.THREAD_MAX_DEPTH + 1):
+      parent = self.post(models.ThreadedComment, parent=parent)
+    self.assertEqual(self.reload(parent).depth, models.THREAD_MAX_DEPTH)
+
+  def test_thread(self):
+    qs = self.comments(models.ThreadedComment, filter='active')
+    expected = [ 'c1', 'r1', 'r11', 'r2', 'c2' ]
+    self.assertEqual(self.texts(models.ThreadedComment.do_thread(qs)), expected)
+    self.assertEqual(self.texts(models.ThreadedComment.do_thread(list(qs.order_by('-id')))), expected)
+    # A sliced queryset keeps its slice (the 3 latest comments) and is sorted in memory
+    self.assertEqual(self.texts(models.ThreadedComment.do_thread(qs.order_by('-id')[:3])), [ 'r1', 'r11', 'r2' ])
+
+  def test_subtree(self):
+    c1 = self.reload(self.c1)
+    self.assertEqual(self.texts(c1.get_subtree()), [ 'c1', 'r1', 'r11', 'r2' ])
+    self.assertEqual(self.texts(self.reload(self.r1).get_subtree(include_self=False)), [ 'r11' ])
+    self.assertEqual(self.texts(self.reload(self.c2).get_subtree()), [ 'c2' ])
+
+  def test_reply_to_deleted(self):
+    self.r1.status = models.ThreadedComment.STATUS_DELETED
+    self.r1.save()
+    form_class = models.ThreadedComment.get_form_class()
+    for parent, valid in ((self.c1, True), (self.r1, False), (self.other, False)):
+      form = form_class(self.article, data=dict(form_class(self.article).initial, comment='Reply', parent_id=parent.pk))
+      self.assertEqual(form.is_valid(), valid)
+      self.assertEqual('parent_id' in form.errors, not valid)
@@ -0,0 +1,51 @@
+from django.test.client import Client
+
+from base import SWCommentsTestCase
+from swcomments import models
+
+class ThreadCommentsViewTest(SWCommentsTestCase):
+
+  def setUp(self):
+    super(ThreadCommentsViewTest, self).setUp()
+    self.client = Client()
+    self.post(models.Comment, comment='c1')
+
+  def get(self, comment_model='swcomments.comment', **headers):
+    return self.client.get('/comments/thread-comments/', { 'comment_model': comment_model,
+                                                          'content_type': 'bench.article',
+                                                          'object_pk': self.article.pk }, **headers)
+
+  def test_conditional_get(self):
+    response = self.get()
+    self.assertEqual(response.status_code, 200)
+    etag = response['ETag']
+    self.assertTrue(etag)
+    self.assertTrue(response.has_header('Last-Modified'))
+
+    response = self.get(HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 304)
+    self.assertEqual(response['ETag'], etag)
+    self.assertEqual(response.content, '')
+
+    # Any change (a new comment, a status change) gives a new version
+    c = self.post(models.Comment, comment='c2')
+    response = self.get(HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+    etag = response['ETag']
+    c.status = models.Comment.STATUS_DELETED
+    c.save()
+    self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+  def test_other_object(self):
+    # Comments on another object do not change the version
+    etag = self.get()['ETag']
+    self.post(models.Comment, self.other_article)
+    self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+  def test_bad_requests(self):
+    self.assertEqual(self.get(comment_model='bench.article').status_code, 400)
+    self.assertEqual(self.get(comment_model='nosuch.model').status_code, 400)
+    response = self.client.get('/comments/thread-comments/', { 'comment_model': 'swcomments.comment',
+                                                              'content_type': 'auth.user', 'object_pk': 1 })
+    self.assertEqual(response.status_code, 400)
@@ -4,5 +4,8 @@ import settings
 
 urlpatterns = patterns('swcomments.views',
   url(r'^post-comment/$', 'post_comment', name='swcomments_post_comment'),
+  url(r'^list-comments/$', 'list_comments', name='swcomments_list_comments'),
+  url(r'^thread-comments/$', 'thread_comments', name='swcomments_thread_comments'),
+  url(r'^security-data/$', 'security_data', name='swcomments_security_data'),
 )
 
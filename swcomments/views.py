@@ -2,16 +2,29 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.db import models
 from django.shortcuts import render_to_response, get_object_or_404
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponseServerError, HttpResponseBadRequest, Http404
-from django.template import RequestContext
-from django.template.loader import render_to_string
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseServerError, HttpResponseBadRequest, HttpResponseNotModified, Http404
+from django.template import Context, RequestContext
+from django.template.loader import select_template
 from django.utils import simplejson, safestring
-from django.views.decorators.http import require_POST
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.utils.cache import patch_cache_control
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_GET, require_POST
 #from django.contrib.auth.decorators import login_required
 #from django.contrib.auth import models as authmodels
 #from django.contrib.contenttypes import models as ctmodels
 
+import calendar
+import re
+import time
+
 import swcomments
+from swcomments import instrumentation
+from swcomments.registry import registry
+
+# Maximum number of objects security data can be requested for at once
+SECURITY_DATA_MAX = 100
 
 FORM_TEMPLATES = [
   "%(app_label)s/%(model)s_%(objmodel)s/%(template_name)s",
@@ -22,6 +35,95 @@ FORM_TEMPLATES = [
   "%(template_name)s"   # Urgh
 ]
 
+# Process-wide cache of resolved form templates: (comment model, object model, template name) -> Template
+_form_templates = {}
+
+def form_template_cache_enabled():
+  """The resolved template cache is bypassed in development (DEBUG), unless forced with 
+  settings.SWCOMMENTS_TEMPLATE_CACHE"""
+  return getattr(settings, 'SWCOMMENTS_TEMPLATE_CACHE', not settings.DEBUG)
+
+def clear_form_template_cache():
+  """Forget all resolved form templates (eg. after templates were changed on disk)"""
+  _form_templates.clear()
+
+def get_form_template(model_class, object_class, template_name=None):
+  """
+  Return the compiled form template for comment model 'model_class' and objects of model
+  'object_class': the first of FORM_TEMPLATES that exists.  Templates are only resolved
+  once per process (see form_template_cache_enabled()).
+  """
+  template_name = template_name or "form.html"
+  key = (model_class, object_class, template_name)
+  t = _form_templates.get(key)
+  if t is not None:
+    return t
+  app_label, model = model_class.get_nonproxy_model_name()
+  _d = dict(app_label=app_label, model=model, objmodel=object_class.__name__.lower(), template_name=template_name)
+  t = select_template([ _s % _d for _s in FORM_TEMPLATES ])
+  if form_template_cache_enabled():
+    _form_templates[key] = t
+  return t
+
+def render_forms(model_class, objects, context=None, template_name=None, defer_security=None):
+  """
+  Render the form of comment model 'model_class' for each object of a list/queryset, exactly
+  like swcomments_render_form does for one object, and return the list of rendered forms.
+  Templates, model metadata and the encoded template name are computed once; only the
+  security data is computed per object.  'context' is a template Context (or dict).
+  If 'defer_security' is True (default: settings.SWCOMMENTS_DEFER_SECURITY_DATA), forms are
+  rendered without timestamp/security_hash (see security_data view).
+  """
+  o_list = list(objects)
+  if not o_list:
+    return []
+  if not isinstance(context, Context):
+    context = Context(context or {})
+  tn = template_name or 'form.html'
+  FormClass = model_class.get_form_class()
+  comment_model = str(FormClass.get_model_class()._meta)
+  initial = { 'tn': FormClass.encode_template_name_for(tn) }
+  if defer_security is None:
+    defer_security = swcomments.forms.DEFER_SECURITY_DATA
+  timestamp = int(time.time())
+  by_class = {}
+  html = []
+  for o in o_list:
+    cls = type(o)
+    if cls not in by_class:
+      by_class[cls] = (get_form_template(model_class, cls, tn), str(o._meta))
+    t, content_type = by_class[cls]
+    if defer_security:
+      security_data = FormClass.make_static_security_data(comment_model, content_type, str(o._get_pk_val()))
+    else:
+      security_data = FormClass.make_security_data(comment_model, content_type, str(o._get_pk_val()), timestamp)
+    form = FormClass(o, initial=dict(initial), template_name=tn, security_data=security_data)
+
+    # Create context (copy from existing to retain all variables that exist) and render
+    context.push()
+    context.update({
+      'object': o,
+      'form': form,
+    })
+    html.append(t.render(Context(context)))
+    context.pop()
+  return html
+
+def lean_errors(request):
+  """Failures are returned as field errors only (no form rendering) if settings.SWCOMMENTS_LEAN_ERRORS
+  is True or the request has a true 'errors_only' field"""
+  return getattr(settings, 'SWCOMMENTS_LEAN_ERRORS', False) or request.REQUEST.get('errors_only') in ('1', 'true', 'yes')
+
+def failure_response(errors, content=None):
+  resp = dict(
+    rc="failure",
+    errors=dict([ (field, [ unicode(e) for e in messages ]) for field, messages in errors.items() ]),
+  )
+  if content is not None:
+    resp['content'] = content
+  return HttpResponse(simplejson.dumps(resp), mimetype="application/json")
+
+@instrumentation.instrument_view
 @require_POST
 def post_comment(request):
   """
@@ -33,7 +135,7 @@ def post_comment(request):
     rc: "CODE"
     [, cid: COMMENTID ]
     [, content: "..." ]
-    [, errors: [...] ]
+    [, errors: {...} ]
     [, errormsg: "MSG" ]
   }
 
@@ -42,26 +144,24 @@ def post_comment(request):
     - cid: commentid (int) on successful save
   - rc=failure: failure saving comment ('content' and 'errors' is set)
     - content: HTML rendering of form with error messages
-    - errors: json structure of errors
+    - errors: json structure of errors (field name -> list of messages)
   - rc=error: misc. error saving form ('errormsg' is server error msg)
     - errormsg: string with server's error message in case of a misc failure
-  """
 
-  import time
-  time.sleep(.5)
+  With lean errors (settings.SWCOMMENTS_LEAN_ERRORS, or an 'errors_only' field set to 1), a
+  failure only has 'errors' (the form is not rendered), and the timestamp and security hash
+  are checked before the content object is fetched and the form is built.
+  """
 
   #if not request.is_ajax():
   #  raise NotImplementedError('View currently only support AJAX requests')
 
-  # Identify Comment type (fetch actual Comment model class)
+  # Identify Comment type and content object model (only registered ones, no database hit)
   comment_model = request.POST.get('comment_model')
   if not comment_model:
     return HttpResponseBadRequest('Could not identify comment_model field')
-  try:
-    #ctmodel = ctmodels.ContentType.objects.get_by_natural_key(*comment_model.split(".", 1))
-    #CommentClass = ctmodel.model_class()  
-    ModelClass = models.get_model(*comment_model.split(".", 1))
-  except Exception, e:
+  ModelClass = registry.get_comment_model(comment_model)
+  if ModelClass is None:
     return HttpResponseBadRequest('Could not find ContentType for Comment model: %s' % (comment_model,))
 
   # Identify comment content object
@@ -72,18 +172,25 @@ def post_comment(request):
     object_pk = 0
   if not object_pk or not content_type:
     return HttpResponseBadRequest('Could not identify content_type and/or object_pk field')
-  try:
-    #ctmodel = ctmodels.ContentType.objects.get_by_natural_key(*content_type.split(".", 1))
-    #ContentObjectClass = ctmodel.model_class()
-    ContentObjectClass = models.get_model(*content_type.split(".", 1))
-  except Exception, e:
+  ContentObjectClass = registry.get_commentable_model(content_type)
+  if ContentObjectClass is None:
     return HttpResponseBadRequest('Could not find ContentType for Content object: %s' % (content_type,))
 
+  FormClass = ModelClass.get_form_class()
+  lean = lean_errors(request)
+  if lean:
+    # Cheap checks first: no database hit, no form
+    errors = FormClass.security_errors(request.POST)
+    if errors:
+      return failure_response(errors)
+
   # Fetch content_object
-  obj = ContentObjectClass.objects.get(pk=object_pk)
+  try:
+    obj = ContentObjectClass.objects.get(pk=object_pk)
+  except ContentObjectClass.DoesNotExist:
+    return HttpResponseBadRequest('Could not find content object: %s %s' % (content_type, object_pk))
 
   # Create form
-  FormClass = ModelClass.get_form_class()
   form = FormClass(obj, data=request.POST)
 
   if form.is_valid():
@@ -95,21 +202,198 @@ def post_comment(request):
 
     return HttpResponse(simplejson.dumps({ 'rc': "success", 'cid': c.id }), mimetype="application/json")
 
-
-  # Create list of templates
-  template_name = form.decode_template_name(form.data['tn']) or "form.html"
-  o_name = obj._meta.object_name.lower()
-  app_label, model = ModelClass.get_nonproxy_model_name()
-  _d = dict(app_label=app_label, model=model, objmodel=o_name, template_name=template_name)
-  templates = [ _s % _d for _s in FORM_TEMPLATES ]
+  if lean:
+    return failure_response(form.errors)
 
   # Render first template we find
-  s = render_to_string(templates, { 'form': form, 'object': obj }, context_instance=RequestContext(request))
-  
+  template_name = form.decode_template_name(form.data.get('tn', '')) or "form.html"
+  t = get_form_template(ModelClass, type(obj), template_name)
+  s = t.render(RequestContext(request, { 'form': form, 'object': obj }))
+  return failure_response(form.errors, s)
+
+@require_GET
+def list_comments(request):
+  """
+  Return one page of comments for an object (keyset pagination), as JSON.
+
+  GET parameters: comment_model and content_type ("app_label.model"), object_pk, and optional
+  filter (one of the model's PUBLIC_MANAGERS, default 'active'), order ('asc'/'desc'), after
+  (cursor) and limit.
+
+  Returns JSON structure:
+
+  {
+    rc: "success",
+    comments: [ {...}, ... ],
+    next: "CURSOR" (or null on the last page)
+  }
+  """
+  comment_model = request.GET.get('comment_model')
+  ModelClass = registry.get_comment_model(comment_model)
+  if ModelClass is None:
+    return HttpResponseBadRequest('Could not find Comment model: %s' % (comment_model,))
+
+  content_type = request.GET.get('content_type')
+  object_pk = request.GET.get('object_pk')
+  if not object_pk or not content_type:
+    return HttpResponseBadRequest('Could not identify content_type and/or object_pk field')
+  ct = registry.get_content_type(content_type)
+  if ct is None:
+    return HttpResponseBadRequest('Could not find ContentType for Content object: %s' % (content_type,))
+
+  try:
+    limit = int(request.GET.get('limit') or 0) or None
+  except ValueError:
+    return HttpResponseBadRequest('Invalid limit: %s' % (request.GET.get('limit'),))
+
+  try:
+    manager = ModelClass.get_public_manager(request.GET.get('filter'))
+  except ValueError, e:
+    return HttpResponseBadRequest(str(e))
+  qs = manager.filter(swcomments.models.object_filter(object_pk), content_type=ct)
+  try:
+    comments, next = ModelClass.get_page(qs, request.GET.get('after'), limit, request.GET.get('order'))
+  except ValueError, e:
+    return HttpResponseBadRequest(str(e))
+
   resp = dict(
-    rc="failure",
-    content=s,
-    errors=form.errors,
+    rc="success",
+    comments=[ c.as_dict() for c in comments ],
+    next=next,
   )
   return HttpResponse(simplejson.dumps(resp), mimetype="application/json")
 
+def thread_validators(ModelClass, content_type_id, object_pk, parts):
+  """Return (etag, last_modified timestamp) for the comments of 'ModelClass' for one object, from
+  their version (see models.CommentVersion: one query, bumped by every change to them,
+  including status changes, edits and deletions).  'parts' is a tuple of anything else the
+  response depends on."""
+  version, modified = swcomments.models.CommentVersion.get_for_object(ModelClass, settings.SITE_ID, content_type_id, object_pk)
+  if modified is None:
+    last_modified = None
+  elif modified.tzinfo is not None:
+    last_modified = calendar.timegm(modified.utctimetuple())
+  else:
+    last_modified = int(time.mktime(modified.timetuple()))
+  key = repr((str(ModelClass.get_nonproxy_model()._meta), content_type_id, unicode(object_pk), parts, version))
+  return md5_constructor(key).hexdigest(), last_modified
+
+def not_modified(request, etag, last_modified):
+  """Return True if the client's copy (If-None-Match / If-Modified-Since) is current"""
+  if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+  if if_none_match:
+    etags = [ e.strip() for e in re.split(r',\s*', if_none_match) ]
+    return '*' in etags or quote_etag(etag) in etags
+  if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+  if if_modified_since and last_modified is not None:
+    since = parse_http_date_safe(if_modified_since)
+    return since is not None and last_modified <= since
+  return False
+
+@require_GET
+def thread_comments(request):
+  """
+  Return all comments for an object, "threaded" by the comment model's do_thread(), as JSON.
+
+  GET parameters: comment_model and content_type ("app_label.model"), object_pk, and optional
+  filter (one of the model's PUBLIC_MANAGERS, default 'active').
+
+  The response has ETag and Last-Modified headers computed from the version of the object's
+  comments (a single query, see models.CommentVersion): conditional requests
+  (If-None-Match/If-Modified-Since) that are still current get a 304 response, without any
+  comment being loaded.
+
+  Returns JSON structure:
+
+  {
+    rc: "success",
+    comments: [ {...}, ... ]
+  }
+
+  Stacked comments are the tops of their stacks, with the rest of each stack in 'others'.
+  """
+  comment_model = request.GET.get('comment_model')
+  ModelClass = registry.get_comment_model(comment_model)
+  if ModelClass is None:
+    return HttpResponseBadRequest('Could not find Comment model: %s' % (comment_model,))
+
+  content_type = request.GET.get('content_type')
+  object_pk = request.GET.get('object_pk')
+  if not object_pk or not content_type:
+    return HttpResponseBadRequest('Could not identify content_type and/or object_pk field')
+  ct = registry.get_content_type(content_type)
+  if ct is None:
+    return HttpResponseBadRequest('Could not find ContentType for Content object: %s' % (content_type,))
+
+  filter = request.GET.get('filter') or ModelClass.PUBLIC_MANAGERS[0]
+  try:
+    manager = ModelClass.get_public_manager(filter)
+  except ValueError, e:
+    return HttpResponseBadRequest(str(e))
+  qs = manager.filter(swcomments.models.object_filter(object_pk), content_type=ct)
+  etag, last_modified = thread_validators(ModelClass, ct.id, object_pk, (filter,))
+
+  if not_modified(request, etag, last_modified):
+    response = HttpResponseNotModified()
+  else:
+    comments = []
+    for c in ModelClass.do_thread(qs):
+      d = c.as_dict()
+      if hasattr(c, 'others'):
+        d['others'] = [ o.as_dict() for o in c.others ]
+      comments.append(d)
+    resp = dict(
+      rc="success",
+      comments=comments,
+    )
+    response = HttpResponse(simplejson.dumps(resp), mimetype="application/json")
+
+  response['ETag'] = quote_etag(etag)
+  if last_modified is not None:
+    response['Last-Modified'] = http_date(last_modified)
+  patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+  return response
+
+@never_cache
+@require_GET
+def security_data(request):
+  """
+  Issue the security data (timestamp and security_hash) of comment forms rendered without
+  them (see settings.SWCOMMENTS_DEFER_SECURITY_DATA), for one or more objects.
+
+  GET parameters: comment_model and content_type ("app_label.model") and one or more object_pk.
+
+  Returns JSON structure:
+
+  {
+    rc: "success",
+    timestamp: TIMESTAMP,
+    security_hash: { "OBJECT_PK": "HASH", ... }
+  }
+  """
+  comment_model = request.GET.get('comment_model')
+  ModelClass = registry.get_comment_model(comment_model)
+  if ModelClass is None:
+    return HttpResponseBadRequest('Could not find Comment model: %s' % (comment_model,))
+  content_type = request.GET.get('content_type')
+  ContentObjectClass = registry.get_commentable_model(content_type)
+  if ContentObjectClass is None:
+    return HttpResponseBadRequest('Could not find ContentType for Content object: %s' % (content_type,))
+  object_pks = request.GET.getlist('object_pk')
+  if not object_pks or len(object_pks) > SECURITY_DATA_MAX:
+    return HttpResponseBadRequest('Between 1 and %d object_pk fields are required' % (SECURITY_DATA_MAX,))
+
+  FormClass = ModelClass.get_form_class()
+  comment_model = str(FormClass.get_model_class()._meta)
+  content_type = str(ContentObjectClass._meta)
+  timestamp = int(time.time())
+  hashes = {}
+  for pk in object_pks:
+    hashes[pk] = FormClass.make_security_data(comment_model, content_type, str(pk), timestamp)['security_hash']
+
+  resp = dict(
+    rc="success",
+    timestamp=timestamp,
+    security_hash=hashes,
+  )
+  return HttpResponse(simplejson.dumps(resp), mimetype="application/json")